@@ -2,6 +2,7 @@ import redis
 
 from loguru import logger
 import json
+import re
 from defines import (
     PostProcess,
     Settings,
@@ -9,11 +10,92 @@ from defines import (
     SignalType,
     CommandType,
     WorkerStatus,
+    RestartCause,
 )
-from job import Job
+from job import (
+    Job,
+    get_requirements,
+    get_backend_registry,
+    classify_failure,
+)
+import threading
+from typing import Callable
 import traceback
+from time import monotonic
 from datetime import datetime, timezone
-from elastic import elastic_client
+from elastic import get_elastic_shipper
+from postprocess.r2 import get_r2_spool
+
+
+CHECKPOINT_PATTERN = re.compile(r'"sd_model_checkpoint"\s*:\s*"([^"]*)"')
+
+
+def get_wait_time(created_at: str | None) -> float:
+    """
+    Seconds since a queued job was created, infinite if it won't parse so
+    that it is taken and failed rather than left blocking its queue.
+    """
+    if not created_at:
+        return 0
+    try:
+        return (
+            datetime.now(timezone.utc) - datetime.fromisoformat(created_at)
+        ).total_seconds()
+    except:
+        return float("inf")
+
+
+def get_queued_requirements(payload: str | None, metadata: str | None):
+    """
+    Checkpoint and requirements of a queued job from its raw fields, a job
+    whose fields won't parse has no checkpoint.
+    """
+    match = CHECKPOINT_PATTERN.search(payload or "")
+    checkpoint = match.group(1) if match is not None else None
+    try:
+        metadata = json.loads(metadata) if metadata else None
+    except:
+        checkpoint, metadata = None, None
+    return checkpoint, get_requirements(checkpoint, metadata)
+
+
+# Fetch a job and mark it as processing, taking it out of the queue first
+# if it is still queued (KEYS[2])
+CLAIM_SCRIPT = """
+if #KEYS > 1 and redis.call("LREM", KEYS[2], 1, KEYS[1]) == 0 then
+    return false
+end
+local job = redis.call("HGETALL", KEYS[1])
+if #job > 0 then
+    redis.call("HSET", KEYS[1], "status", "PROCESSING", "worker", ARGV[1])
+end
+return job
+"""
+
+# Pop the next command, or claim the head job of the first non-empty queue
+#
+# The worker assumes a single Redis node: the popped job hash is not in KEYS,
+# which is only allowed outside Redis Cluster, and the command, queue and job
+# keys would hash to different slots there anyway.
+CLAIM_NEXT_SCRIPT = """
+local command = redis.call("LPOP", KEYS[1])
+if command then
+    return {"COMMAND", KEYS[1], command}
+end
+for i = 2, #KEYS do
+    local job_id = redis.call("LPOP", KEYS[i])
+    if job_id then
+        local job = redis.call("HGETALL", job_id)
+        if #job > 0 then
+            redis.call(
+                "HSET", job_id, "status", "PROCESSING", "worker", ARGV[1]
+            )
+        end
+        return {"JOB", KEYS[i], job_id, job}
+    end
+end
+return false
+"""
 
 
 class RedisDatabase(object):
@@ -23,6 +105,7 @@ class RedisDatabase(object):
         logger.info(
             f"Connecting to Redis: {Settings.REDIS_HOST}:{Settings.REDIS_PORT}"
         )
+        # A single node, not a cluster, see `CLAIM_NEXT_SCRIPT`
         self.__db = redis.Redis(
             host=Settings.REDIS_HOST,
             port=Settings.REDIS_PORT,
@@ -36,20 +119,56 @@ class RedisDatabase(object):
         self.__command_key = f"command_{self.__worker}"
         self.__worker_key = f"worker_{self.__worker}"
 
+        # Extra sections of the worker status, name -> stats getter
+        self.__status_sources: dict[str, Callable[[], dict]] = {}
+
+        # Failed jobs by failure type, and webui restarts by cause
+        self.__failures: dict[str, int] = {}
+        self.__restarts = {
+            "count": 0,
+            "causes": {},
+            "last_cause": None,
+            "last_at": None,
+        }
+
+        # Round-trips to Redis, to measure them per job
+        self.__redis_stats = {
+            "round_trips": 0,
+            "claimed": 0,
+            "completed": 0,
+            "status_writes": 0,
+            "status_skips": 0,
+        }
+
         # Queue
         self.__queue_worker_key = f"queue_{self.__worker}"
         self.__queue_key_list = []
         self.update_queue_key_list()
         logger.debug(f"Queue keys: {self.__queue_key_list}")
 
+        # Server-side scripts, one round-trip per claim
+        self.__claim_script = self.__db.register_script(CLAIM_SCRIPT)
+        self.__claim_next_script = self.__db.register_script(CLAIM_NEXT_SCRIPT)
+
+        # Worker status is only written on change or to refresh its TTL
+        self.__status_lock = threading.Lock()
+        self.__status: WorkerStatus = "INITIAL"
+        self.__status_written: str | None = None
+        self.__status_written_at = 0.0
+
         # Register worker and clean previous commands
         self.__db.delete(self.__command_key)
+        self.__count_round_trip()
         self.update_worker_status("INITIAL")
 
+    def __count_round_trip(self, count: int = 1):
+        self.__redis_stats["round_trips"] += count
+
     def update_queue_key_list(self):
         try:
             # Load queue config
             queue_config_str = self.__db.get("queue:config")
+            self.__count_round_trip()
 
             if queue_config_str is None:
                 raise ValueError("Queue config not found")
@@ -82,33 +201,140 @@ class RedisDatabase(object):
             return
 
     def update_worker_status(self, status: WorkerStatus):
-        self.__db.setex(
-            self.__worker_key,
-            self.WORKER_TIMEOUT,
-            json.dumps(
-                {
-                    "status": status,
-                    "version": Settings.WORKER_VERSION,
-                    "queue_list": self.__queue_key_list,
-                }
-            ),
-        )
+        with self.__status_lock:
+            self.__status = status
+        try:
+            if self.__write_worker_status(self.__db):
+                self.__count_round_trip()
+        except:
+            self.__forget_worker_status()
+            raise
+
+    def __forget_worker_status(self):
+        with self.__status_lock:
+            self.__status_written = None
+
+    def __write_worker_status(self, client) -> bool:
+        """
+        Queue the worker status on `client` if it changed or its TTL is
+        half spent, return whether it was written.
+        """
+        registry = get_backend_registry()
+        r2_spool = get_r2_spool()
+        elastic_shipper = get_elastic_shipper()
+        with self.__status_lock:
+            worker_status = {
+                "status": self.__status,
+                "version": Settings.WORKER_VERSION,
+                "queue_list": self.__queue_key_list,
+                "checkpoints": registry.checkpoints,
+                "checkpoint_swaps": registry.checkpoint_swaps,
+                "failures": self.__failures,
+                "restarts": self.__restarts,
+                "options": {
+                    name: registry.get_api(name).options_stats
+                    for name in registry.names
+                },
+                "spool": r2_spool.stats if r2_spool is not None else None,
+                "elastic": (
+                    elastic_shipper.stats
+                    if elastic_shipper is not None
+                    else None
+                ),
+                **{
+                    name: source()
+                    for name, source in self.__status_sources.items()
+                },
+            }
+
+            # Counters below change on every write, they don't count
+            content = json.dumps(worker_status)
+            if (
+                content == self.__status_written
+                and monotonic() - self.__status_written_at
+                < self.WORKER_TIMEOUT / 2
+            ):
+                self.__redis_stats["status_skips"] += 1
+                return False
+
+            self.__redis_stats["status_writes"] += 1
+            self.__status_written = content
+            self.__status_written_at = monotonic()
+            client.setex(
+                self.__worker_key,
+                self.WORKER_TIMEOUT,
+                json.dumps({**worker_status, "redis": self.__redis_stats}),
+            )
+            return True
+
+    def add_status_source(self, name: str, source: Callable[[], dict]):
+        self.__status_sources[name] = source
+
+    def is_worker_queue_empty(self) -> bool:
+        self.__count_round_trip()
+        return self.__db.llen(self.__queue_worker_key) == 0
+
+    def record_restart(self, cause: RestartCause):
+        with self.__status_lock:
+            self.__restarts["count"] += 1
+            self.__restarts["causes"][cause] = (
+                self.__restarts["causes"].get(cause, 0) + 1
+            )
+            self.__restarts["last_cause"] = cause
+            self.__restarts["last_at"] = datetime.now(timezone.utc).isoformat()
+
+    def __record_failure(self, failure_type: str):
+        with self.__status_lock:
+            self.__failures[failure_type] = (
+                self.__failures.get(failure_type, 0) + 1
+            )
 
-    def wait_signal(self) -> tuple[SignalType, str | CommandType, str] | None:
+    def wait_signal(
+        self,
+        with_queue: bool = True,
+        timeout: int = 5,
+        accept: Callable[[dict], bool] | None = None,
+    ) -> tuple[SignalType, CommandType | Job | None, str] | None:
         """
-        Wait for a signal from redis and return the payload.
+        Wait for a signal from redis and return the payload, jobs are
+        claimed on the way.
 
         - Watch command first, then queue.
         - Worker key first, then global key.
+        - Only watch command if `with_queue` is False.
+        - Prefer queued jobs matching loaded checkpoints, see `__pick_job`.
+        - Job payload is None if it could not be claimed or created.
+        - Only jobs whose requirements pass `accept` are claimed if given,
+          queues are then polled instead of blocked on.
         """
-        self.update_worker_status("STANDBY")
+        if with_queue:
+            if Settings.AFFINITY_WINDOW > 1 or accept is not None:
+                pick_result = self.__pick_job(accept)
+            else:
+                pick_result = self.__claim_next_script(
+                    keys=[self.__command_key, *self.__queue_key_list],
+                    args=[Settings.WORKER_INFO],
+                )
+                self.__count_round_trip()
+
+            if pick_result:
+                if pick_result[0] == "COMMAND":
+                    return "COMMAND", pick_result[2], pick_result[1]
+                _, key, job_id, job_fields = pick_result
+                return "JOB", self.__create_job(job_id, key, job_fields), key
+
+        # A blocking pop can't choose, only wait for commands then
+        if accept is not None:
+            with_queue = False
+
         blopo_result = self.__db.blpop(
             [
                 self.__command_key,
-                *self.__queue_key_list,
+                *(self.__queue_key_list if with_queue else []),
             ],
-            timeout=5,
+            timeout=timeout,
         )
+        self.__count_round_trip()
         if blopo_result is None:
             return None
 
@@ -118,52 +344,142 @@ class RedisDatabase(object):
             return "COMMAND", payload, key
 
         if key == "queue" or key.startswith("queue_"):
-            return "JOB", payload, key
+            job_fields = self.__claim_script(
+                keys=[payload], args=[Settings.WORKER_INFO]
+            )
+            self.__count_round_trip()
+            return "JOB", self.__create_job(payload, key, job_fields), key
 
         raise Exception(f"Unknown signal: {key} {payload}")
 
-    def get_job(self, job_id: str, queue_key: str) -> Job | None:
-        job_dict = self.__db.hgetall(job_id)
-        if not job_dict:
-            logger.error(f"Job not found: {job_id}")
-            return None
-
-        self.__db.hset(
-            job_id,
-            mapping={
-                "status": "PROCESSING",
-                "worker": Settings.WORKER_INFO,
-            },
-        )
-
-        # Convert postprocess from dict
-        if job_dict.get("postprocess"):
-            job_dict["postprocess"] = [
-                PostProcess(**process)
-                for process in json.loads(job_dict["postprocess"])
-            ]
-
-        # Convert payload from dict
-        job_dict["payload"] = json.loads(job_dict["payload"])
+    def __pick_job(
+        self, accept: Callable[[dict], bool] | None = None
+    ) -> list | None:
+        """
+        Peek the head of the first non-empty queue and claim the first job
+        whose checkpoint is already loaded, or the head job otherwise.
+
+        - Pending commands are taken before any job.
+        - Jobs without checkpoint never need a swap, they always match.
+        - Queue priority is kept, jobs are only reordered inside a queue.
+        - Head job older than `AFFINITY_MAX_WAIT` is taken to avoid starving.
+        - With `accept`, jobs it refuses are skipped, a queue with
+          none to take in `LANE_WINDOW` jobs is passed over.
+        - Result is shaped like `CLAIM_NEXT_SCRIPT`'s.
+        """
+        window = Settings.AFFINITY_WINDOW
+        if accept is not None:
+            window = max(window, Settings.LANE_WINDOW)
+
+        pipeline = self.__db.pipeline(transaction=False)
+        pipeline.lpop(self.__command_key)
+        for queue_key in self.__queue_key_list:
+            pipeline.lrange(queue_key, 0, window - 1)
+        command, *windows = pipeline.execute()
+        self.__count_round_trip()
+
+        if command is not None:
+            return ["COMMAND", self.__command_key, command]
+
+        loaded_checkpoints = set(get_backend_registry().checkpoints.values())
+        for queue_key, job_ids in zip(self.__queue_key_list, windows):
+            if not job_ids:
+                continue
+
+            pick_id = job_ids[0]
+            is_affine = (
+                Settings.AFFINITY_WINDOW > 1
+                and len(job_ids) > 1
+                and len(loaded_checkpoints) > 0
+            )
+            if is_affine or accept is not None:
+                pipeline = self.__db.pipeline(transaction=False)
+                for job_id in job_ids:
+                    pipeline.hmget(job_id, "payload", "created_at", "metadata")
+                job_fields = pipeline.execute()
+                self.__count_round_trip()
+
+                candidates = []
+                for job_id, (payload, created_at, metadata) in zip(
+                    job_ids, job_fields
+                ):
+                    checkpoint, requirements = get_queued_requirements(
+                        payload, metadata
+                    )
+                    if accept is not None and not accept(requirements):
+                        continue
+                    candidates.append((job_id, checkpoint, created_at))
+                if len(candidates) == 0:
+                    continue
+                pick_id = candidates[0][0]
+
+                head_wait_time = get_wait_time(candidates[0][2])
+
+                if is_affine and head_wait_time < Settings.AFFINITY_MAX_WAIT:
+                    for job_id, checkpoint, _ in candidates:
+                        if (
+                            checkpoint is None
+                            or checkpoint in loaded_checkpoints
+                        ):
+                            pick_id = job_id
+                            break
+
+            # Claim, unless taken by another worker in the meantime
+            job_fields = self.__claim_script(
+                keys=[pick_id, queue_key], args=[Settings.WORKER_INFO]
+            )
+            self.__count_round_trip()
+            if job_fields is None:
+                return None
 
-        # Convert webhook from dict
-        if job_dict.get("webhook"):
-            job_dict["webhook"] = Webhook(**json.loads(job_dict["webhook"]))
+            if pick_id != job_ids[0]:
+                logger.debug(f"Picked job out of order: {pick_id}")
+            return ["JOB", queue_key, pick_id, job_fields]
 
-        # Convert metadata from dict
-        if job_dict.get("metadata"):
-            job_dict["metadata"] = json.loads(job_dict["metadata"])
+        return None
 
-        # Convert created_at from timestamp
-        if job_dict.get("created_at"):
-            job_dict["created_at"] = datetime.fromisoformat(
-                job_dict["created_at"]
-            )
-        else:
-            job_dict["created_at"] = datetime.now(timezone.utc)
+    def __create_job(
+        self, job_id: str, queue_key: str, job_fields: list[str]
+    ) -> Job | None:
+        """
+        Create a claimed job from its flattened hash fields.
+        """
+        job_dict = dict(zip(job_fields[0::2], job_fields[1::2]))
+        if not job_dict:
+            logger.error(f"Job not found: {job_id}")
+            return None
+        self.__redis_stats["claimed"] += 1
 
-        # Create job
+        # Create job, failing it if any field won't parse
         try:
+            # Convert postprocess from dict
+            if job_dict.get("postprocess"):
+                job_dict["postprocess"] = [
+                    PostProcess(**process)
+                    for process in json.loads(job_dict["postprocess"])
+                ]
+
+            # Convert payload from dict
+            job_dict["payload"] = json.loads(job_dict["payload"])
+
+            # Convert webhook from dict
+            if job_dict.get("webhook"):
+                job_dict["webhook"] = Webhook(
+                    **json.loads(job_dict["webhook"])
+                )
+
+            # Convert metadata from dict
+            if job_dict.get("metadata"):
+                job_dict["metadata"] = json.loads(job_dict["metadata"])
+
+            # Convert created_at from timestamp
+            if job_dict.get("created_at"):
+                job_dict["created_at"] = datetime.fromisoformat(
+                    job_dict["created_at"]
+                )
+            else:
+                job_dict["created_at"] = datetime.now(timezone.utc)
+
             job = Job(
                 on_close=self.end_job,
                 _id=job_id,
@@ -185,14 +501,32 @@ class RedisDatabase(object):
         except Exception as e:
             logger.error(f"Failed to create job: {job_id}")
             logger.error(traceback.format_exc())
+            failure_type = classify_failure(e)
+            self.__record_failure(failure_type)
             self.__db.hset(
                 job_id,
                 "status",
                 "FAILED",
-                mapping={"result": json.dumps({"error": str(e)})},
+                mapping={
+                    "result": json.dumps(
+                        {"error": str(e), "error_type": failure_type}
+                    )
+                },
             )
+            self.__count_round_trip()
             return None
 
+    def requeue_job(self, job: Job):
+        """
+        Hand a claimed but unprocessed job back to the front of its queue.
+        """
+        pipeline = self.__db.pipeline()
+        pipeline.hset(job.id, "status", "PENDING")
+        pipeline.hdel(job.id, "worker")
+        pipeline.lpush(job.queue_key, job.id)
+        pipeline.execute()
+        self.__count_round_trip()
+
     def end_job(self, job: Job):
         try:
             result = json.dumps(job.result)
@@ -203,8 +537,9 @@ class RedisDatabase(object):
 
         now = datetime.now(timezone.utc)
 
-        # Update job
-        self.__db.hset(
+        # Update job, with the worker status in the same transaction
+        pipeline = self.__db.pipeline()
+        pipeline.hset(
             job.id,
             "status",
             job.status,
@@ -213,6 +548,16 @@ class RedisDatabase(object):
                 "result": result,
             },
         )
+        self.__redis_stats["completed"] += 1
+        if job.failure_type is not None:
+            self.__record_failure(job.failure_type)
+        self.__write_worker_status(pipeline)
+        try:
+            pipeline.execute()
+        except:
+            self.__forget_worker_status()
+            raise
+        self.__count_round_trip()
 
         # Log to elastic
         self.log_job(job, now)
@@ -238,12 +583,16 @@ class RedisDatabase(object):
             # remove infotexts
             this_result["info"].pop("infotexts", None)
 
+        elastic_shipper = get_elastic_shipper()
+        if elastic_shipper is None:
+            return
+
         try:
-            elastic_client.index(
-                id=job.id,
-                index=f"{'dev_' if Settings.DEV else ''}"
+            elastic_shipper.ship(
+                f"{'dev_' if Settings.DEV else ''}"
                 + f"worker_{timestamp.strftime('%Y%m%d')}",
-                document={
+                job.id,
+                {
                     "@timestamp": timestamp,
                     "worker": Settings.WORKER_NAME,
                     "status": job.status,
@@ -264,9 +613,10 @@ class RedisDatabase(object):
 
     def flush_queue(self):
         self.__db.delete(self.__queue_worker_key)
+        self.__count_round_trip()
 
     def close(self):
-        self.__db.delete(self.__worker_key)
-        self.__db.delete(self.__command_key)
-        self.flush_queue()
+        self.__db.delete(
+            self.__worker_key, self.__command_key, self.__queue_worker_key
+        )
         self.__db.close()
@@ -25,6 +25,8 @@ JobType = Literal[
     "PROMPTGEN",
 ]
 JobStatus = Literal["PENDING", "PROCESSING", "FAILED", "DONE"]
+FailureType = Literal["CLIENT", "TRANSIENT", "BACKEND", "OOM"]
+RestartCause = Literal["COMMAND", "BACKEND", "OOM", "MEMORY"]
 ImageFormat = Literal["JPEG", "PNG", "WEBP", "WEBP_LOSSLESS", "GIF", "MP4"]
 
 
@@ -56,16 +58,82 @@ class Settings:
     A1111_PORT = os.environ.get("A1111_PORT", 7860)
     FORGE_HOST = os.environ.get("FORGE_HOST", "localhost")
     FORGE_PORT = os.environ.get("FORGE_PORT", None)
+    WEBUI_BACKENDS = os.environ.get(
+        "WEBUI_BACKENDS", f"a1111={A1111_HOST}:{A1111_PORT}"
+    )
+    WEBUI_FLUX_BACKENDS = os.environ.get(
+        "WEBUI_FLUX_BACKENDS",
+        f"forge={FORGE_HOST}:{FORGE_PORT}" if FORGE_PORT is not None else "",
+    )
+    WEBUI_DECODE_MODE = os.environ.get("WEBUI_DECODE_MODE", "lazy")
+    WEBUI_OPTIONS_TTL = int(os.environ.get("WEBUI_OPTIONS_TTL", 300))
+    WEBUI_RESTART_GRACE = int(os.environ.get("WEBUI_RESTART_GRACE", 3))
+    WEBUI_FAILURE_STREAK = int(os.environ.get("WEBUI_FAILURE_STREAK", 3))
+    HEALTH_INTERVAL = int(os.environ.get("HEALTH_INTERVAL", 5))
+    HEALTH_TIMEOUT = int(os.environ.get("HEALTH_TIMEOUT", 5))
+    HEALTH_MIN_BACKOFF_MS = int(os.environ.get("HEALTH_MIN_BACKOFF_MS", 500))
+    HEALTH_MAX_BACKOFF = int(os.environ.get("HEALTH_MAX_BACKOFF", 5))
+    MEMORY_INTERVAL = int(os.environ.get("MEMORY_INTERVAL", 30))
+    MEMORY_WINDOW = int(os.environ.get("MEMORY_WINDOW", 20))
+    MEMORY_RAM_LIMIT = int(os.environ.get("MEMORY_RAM_LIMIT", 90))
+    MEMORY_VRAM_LIMIT = int(os.environ.get("MEMORY_VRAM_LIMIT", 95))
+    MEMORY_FRAGMENTATION = int(os.environ.get("MEMORY_FRAGMENTATION", 50))
+    MEMORY_HORIZON = int(os.environ.get("MEMORY_HORIZON", 3600))
     ELASTIC_HOST = os.environ.get("ELASTIC_HOST", None)
     ELASTIC_AUTH_HEADER = os.environ.get("ELASTIC_AUTH_HEADER", None)
     ELASTIC_CLOUD_ID = os.environ.get("ELASTIC_CLOUD_ID", None)
     ELASTIC_API_KEY = os.environ.get("ELASTIC_API_KEY", None)
+    ELASTIC_BULK_SIZE = int(os.environ.get("ELASTIC_BULK_SIZE", 100))
+    ELASTIC_FLUSH_INTERVAL = int(os.environ.get("ELASTIC_FLUSH_INTERVAL", 5))
+    ELASTIC_RETRY_INTERVAL = int(os.environ.get("ELASTIC_RETRY_INTERVAL", 30))
+    ELASTIC_JOURNAL_PATH = os.environ.get(
+        "ELASTIC_JOURNAL_PATH", "cache/elastic_journal.ndjson"
+    )
+    ELASTIC_JOURNAL_SIZE = (
+        int(os.environ.get("ELASTIC_JOURNAL_SIZE_MB", 256)) * 1024 * 1024
+    )
     R2_ENDPOINT_URL = os.environ["R2_ENDPOINT_URL"]
     R2_BUCKET_NAME = os.environ["R2_BUCKET_NAME"]
     R2_PUBLIC_URL = os.environ["R2_PUBLIC_URL"]
     AWS_ACCESS_KEY_ID = os.environ["AWS_ACCESS_KEY_ID"]
     AWS_SECRET_ACCESS_KEY = os.environ["AWS_SECRET_ACCESS_KEY"]
+    R2_PART_SIZE = int(os.environ.get("R2_PART_SIZE_MB", 8)) * 1024 * 1024
+    R2_MAX_CONCURRENCY = int(os.environ.get("R2_MAX_CONCURRENCY", 4))
+    R2_MAX_POOL_CONNECTIONS = int(
+        os.environ.get("R2_MAX_POOL_CONNECTIONS", 16)
+    )
+    MP4_CRF = int(os.environ.get("MP4_CRF", 23))
+    MP4_PRESET = os.environ.get("MP4_PRESET", "medium")
+    MP4_FRAGMENTED = (
+        os.environ.get("MP4_FRAGMENTED", "false").lower() == "true"
+    )
+    R2_SPOOL_DIR = os.environ.get("R2_SPOOL_DIR", "")
+    R2_SPOOL_SIZE = int(os.environ.get("R2_SPOOL_SIZE_MB", 4096)) * 1024 * 1024
+    R2_SPOOL_WORKERS = int(os.environ.get("R2_SPOOL_WORKERS", 2))
+    R2_SPOOL_MAX_BACKOFF = int(os.environ.get("R2_SPOOL_MAX_BACKOFF", 300))
+    IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "cache/images")
+    IMAGE_CACHE_SIZE = (
+        int(os.environ.get("IMAGE_CACHE_SIZE_MB", 2048)) * 1024 * 1024
+    )
+    IMAGE_CACHE_MAX_AGE = int(os.environ.get("IMAGE_CACHE_MAX_AGE", 3600))
+    IMAGE_FETCH_CONCURRENCY = int(os.environ.get("IMAGE_FETCH_CONCURRENCY", 8))
+    IMAGE_FETCH_DEADLINE = int(os.environ.get("IMAGE_FETCH_DEADLINE", 120))
     DEV = os.environ.get("DEV", "false").lower() == "true"
+    WARM_UP = os.environ.get("WARM_UP", "true").lower() == "true"
+    STARTUP_BUDGET = int(os.environ.get("STARTUP_BUDGET", 10))
+    PREFETCH_JOBS = int(os.environ.get("PREFETCH_JOBS", 1))
+    AFFINITY_WINDOW = int(os.environ.get("AFFINITY_WINDOW", 8))
+    AFFINITY_MAX_WAIT = int(os.environ.get("AFFINITY_MAX_WAIT", 60))
+    POSTPROCESS_DEPTH = int(os.environ.get("POSTPROCESS_DEPTH", 2))
+    CONCURRENT_LANES = (
+        os.environ.get("CONCURRENT_LANES", "false").lower() == "true"
+    )
+    LANE_WINDOW = max(1, int(os.environ.get("LANE_WINDOW", 8)))
+    COALESCE_MAX_BATCH = int(os.environ.get("COALESCE_MAX_BATCH", 1))
+    COALESCE_WINDOW_MS = int(os.environ.get("COALESCE_WINDOW_MS", 500))
+    NSFW_BATCH_SIZE = int(os.environ.get("NSFW_BATCH_SIZE", 32))
+    NSFW_ANIMATION_SAMPLES = int(os.environ.get("NSFW_ANIMATION_SAMPLES", 1))
+    NSFW_TIMEOUT = int(os.environ.get("NSFW_TIMEOUT", 300))
 
 
 @dataclass
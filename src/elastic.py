@@ -1,25 +1,278 @@
-from elasticsearch import Elasticsearch, JsonSerializer
 from defines import Settings
+from functools import cache
 from typing import Any
 from PIL.Image import Image
 from webuiapi import ControlNetUnit
+from loguru import logger
+from pathlib import Path
+from time import monotonic, perf_counter
+import json
+import threading
+import traceback
+from job import classify_failure
 
+elastic_client_lock = threading.Lock()
 
-class JsonPILSerializer(JsonSerializer):
-    def default(self, data: Any) -> Any:
-        if isinstance(data, Image):
-            return f"PIL.Image ({data.width}x{data.height} / {data.format})"
-        if isinstance(data, ControlNetUnit):
-            return f"ControlNetUnit ({data.control_mode})"
-        return super().default(data)
-
-
-elastic_client = Elasticsearch(
-    hosts=Settings.ELASTIC_HOST,
-    cloud_id=Settings.ELASTIC_CLOUD_ID,
-    api_key=Settings.ELASTIC_API_KEY,
-    headers={"Authorization": Settings.ELASTIC_AUTH_HEADER}
-    if Settings.ELASTIC_AUTH_HEADER is not None
-    else None,
-    serializers={"application/json": JsonPILSerializer()},
-)
+
+@cache
+def get_elastic_serializer():
+    from elasticsearch import JsonSerializer
+
+    class JsonPILSerializer(JsonSerializer):
+        def default(self, data: Any) -> Any:
+            if isinstance(data, Image):
+                return (
+                    f"PIL.Image ({data.width}x{data.height} / {data.format})"
+                )
+            if isinstance(data, ControlNetUnit):
+                return f"ControlNetUnit ({data.control_mode})"
+            return super().default(data)
+
+    return JsonPILSerializer()
+
+
+def get_elastic_client():
+    """
+    Create the client on first use, importing elasticsearch is slow.
+
+    - Created under a lock, warm-up may race the first log.
+    """
+    with elastic_client_lock:
+        return create_elastic_client()
+
+
+@cache
+def create_elastic_client():
+    from elasticsearch import Elasticsearch
+
+    return Elasticsearch(
+        hosts=Settings.ELASTIC_HOST,
+        cloud_id=Settings.ELASTIC_CLOUD_ID,
+        api_key=Settings.ELASTIC_API_KEY,
+        headers={"Authorization": Settings.ELASTIC_AUTH_HEADER}
+        if Settings.ELASTIC_AUTH_HEADER is not None
+        else None,
+        serializers={"application/json": get_elastic_serializer()},
+    )
+
+
+class ElasticShipper:
+    """
+    Index documents with the bulk API from a background thread.
+
+    - A batch is sent once `max_batch` documents are queued or the oldest
+      one waited `flush_interval` seconds.
+    - Batches that can't be sent are appended to a bulk-format journal and
+      replayed every `retry_interval` seconds until Elasticsearch is back.
+    - `ship` only queues the document, it never blocks on the network.
+    """
+
+    # Bulk item statuses worth sending again
+    RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+    def __init__(
+        self,
+        journal_path: str,
+        max_batch: int = 100,
+        flush_interval: float = 5,
+        retry_interval: float = 30,
+        max_journal_size: int = 256 * 1024 * 1024,
+    ):
+        self.__journal = Path(journal_path)
+        self.__journal.parent.mkdir(parents=True, exist_ok=True)
+        self.__replaying = self.__journal.with_name(
+            self.__journal.name + ".replay"
+        )
+        self.__max_batch = max_batch
+        self.__flush_interval = flush_interval
+        self.__retry_interval = retry_interval
+        self.__max_journal_size = max_journal_size
+
+        self.__condition = threading.Condition()
+        self.__queue: list[tuple[float, str, str, dict]] = []
+        self.__is_closed = False
+        self.__retry_at = 0.0
+        self.__shipped = 0
+        self.__dropped = 0
+        self.__flush_time = 0.0
+
+        self.__thread = threading.Thread(
+            target=self.__run, name="elastic_shipper", daemon=True
+        )
+        self.__thread.start()
+
+    @property
+    def stats(self) -> dict:
+        with self.__condition:
+            queued = len(self.__queue)
+        return {
+            "queued": queued,
+            "journal_bytes": self.__journal_size(),
+            "shipped": self.__shipped,
+            "dropped": self.__dropped,
+            "flush_time": round(self.__flush_time, 3),
+        }
+
+    def ship(self, index: str, _id: str, document: dict):
+        with self.__condition:
+            if self.__is_closed:
+                raise Exception("Elastic shipper is closed")
+            self.__queue.append((monotonic(), index, _id, document))
+            if len(self.__queue) >= self.__max_batch:
+                self.__condition.notify()
+
+    def close(self):
+        """
+        Send what is still queued, or journal it if Elasticsearch is down.
+        """
+        with self.__condition:
+            self.__is_closed = True
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __journal_size(self) -> int:
+        return sum(
+            path.stat().st_size
+            for path in [self.__journal, self.__replaying]
+            if path.exists()
+        )
+
+    def __take(self) -> list[tuple[float, str, str, dict]] | None:
+        with self.__condition:
+            while not self.__is_closed:
+                now = monotonic()
+                if len(self.__queue) >= self.__max_batch or (
+                    len(self.__queue) > 0
+                    and now - self.__queue[0][0] >= self.__flush_interval
+                ):
+                    break
+
+                timeout = (
+                    self.__queue[0][0] + self.__flush_interval - now
+                    if len(self.__queue) > 0
+                    else self.__flush_interval
+                )
+                if self.__journal.exists() or self.__replaying.exists():
+                    # Come back in time for the next replay
+                    timeout = min(timeout, max(0, self.__retry_at - now))
+                    if timeout == 0:
+                        return []
+                self.__condition.wait(timeout)
+
+            if self.__is_closed and len(self.__queue) == 0:
+                return None
+            batch = self.__queue[: self.__max_batch]
+            del self.__queue[: self.__max_batch]
+            return batch
+
+    def __run(self):
+        while (batch := self.__take()) is not None:
+            if len(batch) > 0:
+                self.__flush(self.__serialize(batch))
+            self.__replay()
+
+    def __serialize(self, batch: list[tuple[float, str, str, dict]]):
+        lines = []
+        for _, index, _id, document in batch:
+            try:
+                source = get_elastic_serializer().dumps(document).decode()
+            except Exception as e:
+                logger.error(f"Failed to serialize elastic document: {_id}")
+                logger.error(traceback.format_exc())
+                self.__dropped += 1
+                continue
+            lines.append(
+                (json.dumps({"index": {"_index": index, "_id": _id}}), source)
+            )
+        return lines
+
+    def __flush(self, lines: list[tuple[str, str]]) -> bool:
+        """
+        Send lines in bulk, journal whatever should be sent again.
+        """
+        if len(lines) == 0:
+            return True
+        if monotonic() < self.__retry_at:
+            self.__write_journal(lines)
+            return False
+
+        time_start = perf_counter()
+        try:
+            response = get_elastic_client().bulk(
+                operations=[line for pair in lines for line in pair]
+            )
+        except Exception as e:
+            logger.warning(
+                f"Failed to ship {len(lines)} logs to elastic "
+                + f"[{classify_failure(e)}]: {e}"
+            )
+            self.__retry_at = monotonic() + self.__retry_interval
+            self.__write_journal(lines)
+            return False
+        self.__flush_time = perf_counter() - time_start
+
+        retry_lines = []
+        for pair, item in zip(lines, response["items"]):
+            result = item["index"]
+            if "error" not in result:
+                self.__shipped += 1
+            elif result["status"] in self.RETRY_STATUSES:
+                retry_lines.append(pair)
+            else:
+                logger.error(
+                    f"Elastic rejected log {result['_id']}: {result['error']}"
+                )
+                self.__dropped += 1
+
+        if len(retry_lines) > 0:
+            self.__retry_at = monotonic() + self.__retry_interval
+            self.__write_journal(retry_lines)
+            return False
+        return True
+
+    def __write_journal(self, lines: list[tuple[str, str]]):
+        if self.__journal_size() >= self.__max_journal_size:
+            logger.error(f"Elastic journal full, dropping {len(lines)} logs")
+            self.__dropped += len(lines)
+            return
+        with open(self.__journal, "a") as f:
+            f.write(
+                "".join(f"{action}\n{source}\n" for action, source in lines)
+            )
+
+    def __replay(self):
+        """
+        Send journaled lines again, batch by batch.
+        """
+        if monotonic() < self.__retry_at:
+            return
+        if not self.__replaying.exists():
+            if not self.__journal.exists():
+                return
+            self.__journal.replace(self.__replaying)
+
+        with open(self.__replaying, "r") as f:
+            raw_lines = f.read().splitlines()
+        logger.info(f"Replaying {len(raw_lines) // 2} journaled elastic logs")
+
+        # A torn write leaves an unpaired action line at the end
+        lines = list(zip(raw_lines[0::2], raw_lines[1::2]))
+        for i in range(0, len(lines), self.__max_batch):
+            self.__flush(lines[i : i + self.__max_batch])
+        self.__replaying.unlink()
+
+
+@cache
+def get_elastic_shipper() -> ElasticShipper | None:
+    """
+    Log shipper, if Elasticsearch is configured.
+    """
+    if Settings.ELASTIC_HOST is None and Settings.ELASTIC_CLOUD_ID is None:
+        return None
+    return ElasticShipper(
+        Settings.ELASTIC_JOURNAL_PATH,
+        max_batch=Settings.ELASTIC_BULK_SIZE,
+        flush_interval=Settings.ELASTIC_FLUSH_INTERVAL,
+        retry_interval=Settings.ELASTIC_RETRY_INTERVAL,
+        max_journal_size=Settings.ELASTIC_JOURNAL_SIZE,
+    )
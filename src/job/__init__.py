@@ -1 +1,3 @@
-from .job import Job, api, forge_api
+from .job import Job, get_requirements
+from .failure import classify_failure
+from .registry import BackendRegistry, get_backend_registry
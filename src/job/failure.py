@@ -0,0 +1,49 @@
+import re
+import requests
+from defines import FailureType
+
+OOM_PATTERN = re.compile(r"out of memory|OutOfMemoryError", re.IGNORECASE)
+
+# Errors from talking to another service, whatever the client library
+NETWORK_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    requests.ConnectionError,
+    requests.Timeout,
+)
+NETWORK_MODULES = ["aiohttp", "urllib3", "botocore", "elastic_transport"]
+
+
+def classify_failure(
+    error: BaseException, is_backend: bool = False
+) -> FailureType:
+    """
+    Tell what a job failure says about the worker.
+
+    - OOM: the backend ran out of memory while `is_backend`, elsewhere
+      restarting the WebUI wouldn't help.
+    - BACKEND: the WebUI failed on its side or could not be reached while
+      `is_backend`, it may need a restart.
+    - TRANSIENT: another service could not be reached, worth a retry.
+    - CLIENT: anything else, the job itself is at fault.
+    """
+    if is_backend and (
+        isinstance(error, MemoryError) or OOM_PATTERN.search(str(error))
+    ):
+        return "OOM"
+
+    # WebUI responses other than 200, see `WebUIApi`
+    if (
+        isinstance(error, RuntimeError)
+        and len(error.args) == 2
+        and isinstance(error.args[0], int)
+    ):
+        return "BACKEND" if error.args[0] >= 500 else "CLIENT"
+
+    if (
+        isinstance(error, NETWORK_ERRORS)
+        or type(error).__module__.split(".")[0] in NETWORK_MODULES
+    ):
+        return "BACKEND" if is_backend else "TRANSIENT"
+
+    return "CLIENT"
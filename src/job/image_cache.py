@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from time import time
+from typing import Callable
+import requests
+from loguru import logger
+
+
+def new_cache_stats() -> dict:
+    return {
+        "hits": 0,
+        "revalidated": 0,
+        "misses": 0,
+        "cached_bytes": 0,
+        "downloaded_bytes": 0,
+    }
+
+
+class ImageCache:
+    """
+    Size-bounded on-disk LRU cache of downloaded input images, keyed by URL.
+
+    - Entries younger than `max_age` are served without any request.
+    - Older entries are revalidated with ETag / Last-Modified.
+    - Least recently used entries are evicted above `max_size`.
+    """
+
+    def __init__(self, directory: str, max_size: int, max_age: float):
+        self.__directory = Path(directory)
+        self.__directory.mkdir(parents=True, exist_ok=True)
+        self.__max_size = max_size
+        self.__max_age = max_age
+
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[str, int] = OrderedDict()
+        self.__size = 0
+
+        # Restore entries from previous runs, oldest access first
+        data_files = sorted(
+            self.__directory.glob("*.bin"), key=lambda f: f.stat().st_mtime
+        )
+        for data_file in data_files:
+            size = data_file.stat().st_size
+            self.__entries[data_file.stem] = size
+            self.__size += size
+        logger.debug(
+            f"Image cache: {len(self.__entries)} entries "
+            + f"({self.__size / 1024 / 1024:.2f}MB)"
+        )
+
+    def fetch(
+        self,
+        url: str,
+        download: Callable[[dict], requests.Response],
+        stats: dict,
+    ) -> bytes:
+        """
+        Get the raw bytes of `url`, `download` is called with extra headers
+        only when the cache cannot answer by itself.
+        """
+        key = hashlib.sha256(url.encode()).hexdigest()
+        meta = self.__read(key)
+
+        # Fresh hit
+        if meta is not None and time() - meta["fetched_at"] < self.__max_age:
+            data = self.__touch(key)
+            if data is not None:
+                stats["hits"] += 1
+                stats["cached_bytes"] += len(data)
+                return data
+
+        # Revalidate stale entry
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = download(headers)
+        if response.status_code == 304 and meta is not None:
+            data = self.__touch(key)
+            if data is not None:
+                meta["fetched_at"] = time()
+                self.__write_meta(key, meta)
+                stats["revalidated"] += 1
+                stats["cached_bytes"] += len(data)
+                return data
+
+            # Entry evicted in the meantime
+            response = download({})
+
+        if response.status_code != 200:
+            logger.error(f"Failed to download image: {response.status_code}")
+            raise Exception(f"Invalid image requested: {url[:100]}")
+
+        data = response.content
+        stats["misses"] += 1
+        stats["downloaded_bytes"] += len(data)
+        self.__store(
+            key,
+            data,
+            {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fetched_at": time(),
+            },
+        )
+        return data
+
+    def __read(self, key: str) -> dict | None:
+        try:
+            with open(self.__directory / f"{key}.json", "r") as f:
+                return json.load(f)
+        except:
+            return None
+
+    def __write_meta(self, key: str, meta: dict):
+        temp_file = self.__directory / f"{key}.json.{threading.get_ident()}"
+        with open(temp_file, "w") as f:
+            json.dump(meta, f)
+        os.replace(temp_file, self.__directory / f"{key}.json")
+
+    def __touch(self, key: str) -> bytes | None:
+        data_file = self.__directory / f"{key}.bin"
+        try:
+            data = data_file.read_bytes()
+            os.utime(data_file)
+        except FileNotFoundError:
+            return None
+
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+        return data
+
+    def __store(self, key: str, data: bytes, meta: dict):
+        if len(data) > self.__max_size:
+            return
+
+        temp_file = self.__directory / f"{key}.bin.{threading.get_ident()}"
+        temp_file.write_bytes(data)
+        os.replace(temp_file, self.__directory / f"{key}.bin")
+        self.__write_meta(key, meta)
+
+        with self.__lock:
+            self.__size += len(data) - self.__entries.pop(key, 0)
+            self.__entries[key] = len(data)
+
+            # Evict least recently used
+            while self.__size > self.__max_size and self.__entries:
+                evict_key, evict_size = self.__entries.popitem(last=False)
+                self.__size -= evict_size
+                for suffix in ["bin", "json"]:
+                    (self.__directory / f"{evict_key}.{suffix}").unlink(
+                        missing_ok=True
+                    )
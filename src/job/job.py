@@ -2,27 +2,52 @@ from defines import (
     JobType,
     PostProcess,
     JobStatus,
+    FailureType,
     ImageFormat,
     Settings,
     Webhook,
 )
 import webuiapi
 from .payload import normalize_payload
+from .failure import classify_failure
+from .registry import get_backend_registry
+import re
 from loguru import logger
 from typing import List, Callable
 import traceback
 from postprocess import postprocess
+from postprocess.nsfw import nsfw_check_batch
 import requests
 from time import perf_counter
 from datetime import datetime, timezone
+import json
 
+LORA_PATTERN = re.compile(r"<lora:([^:>]+)")
 
-api = webuiapi.WebUIApi(host=Settings.A1111_HOST, port=Settings.A1111_PORT)
-forge_api = (
-    webuiapi.WebUIApi(host=Settings.FORGE_HOST, port=Settings.FORGE_PORT)
-    if Settings.FORGE_PORT is not None
-    else None
-)
+
+def is_checkpoint_flux(sd_model: str | None, metadata: dict | None) -> bool:
+    try:
+        if sd_model is None:
+            return False
+
+        # Check metadata first
+        if metadata is not None and "flux" in metadata:
+            return metadata["flux"]
+        # Check sd_model
+        return sd_model.lower().startswith("flux")
+    except:
+        return False
+
+
+def get_requirements(sd_model: str | None, metadata: dict | None) -> dict:
+    """
+    What a backend needs to serve a checkpoint, before the job is even
+    claimed, see `BackendRegistry`.
+    """
+    return {
+        "flux": is_checkpoint_flux(sd_model, metadata),
+        "checkpoints": {sd_model} if sd_model is not None else set(),
+    }
 
 
 class Job:
@@ -51,10 +76,13 @@ class Job:
         self.status = status
         self.webhook = webhook
         self.result = {}
+        self.failure_type: FailureType | None = None
+        self.backend_name: str | None = None
         self.metadata = metadata
         self.tag = tag
 
         self.__buffers = []
+        self.__requirements = None
 
         self.generate_images = []
 
@@ -73,7 +101,9 @@ class Job:
 
         # Normalize payload
         self.payload_raw = self.payload.copy()
-        normalize_payload(self.payload)
+        image_cache_stats = normalize_payload(self.payload)
+        self.dump_result("normalize_time", perf_counter() - self.start_time)
+        self.dump_result("image_cache", image_cache_stats)
 
         # Add default upload process
         upload_args = None
@@ -99,58 +129,12 @@ class Job:
     def generate(self):
         logger.info(f"Generating [{self.type}]: {self.id}")
 
+        # Job may have been prefetched, measure from here
+        self.start_time = perf_counter()
+
         api_result = None
         try:
-            sd_model = None
-
-            # If animate diff, set model first
-            if self.is_using_animate_diff():
-                try:
-                    sd_model = self.payload["override_settings"][
-                        "sd_model_checkpoint"
-                    ]
-                    logger.debug(
-                        f"Setting sd_model_checkpoint first ({sd_model})"
-                    )
-                    api.set_options({"sd_model_checkpoint": sd_model})
-                    logger.debug("Done")
-                except Exception as e:
-                    logger.warning(f"Failed to set sd_model first: {e}")
-                    pass
-
-            # Get checkpoint type
-            try:
-                is_checkpoint_flux = False
-
-                # Make sure sd_model is defined
-                if sd_model is None:
-                    sd_model = self.payload["override_settings"][
-                        "sd_model_checkpoint"
-                    ]
-
-                # Check metadata first
-                if self.metadata is not None and "flux" in self.metadata:
-                    is_checkpoint_flux = self.metadata["flux"]
-                # Check sd_model
-                else:
-                    is_checkpoint_flux = sd_model.lower().startswith("flux")
-            except:
-                is_checkpoint_flux = False
-
-            # Assign API client
-            if is_checkpoint_flux:
-                if forge_api is None:
-                    raise Exception("Forge API not available on this worker")
-                this_api = forge_api
-
-                # Change model first
-                try:
-                    this_api.set_options({"sd_model_checkpoint": sd_model})
-                except Exception as e:
-                    logger.warning(f"Failed to set sd_model first: {e}")
-                    pass
-            else:
-                this_api = api
+            this_api = self.prepare_api()
 
             if self.type == "TXT2IMG":
                 api_result = this_api.txt2img(
@@ -180,35 +164,141 @@ class Job:
             if api_result is None:
                 raise Exception("No result returned")
 
-            # If using AnimateDiff, put all images into one item
-            if self.is_using_animate_diff():
-                # extract controlnet images
-                controlnet_count = self.get_controlnet_count()
-                if controlnet_count > 0:
-                    # get controlnet images from images end
-                    controlnet_images = api_result.images[-controlnet_count:]
-                    animate_images = api_result.images[:-controlnet_count]
-                    self.generate_images = [
-                        animate_images,
-                        *controlnet_images,
-                    ]
-                else:
-                    self.generate_images = [api_result.images]
-            else:
-                self.generate_images = api_result.images
-
-            self.prune_info(api_result.info)
-            self.dump_result("info", api_result.info)
-            self.dump_result("generate_time", perf_counter() - self.start_time)
-
+            self.set_api_result(api_result)
             return True
 
         except Exception as e:
             logger.error(traceback.format_exc())
-            self.dump_result("error", str(e))
-            self.close(is_failed=True)
+            self.fail(e, is_backend=True)
             return False
 
+    def prepare_api(self) -> webuiapi.WebUIApi:
+        """
+        Get the backend this job was routed to, routing it now if it wasn't,
+        and load its checkpoint first if needed.
+        """
+        registry = get_backend_registry()
+        if self.backend_name is None:
+            self.backend_name = registry.route(self)
+        if self.backend_name is None:
+            raise Exception("No WebUI on this worker can serve this job")
+        this_api = registry.get_api(self.backend_name)
+
+        # Change model first for flux and animate diff
+        if self.is_checkpoint_flux() or self.is_using_animate_diff():
+            try:
+                sd_model = self.get_checkpoint()
+                logger.debug(f"Setting sd_model_checkpoint first ({sd_model})")
+                this_api.set_options({"sd_model_checkpoint": sd_model})
+                logger.debug("Done")
+            except Exception as e:
+                logger.warning(f"Failed to set sd_model first: {e}")
+                pass
+        return this_api
+
+    def set_api_result(self, api_result: webuiapi.WebUIApiResult):
+        # If using AnimateDiff, put all images into one item
+        if self.is_using_animate_diff():
+            # extract controlnet images
+            controlnet_count = self.get_controlnet_count()
+            if controlnet_count > 0:
+                # get controlnet images from images end
+                controlnet_images = api_result.images[-controlnet_count:]
+                animate_images = api_result.images[:-controlnet_count]
+                self.generate_images = [
+                    animate_images,
+                    *controlnet_images,
+                ]
+            else:
+                self.generate_images = [api_result.images]
+        else:
+            self.generate_images = api_result.images
+
+        self.prune_info(api_result.info)
+        self.dump_result("info", api_result.info)
+        self.dump_result("generate_time", perf_counter() - self.start_time)
+
+    def get_coalesce_key(self) -> str | None:
+        """
+        Jobs with the same key can share one batched TXT2IMG request.
+
+        - Payloads must be equal apart from a random seed.
+        - None if the job has to run alone.
+        """
+        if (
+            self.type != "TXT2IMG"
+            or self.is_using_animate_diff()
+            or self.get_controlnet_count() > 0
+        ):
+            return None
+
+        payload = dict(self.payload_raw)
+        if payload.pop("seed", -1) != -1:
+            return None
+        if payload.pop("batch_size", 1) != 1 or payload.pop("n_iter", 1) != 1:
+            return None
+
+        try:
+            return json.dumps(
+                [self.is_checkpoint_flux(), payload], sort_keys=True
+            )
+        except:
+            return None
+
+    def get_checkpoint(self) -> str | None:
+        try:
+            return self.payload["override_settings"]["sd_model_checkpoint"]
+        except:
+            return None
+
+    def is_checkpoint_flux(self) -> bool:
+        return is_checkpoint_flux(self.get_checkpoint(), self.metadata)
+
+    def get_requirements(self) -> dict:
+        """
+        What a backend needs to serve this job: its kind, checkpoint, LoRAs
+        in the prompts, scripts and ControlNet modules.
+        """
+        if self.__requirements is not None:
+            return self.__requirements
+
+        requirements = get_requirements(self.get_checkpoint(), self.metadata)
+        payload = self.payload_raw
+        loras = set()
+        scripts = set()
+        controlnet_modules = set()
+        try:
+            for key in ["prompt", "negative_prompt"]:
+                if isinstance(payload.get(key), str):
+                    loras.update(LORA_PATTERN.findall(payload[key]))
+
+            if self.type in ["TXT2IMG", "IMG2IMG"]:
+                scripts.update(
+                    script.lower()
+                    for script in payload.get("alwayson_scripts") or {}
+                )
+                if payload.get("script_name"):
+                    scripts.add(payload["script_name"].lower())
+                if self.get_controlnet_count() > 0:
+                    scripts.add("controlnet")
+                    controlnet_modules.update(
+                        unit.get("module", "none")
+                        for unit in payload["controlnet_units"]
+                    )
+            elif self.type == "CONTROLNET_DETECT":
+                controlnet_modules.add(payload.get("module", "none"))
+        except:
+            logger.warning(f"Failed to read requirements: {self.id}")
+        controlnet_modules.discard("none")
+
+        self.__requirements = {
+            **requirements,
+            "loras": loras,
+            "scripts": scripts,
+            "controlnet_modules": controlnet_modules,
+        }
+        return self.__requirements
+
     def is_using_animate_diff(self) -> bool:
         try:
             is_animatediff = self.payload["alwayson_scripts"]["AnimateDiff"][
@@ -233,23 +323,51 @@ class Job:
             info["infotexts"] = [info["infotexts"][0]]
 
     def postprocess(self):
-        logger.info("Postprocessing...")
+        logger.info(f"Postprocessing: {self.id}")
         try:
+            # Decode lazily returned frames across threads
+            if isinstance(self.generate_images, webuiapi.LazyImages):
+                self.generate_images.decode_all()
+            for image in self.generate_images:
+                if isinstance(image, webuiapi.LazyImages):
+                    image.decode_all()
+
+            # Classify all images at once while the rest is processed
+            nsfw_result = None
+            process_list = self.process_list
+            if any(p.type == "NSFW_DETECTION" for p in process_list):
+                nsfw_result = nsfw_check_batch(self.generate_images)
+                process_list = [
+                    p for p in process_list if p.type != "NSFW_DETECTION"
+                ]
+
             for image in self.generate_images:
                 postprocess(
                     image,
                     self.image_format,
-                    self.process_list,
+                    process_list,
                     self.dump_result,
                 )
+
+            if nsfw_result is not None:
+                for nsfw_stat in nsfw_result.result(Settings.NSFW_TIMEOUT):
+                    self.dump_result("nsfw", nsfw_stat, True, False)
             return True
 
         except Exception as e:
             logger.error(traceback.format_exc())
-            self.dump_result("error", str(e))
-            self.close(is_failed=True)
+            self.fail(e)
             return False
 
+    def fail(self, error: Exception, is_backend: bool = False):
+        """
+        Close as failed, with the error and what kind of failure it is.
+        """
+        self.failure_type = classify_failure(error, is_backend)
+        self.dump_result("error", str(error))
+        self.dump_result("error_type", self.failure_type)
+        self.close(is_failed=True)
+
     def emit_webhook(self):
         if not self.webhook:
             return
@@ -279,7 +397,9 @@ class Job:
                 timeout=3,
             )
         except Exception as e:
-            logger.warning(f"Webhook failed: {e}")
+            logger.warning(
+                f"Webhook failed [{classify_failure(e)}]: {self.id} {e}"
+            )
 
     def dump_result(
         self, key: str, value: any, is_append=False, inside_info=False
@@ -1,10 +1,17 @@
-from webuiapi import ControlNetUnit
+from webuiapi import ControlNetUnit, set_image_source
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import cache
+from time import perf_counter
 from io import BytesIO
 from PIL import Image
 from loguru import logger
 import re
 import base64
+import threading
+from defines import Settings
+from .image_cache import ImageCache, new_cache_stats
 
 
 REQUESTS_HEADERS = headers = {
@@ -17,27 +24,89 @@ REQUESTS_HEADERS = headers = {
     "Expires": "0",
 }
 
+# Shared keep-alive pool for input downloads
+session = requests.Session()
+session.headers.update(REQUESTS_HEADERS)
+session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=Settings.IMAGE_FETCH_CONCURRENCY,
+        pool_maxsize=Settings.IMAGE_FETCH_CONCURRENCY,
+    ),
+)
+
+image_cache_lock = threading.Lock()
+
+
+def get_image_cache() -> ImageCache | None:
+    """
+    Open the cache on first use, it reads every entry on disk.
+
+    - Opened under a lock, images are fetched concurrently.
+    """
+    with image_cache_lock:
+        return create_image_cache()
+
+
+@cache
+def create_image_cache() -> ImageCache | None:
+    if Settings.IMAGE_CACHE_SIZE <= 0:
+        return None
+    return ImageCache(
+        Settings.IMAGE_CACHE_DIR,
+        Settings.IMAGE_CACHE_SIZE,
+        Settings.IMAGE_CACHE_MAX_AGE,
+    )
+
+
+def download_image(
+    image: str, stats: dict, deadline: float | None = None
+) -> bytes:
+    def download(extra_headers: dict) -> requests.Response:
+        logger.debug(f"Downloading image: {image}")
+        timeout = 60
+        if deadline is not None:
+            timeout = max(1, min(timeout, deadline - perf_counter()))
+        return session.get(image, headers=extra_headers, timeout=timeout)
+
+    image_cache = get_image_cache()
+    if image_cache is not None:
+        return image_cache.fetch(image, download, stats)
+
+    response = download({})
+    if response.status_code != 200:
+        logger.error(f"Failed to download image: {response.status_code}")
+        raise Exception(f"Invalid image requested: {image[:100]}")
+    stats["misses"] += 1
+    stats["downloaded_bytes"] += len(response.content)
+    return response.content
+
+
+def normalize_image(
+    image: str, stats: dict | None = None, deadline: float | None = None
+):
+    if stats is None:
+        stats = new_cache_stats()
 
-def normalize_image(image: str):
     pil_image = None
     if image.startswith("data:image"):
-        pil_image = Image.open(
-            BytesIO(
-                base64.b64decode(re.sub("^data:image/.+;base64,", "", image))
-            )
-        )
+        b64 = re.sub("^data:image/.+;base64,", "", image)
+        data = base64.b64decode(b64)
+        pil_image = Image.open(BytesIO(data))
     elif image.startswith("https://"):
-        logger.debug(f"Downloading image: {image}")
-        response = requests.get(image, headers=REQUESTS_HEADERS, timeout=60)
-        if response.status_code == 200:
-            pil_image = Image.open(BytesIO(response.content))
-        else:
-            logger.error(f"Failed to download image: {response.status_code}")
-            raise Exception(f"Invalid image requested: {image[:100]}")
+        b64 = None
+        data = download_image(image, stats, deadline)
+        pil_image = Image.open(BytesIO(data))
 
     if pil_image is None:
         raise Exception(f"Invalid image: {image[:100]}")
 
+    # Decode now, while other images are still downloading
+    pil_image.load()
+
+    # Keep original bytes to send to the WebUI without re-encoding
+    set_image_source(pil_image, data, b64)
+
     # change to RGB if CMYK
     if pil_image.mode == "CMYK":
         pil_image = pil_image.convert("RGB")
@@ -45,44 +114,81 @@ def normalize_image(image: str):
     return pil_image
 
 
-def normalize_payload(payload: dict):
+def normalize_images(images: list[str], stats: dict) -> list:
+    """
+    Fetch and decode images concurrently, bounded by the job deadline.
+    """
+    if len(images) == 0:
+        return []
+
+    deadline = perf_counter() + Settings.IMAGE_FETCH_DEADLINE
+    task_stats = [new_cache_stats() for _ in images]
+    executor = ThreadPoolExecutor(
+        max_workers=min(len(images), Settings.IMAGE_FETCH_CONCURRENCY),
+        thread_name_prefix="fetch",
+    )
+    try:
+        futures = [
+            executor.submit(normalize_image, image, this_stats, deadline)
+            for image, this_stats in zip(images, task_stats)
+        ]
+        _, not_done = wait(futures, timeout=Settings.IMAGE_FETCH_DEADLINE)
+        if len(not_done) > 0:
+            raise Exception(
+                f"Timed out fetching {len(not_done)} of {len(images)} images"
+            )
+        pil_images = [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for this_stats in task_stats:
+        for key, value in this_stats.items():
+            stats[key] += value
+
+    return pil_images
+
+
+def normalize_payload(payload: dict) -> dict:
+    """
+    Normalize payload in place, return image cache stats.
+    """
+    stats = new_cache_stats()
+
+    # Collect every image reference first, then fetch them all at once
+    image_refs: list[tuple[dict | list, str | int]] = []
+
     if "image" in payload:
-        payload["image"] = normalize_image(payload["image"])
+        image_refs.append((payload, "image"))
 
     if "mask_image" in payload:
-        payload["mask_image"] = normalize_image(payload["mask_image"])
+        image_refs.append((payload, "mask_image"))
 
     if "images" in payload:
-        payload["images"] = [
-            normalize_image(image) for image in payload["images"]
+        payload["images"] = list(payload["images"])
+        image_refs += [
+            (payload["images"], i) for i in range(len(payload["images"]))
         ]
 
-    if "controlnet_units" in payload and isinstance(
+    has_controlnet_units = "controlnet_units" in payload and isinstance(
         payload["controlnet_units"], list
-    ):
-        normalized_controlnet_units = []
+    )
+    if has_controlnet_units:
         for controlnet_unit_dict in payload["controlnet_units"]:
-            if (
-                "input_image" in controlnet_unit_dict
-                and controlnet_unit_dict["input_image"] is not None
-            ):
-                controlnet_unit_dict["input_image"] = normalize_image(
-                    controlnet_unit_dict["input_image"]
-                )
-
-            if (
-                "mask" in controlnet_unit_dict
-                and controlnet_unit_dict["mask"] is not None
-            ):
-                controlnet_unit_dict["mask"] = normalize_image(
-                    controlnet_unit_dict["mask"]
-                )
-
-            normalized_controlnet_units.append(
-                ControlNetUnit(**controlnet_unit_dict)
-            )
-
-        payload["controlnet_units"] = normalized_controlnet_units
+            for key in ["input_image", "mask"]:
+                if controlnet_unit_dict.get(key) is not None:
+                    image_refs.append((controlnet_unit_dict, key))
+
+    pil_images = normalize_images(
+        [container[key] for container, key in image_refs], stats
+    )
+    for (container, key), pil_image in zip(image_refs, pil_images):
+        container[key] = pil_image
+
+    if has_controlnet_units:
+        payload["controlnet_units"] = [
+            ControlNetUnit(**controlnet_unit_dict)
+            for controlnet_unit_dict in payload["controlnet_units"]
+        ]
 
     # AnimateDiff
     try:
@@ -114,3 +220,5 @@ def normalize_payload(payload: dict):
 
     except:
         pass
+
+    return stats
@@ -0,0 +1,344 @@
+import threading
+from contextlib import contextmanager, nullcontext
+from functools import cache
+from time import time
+from typing import Callable
+from loguru import logger
+import webuiapi
+from defines import Settings
+
+# Requirements a backend may not meet, in the order they narrow candidates
+CAPABILITIES = ["scripts", "controlnet_modules", "checkpoints", "loras"]
+
+
+def parse_backends(value: str) -> list[tuple[str, str, int]]:
+    """
+    Parse `name=host:port` entries separated by commas, the name defaults
+    to `host:port`.
+    """
+    backends = []
+    for entry in value.split(","):
+        entry = entry.strip()
+        if entry == "":
+            continue
+        name, _, address = entry.rpartition("=")
+        host, _, port = address.rpartition(":")
+        if host == "" or not port.isdigit():
+            raise ValueError(f"Invalid WebUI backend: {entry}")
+        backends.append((name or address, host, int(port)))
+    return backends
+
+
+def get_checkpoint_names(sd_models: list[dict]) -> dict[str, str]:
+    """
+    Titles of `/sd-models` checkpoints by every name they can be requested
+    by.
+    """
+    names = {}
+    for sd_model in sd_models:
+        title = sd_model["title"]
+        names[title.split(" [")[0]] = title
+        for key in ["title", "model_name", "hash", "sha256"]:
+            if sd_model.get(key):
+                names[sd_model[key]] = title
+    return names
+
+
+def count_capability(available: set | dict | None) -> int | None:
+    """
+    Size of a probed capability, checkpoints count once for all names.
+    """
+    if available is None:
+        return None
+    if isinstance(available, dict):
+        return len(set(available.values()))
+    return len(available)
+
+
+class WebUIBackend:
+    """
+    One WebUI endpoint, with what it was found to serve and how busy it is.
+
+    - Capabilities are None until probed, per category, unknown ones are
+      assumed to be met.
+    """
+
+    def __init__(self, name: str, host: str, port: int, is_flux: bool):
+        self.name = name
+        self.is_flux = is_flux
+        self.api = webuiapi.WebUIApi(
+            host=host,
+            port=port,
+            decode_mode=Settings.WEBUI_DECODE_MODE,
+            options_ttl=Settings.WEBUI_OPTIONS_TTL,
+        )
+        self.capabilities: dict[str, set | dict | None] = {
+            capability: None for capability in CAPABILITIES
+        }
+        self.probed_at: float | None = None
+        self.checkpoint: str | None = None
+        self.swaps = 0
+        self.load = 0
+        self.jobs = 0
+        self.failure_streak = 0
+
+    def meets(self, requirements: dict, capability: str) -> bool:
+        available = self.capabilities[capability]
+        required = requirements.get(capability, set())
+        return available is None or required.issubset(available)
+
+
+class BackendRegistry:
+    """
+    WebUI backends of this worker, routing each job to the least loaded one
+    able to serve it.
+
+    - Flux checkpoints only go to flux backends, other jobs never do.
+    - Capabilities come from `probe`, a requirement no backend of the kind
+      meets is ignored and left to the WebUI.
+    - Backends are skipped while any skip condition holds for them, jobs
+      wait for them rather than going to a backend that can't serve them.
+    - Ties go to the backend with the job's checkpoint loaded last, the
+      checkpoint of each backend is only tracked here.
+    """
+
+    def __init__(self, backends: list[WebUIBackend]):
+        self.__backends = {backend.name: backend for backend in backends}
+        if len(self.__backends) != len(backends):
+            raise ValueError("WebUI backend names must be unique")
+        self.__lock = threading.Lock()
+        self.__skip_conditions: list[Callable[[str], bool]] = []
+        self.__swap_callbacks: list[Callable[[str], None]] = []
+
+    @property
+    def names(self) -> list[str]:
+        return list(self.__backends)
+
+    @property
+    def getters(self) -> dict[str, Callable[[], webuiapi.WebUIApi]]:
+        """API getters by backend name, as used for health and memory."""
+        return {
+            name: (lambda api=backend.api: api)
+            for name, backend in self.__backends.items()
+        }
+
+    @property
+    def checkpoints(self) -> dict[str, str]:
+        """Checkpoint loaded last by backend name, for known ones."""
+        with self.__lock:
+            return {
+                name: backend.checkpoint
+                for name, backend in self.__backends.items()
+                if backend.checkpoint is not None
+            }
+
+    @property
+    def checkpoint_swaps(self) -> int:
+        with self.__lock:
+            return sum(backend.swaps for backend in self.__backends.values())
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                name: {
+                    "flux": backend.is_flux,
+                    "url": backend.api.rooturl,
+                    "load": backend.load,
+                    "jobs": backend.jobs,
+                    "failure_streak": backend.failure_streak,
+                    "checkpoint": backend.checkpoint,
+                    "swaps": backend.swaps,
+                    "probed_at": backend.probed_at,
+                    "capabilities": {
+                        capability: count_capability(available)
+                        for capability, available in backend.capabilities.items()
+                    },
+                }
+                for name, backend in self.__backends.items()
+            }
+
+    def get_api(self, name: str) -> webuiapi.WebUIApi:
+        return self.__backends[name].api
+
+    def skip_when(self, condition: Callable[[str], bool]):
+        self.__skip_conditions.append(condition)
+
+    def on_swap(self, callback: Callable[[str], None]):
+        """
+        Call `callback` with a backend name when it loads another
+        checkpoint.
+        """
+        self.__swap_callbacks.append(callback)
+
+    def has_kind(self, is_flux: bool) -> bool:
+        return any(
+            backend.is_flux == is_flux for backend in self.__backends.values()
+        )
+
+    def mark_generated(self, name: str, is_backend_failure: bool):
+        """
+        Count the BACKEND failures of backend `name` in a row.
+        """
+        with self.__lock:
+            backend = self.__backends[name]
+            if is_backend_failure:
+                backend.failure_streak += 1
+            else:
+                backend.failure_streak = 0
+
+    def get_failure_streak(self, name: str) -> int:
+        with self.__lock:
+            return self.__backends[name].failure_streak
+
+    def probe(self, name: str):
+        """
+        Fetch what backend `name` serves, categories failing to load stay
+        unknown.
+        """
+        api = self.__backends[name].api
+        probes = {
+            "checkpoints": lambda: get_checkpoint_names(api.get_sd_models()),
+            "loras": lambda: {
+                lora_name
+                for lora in api.get_loras()
+                for lora_name in [lora.get("name"), lora.get("alias")]
+                if lora_name
+            },
+            "scripts": lambda: {
+                script.lower()
+                for scripts in api.get_scripts().values()
+                for script in scripts
+            },
+            "controlnet_modules": lambda: set(api.controlnet_module_list()),
+        }
+
+        capabilities = {}
+        for capability, probe in probes.items():
+            try:
+                capabilities[capability] = probe()
+            except Exception as e:
+                logger.debug(f"Failed to probe {capability} [{name}]: {e}")
+                capabilities[capability] = None
+
+        with self.__lock:
+            backend = self.__backends[name]
+            backend.capabilities = capabilities
+            backend.probed_at = time()
+        logger.info(
+            f"Probed WebUI [{name}]: "
+            + ", ".join(
+                f"{count_capability(available)} {capability}"
+                for capability, available in capabilities.items()
+            )
+        )
+
+    def get_capable(
+        self, requirements: dict, names: list[str] | None = None
+    ) -> list[str]:
+        """
+        Backends in `names`, all by default, able to serve `requirements`
+        and not skipped, in registry order.
+        """
+        with self.__lock:
+            return [
+                backend.name
+                for backend in self.__get_available(requirements, names)
+            ]
+
+    def route(self, job, names: list[str] | None = None) -> str | None:
+        """
+        Least loaded backend in `names`, all by default, for `job`, None if
+        none can take it now.
+        """
+        requirements = job.get_requirements()
+        checkpoint = job.get_checkpoint()
+        with self.__lock:
+            candidates = self.__get_available(requirements, names)
+            if len(candidates) == 0:
+                return None
+            return min(
+                candidates,
+                key=lambda backend: (
+                    backend.load,
+                    checkpoint is None or backend.checkpoint != checkpoint,
+                ),
+            ).name
+
+    def use(self, name: str | None, checkpoint: str | None = None):
+        """
+        Count a generation on backend `name` while in the context, loading
+        `checkpoint` if given.
+        """
+        if name is None:
+            return nullcontext()
+        return self.__use(name, checkpoint)
+
+    @contextmanager
+    def __use(self, name: str, checkpoint: str | None):
+        backend = self.__backends[name]
+        is_swapped = False
+        with self.__lock:
+            backend.load += 1
+            backend.jobs += 1
+            if checkpoint is not None and checkpoint != backend.checkpoint:
+                if backend.checkpoint is not None:
+                    backend.swaps += 1
+                    logger.debug(f"Checkpoint swap [{name}]: {checkpoint}")
+                backend.checkpoint = checkpoint
+                is_swapped = True
+        if is_swapped:
+            for callback in self.__swap_callbacks:
+                callback(name)
+        try:
+            yield backend.api
+        finally:
+            with self.__lock:
+                backend.load -= 1
+
+    def __get_available(
+        self, requirements: dict, names: list[str] | None
+    ) -> list[WebUIBackend]:
+        return [
+            backend
+            for backend in self.__get_capable(requirements)
+            if (names is None or backend.name in names)
+            and not any(
+                condition(backend.name) for condition in self.__skip_conditions
+            )
+        ]
+
+    def __get_capable(self, requirements: dict) -> list[WebUIBackend]:
+        """
+        Backends of the job's kind meeting as many requirements as any does.
+        """
+        candidates = [
+            backend
+            for backend in self.__backends.values()
+            if backend.is_flux == requirements.get("flux", False)
+        ]
+        for capability in CAPABILITIES:
+            narrowed = [
+                backend
+                for backend in candidates
+                if backend.meets(requirements, capability)
+            ]
+            if len(narrowed) > 0:
+                candidates = narrowed
+        return candidates
+
+
+@cache
+def get_backend_registry() -> BackendRegistry:
+    return BackendRegistry(
+        [
+            WebUIBackend(name, host, port, is_flux=False)
+            for name, host, port in parse_backends(Settings.WEBUI_BACKENDS)
+        ]
+        + [
+            WebUIBackend(name, host, port, is_flux=True)
+            for name, host, port in parse_backends(
+                Settings.WEBUI_FLUX_BACKENDS
+            )
+        ]
+    )
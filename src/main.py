@@ -1,99 +1,235 @@
+from startup import StartupProfile
+
+startup_profile = StartupProfile()
+
 from db import RedisDatabase
 from loguru import logger
 from killer import GracefulKiller
 import traceback
-from defines import CommandType
-from utils import restart_webui, check_webui_alive
-from time import sleep
+from defines import CommandType, Settings
+from pipeline import (
+    JobPrefetcher,
+    JobPostprocessor,
+    JobCoalescer,
+    JobLane,
+    HealthMonitor,
+    MemoryWatcher,
+)
+from utils import (
+    restart_webui,
+    handle_failures,
+    reset_webui_state,
+    get_backends,
+    warm_up,
+)
+from job import get_backend_registry
+from postprocess.nsfw import nsfw_service
+from postprocess.r2 import get_r2_spool
+from elastic import get_elastic_shipper
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+startup_profile.mark("imports")
+
+COMMAND_WAIT_TIMEOUT = 5
+
+
+@contextmanager
+def between_jobs(lanes: list[JobLane]):
+    """
+    Hold every lane once its current job is done.
+    """
+    for lane in lanes:
+        lane.pause()
+    try:
+        yield
+    finally:
+        for lane in lanes:
+            lane.resume()
 
 
 if __name__ == "__main__":
     db = RedisDatabase()
+    startup_profile.mark("register")
     killer = GracefulKiller()
+    r2_spool = get_r2_spool()
+    elastic_shipper = get_elastic_shipper()
+    health = HealthMonitor(
+        get_backends(),
+        interval=Settings.HEALTH_INTERVAL,
+        timeout=Settings.HEALTH_TIMEOUT,
+        min_backoff=Settings.HEALTH_MIN_BACKOFF_MS / 1000,
+        max_backoff=Settings.HEALTH_MAX_BACKOFF,
+    )
+
+    # Learn what each backend serves whenever it comes up, in the
+    # background, and route jobs only to healthy ones
+    registry = get_backend_registry()
+    health.on_up(registry.probe)
+    registry.skip_when(lambda name: not health.is_backend_healthy(name))
+    db.add_status_source("backends", lambda: registry.stats)
+    health.start()
+
+    # One lane per backend if they can run side by side, one for all if not
+    backend_names = list(get_backends())
+    lane_backends = (
+        {name: [name] for name in backend_names}
+        if Settings.CONCURRENT_LANES
+        else {"main": backend_names}
+    )
+    lanes: list[JobLane] = []
+
+    memory = MemoryWatcher(
+        get_backends(),
+        is_quiet=lambda: not any(lane.is_busy for lane in lanes),
+        interval=Settings.MEMORY_INTERVAL,
+        window=Settings.MEMORY_WINDOW,
+        ram_limit=Settings.MEMORY_RAM_LIMIT / 100,
+        vram_limit=Settings.MEMORY_VRAM_LIMIT / 100,
+        fragmentation_limit=Settings.MEMORY_FRAGMENTATION / 100,
+        horizon=Settings.MEMORY_HORIZON,
+    )
+    registry.on_swap(memory.clear_samples)
+    memory.start()
+    db.add_status_source("memory", lambda: memory.stats)
+    postprocessor = JobPostprocessor(depth=Settings.POSTPROCESS_DEPTH)
+    postprocessor.start()
+    prefetcher = JobPrefetcher(
+        db,
+        killer,
+        lookahead=max(Settings.PREFETCH_JOBS, Settings.COALESCE_MAX_BATCH - 1),
+        lanes=lane_backends if len(lane_backends) > 1 else None,
+    )
+    prefetcher.pause_when(lambda: postprocessor.is_full)
+    prefetcher.pause_when(lambda: memory.is_draining)
+    if len(lane_backends) > 1:
+        prefetcher.pause_lane_when(
+            lambda backends: not all(
+                health.is_backend_healthy(name) for name in backends
+            )
+        )
+    else:
+        prefetcher.pause_when(lambda: not health.is_healthy)
+    prefetcher.start()
+    coalescer = JobCoalescer(
+        prefetcher,
+        max_batch=Settings.COALESCE_MAX_BATCH,
+        window=Settings.COALESCE_WINDOW_MS / 1000,
+    )
+    for name, backends in lane_backends.items():
+        lane = JobLane(
+            name,
+            backends,
+            prefetcher,
+            coalescer,
+            postprocessor,
+            on_failures=lambda jobs: handle_failures(db, health, jobs),
+        )
+        lane.start()
+        lanes.append(lane)
+    db.add_status_source(
+        "lanes", lambda: {lane.lane_name: lane.stats for lane in lanes}
+    )
+    startup_profile.mark("pipeline")
+    startup_profile.report(Settings.STARTUP_BUDGET)
+
+    # Initialize heavy subsystems before the first job needs them
+    if Settings.WARM_UP:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
 
     is_waiting_for_webui_alive = False
-    is_previous_signal_received = True
+    is_standby = False
+    idle_since = None
 
     while True:
         # Check exit
         if killer.is_exit:
             break
 
-        # Check webui alive
-        is_alive = check_webui_alive()
-        if not is_alive:
+        # Check postprocess failures
+        failed_jobs = postprocessor.take_failures()
+        if len(failed_jobs) > 0:
+            handle_failures(
+                db, health, failed_jobs, hold=lambda: between_jobs(lanes)
+            )
+
+        # Check webui alive, as last seen by the health monitor, lanes of
+        # healthy backends keep going meanwhile
+        if not health.is_healthy:
             if not is_waiting_for_webui_alive:
                 db.update_worker_status("DISCONNECTED")
                 logger.error("WebUI is not alive, Waiting...")
                 is_waiting_for_webui_alive = True
-            sleep(5)
+            health.wait_healthy(timeout=5)
             continue
         if is_waiting_for_webui_alive:
             logger.info("WebUI is alive")
+            reset_webui_state()
 
         is_waiting_for_webui_alive = False
 
-        # Check signal
-        if is_previous_signal_received:
-            logger.info("<< Standby >>")
-            is_previous_signal_received = False
+        # Idle once no lane had a job for a whole command wait
+        is_busy = prefetcher.backlog > 0 or any(lane.is_busy for lane in lanes)
+        if is_busy:
+            idle_since = None
+        elif idle_since is None:
+            idle_since = monotonic()
+        is_idle = (
+            idle_since is not None
+            and monotonic() - idle_since >= COMMAND_WAIT_TIMEOUT
+        )
+
+        # Recycle the webui before it runs out of memory, once idle or done
+        # with the jobs sent to this worker
+        recycle_reasons = memory.recycle_reasons
+        if len(recycle_reasons) > 0:
+            memory.is_draining = is_idle or db.is_worker_queue_empty()
+            if memory.is_draining and not is_busy:
+                with between_jobs(lanes):
+                    restart_webui(db, health, "MEMORY", list(recycle_reasons))
+                for name in recycle_reasons:
+                    memory.reset(name)
+                continue
 
-        try:
-            wait_result = db.wait_signal()
-        except Exception as e:
-            logger.error(f"Failed to wait signal: {e}")
-            logger.error(traceback.format_exc())
-            continue
-        if wait_result is None:
+        # Report standby once every lane is done
+        if not is_busy and not is_standby:
+            logger.info("<< Standby >>")
+        is_standby = not is_busy
+        db.update_worker_status("PROCESSING" if is_busy else "STANDBY")
+
+        # Jobs run in the lanes, only commands are handled here
+        command: CommandType | None = prefetcher.get_command(
+            timeout=1 if is_busy else COMMAND_WAIT_TIMEOUT
+        )
+        if command is None:
             continue
 
-        # Signal received
-        is_previous_signal_received = True
-        signalType, payload, queue_key = wait_result
-        db.update_worker_status("PROCESSING")
-
-        # Command
-        if signalType == "COMMAND":
-            logger.info(f"Received command: {payload}")
-            command: CommandType = payload
-
-            if command == "STOP":
-                break
+        logger.info(f"Received command: {command}")
 
-            if command == "RESTART_WEBUI":
-                restart_webui(db)
-
-            if command == "FLUSH_QUEUE":
-                db.flush_queue()
-
-            if command == "RELOAD_QUEUE_CONFIG":
-                db.update_queue_key_list()
-
-        # Queue
-        if signalType == "JOB":
-            logger.info(f"Received job: {payload}")
-
-            try:
-                job = db.get_job(payload, queue_key)
-                if job is None:
-                    logger.warning("No job found or failed to get job")
-                    continue
-            except:
-                logger.error(traceback.format_exc())
-                continue
+        if command == "STOP":
+            break
 
-            # Run
-            is_success = job.generate()
-            if not is_success:
-                restart_webui(db)
-                continue
+        if command == "RESTART_WEBUI":
+            with between_jobs(lanes):
+                restart_webui(db, health, "COMMAND")
 
-            is_success = job.postprocess()
-            if not is_success:
-                restart_webui(db)
-                continue
+        if command == "FLUSH_QUEUE":
+            db.flush_queue()
 
-            job.close()
+        if command == "RELOAD_QUEUE_CONFIG":
+            db.update_queue_key_list()
 
     logger.info("Exiting...")
+    for lane in lanes:
+        lane.close()
+    prefetcher.close()
+    postprocessor.close()
+    health.close()
+    memory.close()
+    nsfw_service.close()
+    if r2_spool is not None:
+        r2_spool.close()
+    if elastic_shipper is not None:
+        elastic_shipper.close()
     db.close()
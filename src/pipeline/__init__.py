@@ -0,0 +1,6 @@
+from .prefetch import JobPrefetcher
+from .postprocessor import JobPostprocessor
+from .coalesce import JobCoalescer, generate_batch
+from .health import HealthMonitor
+from .memory import MemoryWatcher
+from .lanes import JobLane
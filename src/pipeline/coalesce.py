@@ -0,0 +1,120 @@
+import traceback
+from time import perf_counter
+from loguru import logger
+from webuiapi import WebUIApiResult
+from job import Job
+from .prefetch import JobPrefetcher
+
+
+# Per-image lists in the WebUI info
+SPLIT_INFO_KEYS = [
+    "all_prompts",
+    "all_negative_prompts",
+    "all_seeds",
+    "all_subseeds",
+    "infotexts",
+]
+
+
+class JobCoalescer:
+    """
+    Group compatible prefetched jobs to generate them with one request.
+
+    - Only jobs sharing `Job.get_coalesce_key` are grouped.
+    - Waits at most `window` seconds for more jobs to be claimed.
+    - Disabled when `max_batch` is 1.
+    """
+
+    def __init__(
+        self, prefetcher: JobPrefetcher, max_batch: int, window: float
+    ):
+        self.__prefetcher = prefetcher
+        self.__max_batch = max_batch
+        self.__window = window
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.__max_batch > 1
+
+    def collect(self, job: Job) -> list[Job]:
+        if not self.is_enabled:
+            return [job]
+
+        key = job.get_coalesce_key()
+        if key is None:
+            return [job]
+
+        jobs = [job] + self.__prefetcher.take_matching(
+            lambda other: other.get_coalesce_key() == key,
+            self.__max_batch - 1,
+            self.__window,
+        )
+        if len(jobs) > 1:
+            logger.info(f"Coalesced {len(jobs)} jobs: {[j.id for j in jobs]}")
+        return jobs
+
+
+def split_info(info: dict, index: int, count: int) -> dict:
+    """
+    Info of a single image out of a batched result.
+    """
+    info = dict(info)
+    for key in SPLIT_INFO_KEYS:
+        if isinstance(info.get(key), list) and len(info[key]) == count:
+            info[key] = [info[key][index]]
+
+    if "all_seeds" in info:
+        info["seed"] = info["all_seeds"][0]
+    if "all_subseeds" in info:
+        info["subseed"] = info["all_subseeds"][0]
+    info["batch_size"] = 1
+    info["index_of_first_image"] = 0
+    return info
+
+
+def generate_batch(jobs: list[Job]) -> list[bool]:
+    """
+    Generate coalesced jobs with one batched request, return success of each.
+
+    - Images and info are split back into the individual jobs.
+    - Falls back to generating one by one if the images can't be split.
+    """
+    logger.info(f"Generating batch [{len(jobs)}]: {[job.id for job in jobs]}")
+    for job in jobs:
+        job.start_time = perf_counter()
+
+    head = jobs[0]
+    try:
+        this_api = head.prepare_api()
+        api_result = this_api.txt2img(
+            **{
+                **head.payload,
+                "seed": -1,
+                "batch_size": len(jobs),
+                "n_iter": 1,
+                "do_not_save_grid": True,
+            }
+        )
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        for job in jobs:
+            job.fail(e, is_backend=True)
+        return [False] * len(jobs)
+
+    if len(api_result.images) != len(jobs):
+        logger.warning(
+            f"Batch returned {len(api_result.images)} images "
+            + f"for {len(jobs)} jobs, generating one by one"
+        )
+        return [job.generate() for job in jobs]
+
+    for index, job in enumerate(jobs):
+        job.set_api_result(
+            WebUIApiResult(
+                images=api_result.images[index : index + 1],
+                parameters=api_result.parameters,
+                info=split_info(api_result.info, index, len(jobs)),
+            )
+        )
+        job.dump_result("coalesced", len(jobs))
+    return [True] * len(jobs)
@@ -0,0 +1,183 @@
+import threading
+from time import monotonic, perf_counter, time
+from typing import Callable
+from loguru import logger
+from webuiapi import WebUIApi
+
+
+class HealthMonitor(threading.Thread):
+    """
+    Check WebUI backends in the background and keep their state cached, so
+    the main loop never waits on a health request.
+
+    - Healthy backends are checked every `interval` seconds.
+    - A failed check opens the circuit at once, down backends are then
+      probed with exponential backoff from `min_backoff` to `max_backoff`.
+    - `mark_down` opens the circuit ahead of a known outage, like a restart.
+    - Up callbacks run in the monitor thread whenever a backend comes up.
+    """
+
+    def __init__(
+        self,
+        backends: dict[str, Callable[[], WebUIApi]],
+        interval: float = 5,
+        timeout: float = 5,
+        min_backoff: float = 0.5,
+        max_backoff: float = 5,
+    ):
+        super().__init__(name="health", daemon=True)
+        self.__backends = backends
+        self.__interval = interval
+        self.__timeout = timeout
+        self.__min_backoff = min_backoff
+        self.__max_backoff = max_backoff
+
+        self.__condition = threading.Condition()
+        self.__is_closed = False
+        self.__up_callbacks: list[Callable[[str], None]] = []
+        self.__next_checks = {name: 0.0 for name in backends}
+        self.__states = {
+            name: {
+                "is_alive": False,
+                "failures": 0,
+                "trips": 0,
+                "latency": None,
+                "down_since": None,
+            }
+            for name in backends
+        }
+
+    @property
+    def is_healthy(self) -> bool:
+        with self.__condition:
+            return self.__is_healthy()
+
+    def is_backend_healthy(self, name: str) -> bool:
+        with self.__condition:
+            return self.__states[name]["is_alive"]
+
+    @property
+    def stats(self) -> dict:
+        with self.__condition:
+            return {
+                name: state.copy() for name, state in self.__states.items()
+            }
+
+    def on_up(self, callback: Callable[[str], None]):
+        self.__up_callbacks.append(callback)
+
+    def start(self):
+        """
+        Check every backend once before going to the background, up
+        callbacks of these checks run in the background too.
+        """
+        for name in self.__backends:
+            self.__check(name, is_notifying=False)
+        super().start()
+
+    def wait_healthy(self, timeout: float | None = None) -> bool:
+        with self.__condition:
+            return self.__condition.wait_for(self.__is_healthy, timeout)
+
+    def probe(self, name: str) -> bool:
+        """
+        Check a backend right away and return whether it is alive.
+        """
+        self.__check(name)
+        with self.__condition:
+            return self.__states[name]["is_alive"]
+
+    def mark_down(self, hold: float = 0, names: list[str] | None = None):
+        """
+        Open the circuit for backends in `names`, all by default, probing
+        resumes after `hold` seconds.
+        """
+        with self.__condition:
+            for name in names if names is not None else self.__backends:
+                self.__set_down(name)
+                self.__states[name]["failures"] = 0
+                self.__next_checks[name] = monotonic() + hold
+            self.__condition.notify_all()
+
+    def close(self):
+        with self.__condition:
+            self.__is_closed = True
+            self.__condition.notify_all()
+        if self.is_alive():
+            self.join()
+
+    def __is_healthy(self) -> bool:
+        return all(state["is_alive"] for state in self.__states.values())
+
+    def __set_down(self, name: str):
+        state = self.__states[name]
+        if state["is_alive"] or state["down_since"] is None:
+            state["trips"] += 1
+            state["down_since"] = time()
+        state["is_alive"] = False
+
+    def run(self):
+        for name in self.__backends:
+            if self.is_backend_healthy(name):
+                self.__notify_up(name)
+
+        while True:
+            with self.__condition:
+                if self.__is_closed:
+                    break
+                now = monotonic()
+                due_names = [
+                    name
+                    for name, next_check in self.__next_checks.items()
+                    if next_check <= now
+                ]
+                if len(due_names) == 0:
+                    self.__condition.wait(
+                        min(self.__next_checks.values()) - now
+                    )
+                    continue
+
+            for name in due_names:
+                self.__check(name)
+
+    def __check(self, name: str, is_notifying: bool = True):
+        time_start = perf_counter()
+        try:
+            self.__backends[name]().get_queue_status(timeout=self.__timeout)
+            is_alive = True
+        except Exception as e:
+            logger.debug(f"Health check failed [{name}]: {e}")
+            is_alive = False
+        latency = perf_counter() - time_start
+
+        with self.__condition:
+            state = self.__states[name]
+            is_up = is_alive and not state["is_alive"]
+            if is_alive:
+                if is_up:
+                    logger.info(f"WebUI [{name}] is up")
+                state["is_alive"] = True
+                state["failures"] = 0
+                state["latency"] = round(latency, 3)
+                state["down_since"] = None
+                self.__next_checks[name] = monotonic() + self.__interval
+            else:
+                if state["is_alive"]:
+                    logger.warning(f"WebUI [{name}] is down")
+                self.__set_down(name)
+                state["failures"] += 1
+                self.__next_checks[name] = monotonic() + min(
+                    self.__max_backoff,
+                    self.__min_backoff * 2 ** (state["failures"] - 1),
+                )
+            self.__condition.notify_all()
+
+        if is_up and is_notifying:
+            self.__notify_up(name)
+
+    def __notify_up(self, name: str):
+        for callback in self.__up_callbacks:
+            try:
+                callback(name)
+            except Exception as e:
+                logger.warning(f"Up callback failed [{name}]: {e}")
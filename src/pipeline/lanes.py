@@ -0,0 +1,154 @@
+import threading
+import traceback
+from typing import Callable
+from loguru import logger
+from job import Job, get_backend_registry
+from .prefetch import JobPrefetcher
+from .postprocessor import JobPostprocessor
+from .coalesce import JobCoalescer, generate_batch
+
+
+class JobLane(threading.Thread):
+    """
+    Generate prefetched jobs for its own backends, lanes of different
+    backends run side by side.
+
+    - Only takes jobs one of its `backends` can serve now, each goes to the
+      least loaded of them, see `BackendRegistry.route`.
+    - Jobs no backend of this worker serves are taken too, to fail them.
+    - Successful jobs go on to the postprocessor, failed ones to
+      `on_failures`.
+    """
+
+    TAKE_TIMEOUT = 1
+
+    def __init__(
+        self,
+        name: str,
+        backends: list[str],
+        prefetcher: JobPrefetcher,
+        coalescer: JobCoalescer,
+        postprocessor: JobPostprocessor,
+        on_failures: Callable[[list[Job]], None],
+    ):
+        super().__init__(name=f"lane_{name}", daemon=True)
+        self.lane_name = name
+        self.backends = backends
+        self.__prefetcher = prefetcher
+        self.__coalescer = coalescer
+        self.__postprocessor = postprocessor
+        self.__on_failures = on_failures
+
+        self.__condition = threading.Condition()
+        self.__is_closed = False
+        self.__is_paused = False
+        self.__job_ids: list[str] = []
+        self.__done = 0
+        self.__failed = 0
+
+    @property
+    def is_busy(self) -> bool:
+        return len(self.__job_ids) > 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "backends": self.backends,
+            "status": "PROCESSING" if self.is_busy else "STANDBY",
+            "jobs": self.__job_ids,
+            "done": self.__done,
+            "failed": self.__failed,
+        }
+
+    def serves(self, job: Job) -> bool:
+        registry = get_backend_registry()
+        if not registry.has_kind(job.is_checkpoint_flux()):
+            return True
+        return registry.route(job, self.backends) is not None
+
+    def pause(self):
+        """
+        Take no new job and wait for the current one to be done.
+        """
+        with self.__condition:
+            self.__is_paused = True
+            self.__condition.wait_for(lambda: not self.is_busy)
+
+    def resume(self):
+        with self.__condition:
+            self.__is_paused = False
+            self.__condition.notify_all()
+
+    def close(self):
+        """
+        Stop once the current job is done.
+        """
+        self.__is_closed = True
+        self.resume()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while not self.__is_closed:
+            with self.__condition:
+                if self.__is_paused:
+                    self.__condition.wait(self.TAKE_TIMEOUT)
+                    continue
+
+            job = self.__prefetcher.take(self.serves, self.TAKE_TIMEOUT)
+            if job is None:
+                continue
+
+            # Paused while taking, leave the job for later
+            with self.__condition:
+                if self.__is_paused:
+                    self.__prefetcher.give_back(job)
+                    continue
+                self.__job_ids = [job.id]
+
+            try:
+                self.__run_job(job)
+            except:
+                logger.error(traceback.format_exc())
+            finally:
+                with self.__condition:
+                    self.__job_ids = []
+                    self.__condition.notify_all()
+
+    def __run_job(self, job: Job):
+        logger.info(f"Received job [{self.lane_name}]: {job.id}")
+
+        # Run on the least loaded backend, together with compatible jobs if
+        # coalescing
+        registry = get_backend_registry()
+        backend_name = registry.route(job, self.backends)
+        jobs = self.__coalescer.collect(job)
+        self.__job_ids = [this_job.id for this_job in jobs]
+        for this_job in jobs:
+            this_job.backend_name = backend_name
+        with registry.use(backend_name, job.get_checkpoint()):
+            if len(jobs) > 1:
+                results = generate_batch(jobs)
+            else:
+                results = [job.generate()]
+
+        # Postprocess and close in background
+        failed_jobs = []
+        for this_job, is_success in zip(jobs, results):
+            if is_success:
+                self.__done += 1
+                self.__postprocessor.submit(this_job)
+            else:
+                self.__failed += 1
+                failed_jobs.append(this_job)
+        if backend_name is not None:
+            registry.mark_generated(
+                backend_name,
+                any(
+                    this_job.failure_type == "BACKEND"
+                    for this_job in failed_jobs
+                ),
+            )
+
+        if len(failed_jobs) > 0:
+            self.__on_failures(failed_jobs)
@@ -0,0 +1,189 @@
+import threading
+from collections import deque
+from time import monotonic
+from typing import Callable
+from loguru import logger
+from webuiapi import WebUIApi
+
+
+def _slope(samples: deque) -> float:
+    """
+    Least-squares slope of (time, value) samples, per second.
+    """
+    count = len(samples)
+    mean_t = sum(t for t, _ in samples) / count
+    mean_v = sum(v for _, v in samples) / count
+    variance = sum((t - mean_t) ** 2 for t, _ in samples)
+    if variance == 0:
+        return 0
+    return sum((t - mean_t) * (v - mean_v) for t, v in samples) / variance
+
+
+class MemoryWatcher(threading.Thread):
+    """
+    Sample WebUI memory through `/memory` between jobs and decide when a
+    backend should be recycled before it runs out.
+
+    - RAM is the WebUI process usage, VRAM the whole device usage.
+    - A backend is due when usage crosses its limit, when usage keeps
+      growing towards the limit within `horizon` seconds, or when the CUDA
+      allocator fragments or starts failing.
+    - Samples are only taken while `is_quiet` holds, so generation peaks
+      don't count as growth.
+    - Growth only counts while the loaded checkpoint stays the same, a swap
+      starts the samples over, see `clear_samples`.
+    """
+
+    def __init__(
+        self,
+        backends: dict[str, Callable[[], WebUIApi]],
+        is_quiet: Callable[[], bool],
+        interval: float = 30,
+        window: int = 20,
+        ram_limit: float = 0.9,
+        vram_limit: float = 0.95,
+        fragmentation_limit: float = 0.5,
+        horizon: float = 3600,
+    ):
+        super().__init__(name="memory", daemon=True)
+        self.__backends = backends
+        self.__is_quiet = is_quiet
+        self.__interval = interval
+        self.__window = max(2, window)
+        self.__ram_limit = ram_limit
+        self.__vram_limit = vram_limit
+        self.__fragmentation_limit = fragmentation_limit
+        self.__horizon = horizon
+
+        self.__lock = threading.Lock()
+        self.__is_closed = threading.Event()
+        self.__samples: dict[str, dict[str, deque]] = {}
+        self.__latest: dict[str, dict] = {}
+        self.__cuda_events: dict[str, dict] = {}
+        self.__reasons: dict[str, str] = {}
+        self.is_draining = False
+        for name in backends:
+            self.reset(name)
+
+    @property
+    def recycle_reasons(self) -> dict[str, str]:
+        """Backends due for a recycle, with the reason."""
+        with self.__lock:
+            return self.__reasons.copy()
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                name: {**latest, "recycle": self.__reasons.get(name)}
+                for name, latest in self.__latest.items()
+            }
+
+    def reset(self, name: str):
+        """
+        Start over after the backend was restarted.
+        """
+        with self.__lock:
+            self.__samples[name] = {
+                "ram": deque(maxlen=self.__window),
+                "vram": deque(maxlen=self.__window),
+            }
+            self.__cuda_events.pop(name, None)
+            self.__reasons.pop(name, None)
+            if len(self.__reasons) == 0:
+                self.is_draining = False
+
+    def clear_samples(self, name: str):
+        """
+        Start growth over after the backend loaded another checkpoint.
+        """
+        with self.__lock:
+            for samples in self.__samples[name].values():
+                samples.clear()
+
+    def close(self):
+        self.__is_closed.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while not self.__is_closed.wait(self.__interval):
+            if not self.__is_quiet():
+                continue
+            for name, get_backend_api in self.__backends.items():
+                try:
+                    memory = get_backend_api().get_memory()
+                except Exception as e:
+                    logger.debug(f"Memory sample failed [{name}]: {e}")
+                    continue
+                self.__sample(name, memory)
+
+    def __sample(self, name: str, memory: dict):
+        now = monotonic()
+        ram = memory.get("ram", {})
+        cuda = memory.get("cuda", {})
+        system = cuda.get("system", {})
+
+        with self.__lock:
+            samples = self.__samples[name]
+            latest = {}
+            checks: list[tuple[str, float, float]] = []
+
+            if ram.get("total"):
+                samples["ram"].append((now, ram["used"]))
+                latest["ram"] = round(ram["used"] / ram["total"], 2)
+                checks.append(("ram", ram["total"], self.__ram_limit))
+
+            if system.get("total"):
+                samples["vram"].append((now, system["used"]))
+                latest["vram"] = round(system["used"] / system["total"], 2)
+                checks.append(("vram", system["total"], self.__vram_limit))
+
+            reason = None
+            for kind, total, limit in checks:
+                used = samples[kind][-1][1]
+                if used >= total * limit:
+                    reason = f"{kind.upper()}_LIMIT"
+                    break
+
+                # Keeps growing and would cross the limit soon
+                if len(samples[kind]) >= self.__window // 2:
+                    slope = _slope(samples[kind])
+                    if (
+                        slope > 0
+                        and (total * limit - used) / slope < self.__horizon
+                    ):
+                        reason = f"{kind.upper()}_LEAK"
+                        break
+
+            # Memory the allocator holds but can't hand out
+            reserved = cuda.get("reserved", {}).get("current", 0)
+            allocated = cuda.get("allocated", {}).get("current", 0)
+            if reserved > 0:
+                fragmentation = 1 - allocated / reserved
+                latest["fragmentation"] = round(fragmentation, 2)
+                if (
+                    reason is None
+                    and system.get("total")
+                    and reserved >= system["total"] / 4
+                    and fragmentation >= self.__fragmentation_limit
+                ):
+                    reason = "FRAGMENTATION"
+
+            # Allocation retries or OOMs since the last sample
+            events = cuda.get("events")
+            if events is not None:
+                previous = self.__cuda_events.get(name)
+                if reason is None and previous is not None:
+                    if events.get("oom", 0) > previous.get("oom", 0):
+                        reason = "CUDA_OOM"
+                    elif events.get("retries", 0) > previous.get("retries", 0):
+                        reason = "FRAGMENTATION"
+                self.__cuda_events[name] = events
+
+            self.__latest[name] = latest
+            if reason is not None and name not in self.__reasons:
+                logger.warning(
+                    f"WebUI [{name}] due for recycle ({reason}): {latest}"
+                )
+                self.__reasons[name] = reason
@@ -0,0 +1,72 @@
+import queue
+import threading
+import traceback
+from collections import deque
+from loguru import logger
+from job import Job
+
+
+class JobPostprocessor(threading.Thread):
+    """
+    Run `Job.postprocess()` and `Job.close()` off the main loop, so the next
+    generation can be submitted as soon as the previous one returns.
+
+    - Hand-off is bounded by `depth`, `submit` blocks when it is full.
+    - Failed jobs are kept for the main loop to react on.
+    """
+
+    def __init__(self, depth: int = 2):
+        super().__init__(name="postprocess", daemon=True)
+        self.__depth = max(1, depth)
+        self.__jobs: queue.Queue[Job | None] = queue.Queue(self.__depth)
+        self.__failures: deque[Job] = deque()
+        self.__backlog = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def backlog(self) -> int:
+        """Jobs submitted but not closed yet."""
+        return self.__backlog
+
+    @property
+    def is_full(self) -> bool:
+        return self.__backlog >= self.__depth
+
+    def submit(self, job: Job):
+        with self.__lock:
+            self.__backlog += 1
+        self.__jobs.put(job)
+
+    def take_failures(self) -> list[Job]:
+        failures = []
+        while self.__failures:
+            failures.append(self.__failures.popleft())
+        return failures
+
+    def run(self):
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                break
+
+            try:
+                is_success = job.postprocess()
+                if is_success:
+                    job.close()
+                else:
+                    self.__failures.append(job)
+            except:
+                logger.error(traceback.format_exc())
+                self.__failures.append(job)
+            finally:
+                with self.__lock:
+                    self.__backlog -= 1
+
+    def close(self):
+        """
+        Finish all submitted jobs and stop.
+        """
+        if not self.is_alive():
+            return
+        self.__jobs.put(None)
+        self.join()
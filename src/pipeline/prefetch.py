@@ -0,0 +1,238 @@
+import threading
+import traceback
+from collections import deque
+from time import sleep, monotonic
+from typing import Callable
+from loguru import logger
+from db import RedisDatabase
+from defines import CommandType
+from killer import GracefulKiller
+from job import Job, get_backend_registry
+
+
+class JobPrefetcher(threading.Thread):
+    """
+    Claim jobs from the worker's queue list ahead of time and normalize their
+    payloads in the background, so the next generation can start right away.
+
+    - Commands are never buffered behind prefetched jobs.
+    - At most `lookahead` jobs are held, per lane if `lanes` are given,
+      they are handed back on close.
+    - No new job is claimed while any pause condition holds, nor for a lane
+      while any lane pause condition holds for its backends.
+    - Lanes map a name to the backends they serve, jobs are only claimed
+      if a backend of a lane with room can serve them, or if no backend of
+      this worker does, lanes fail those.
+    """
+
+    FULL_WAIT_TIMEOUT = 1
+
+    def __init__(
+        self,
+        db: RedisDatabase,
+        killer: GracefulKiller,
+        lookahead: int = 1,
+        lanes: dict[str, list[str]] | None = None,
+    ):
+        super().__init__(name="prefetch", daemon=True)
+        self.__db = db
+        self.__killer = killer
+        self.__lookahead = max(1, lookahead)
+        self.__lanes = lanes
+        self.__lane_pause_conditions: list[Callable[[list[str]], bool]] = []
+
+        self.__commands: deque[CommandType] = deque()
+        self.__jobs: deque[Job] = deque()
+        self.__condition = threading.Condition()
+        self.__is_closed = False
+        self.__pause_conditions: list[Callable[[], bool]] = []
+
+    @property
+    def backlog(self) -> int:
+        """Jobs claimed but not taken yet."""
+        with self.__condition:
+            return len(self.__jobs)
+
+    @property
+    def is_claiming(self) -> bool:
+        return not self.__is_closed and not self.__killer.is_exit
+
+    @property
+    def is_paused(self) -> bool:
+        return any(condition() for condition in self.__pause_conditions)
+
+    def pause_when(self, condition: Callable[[], bool]):
+        self.__pause_conditions.append(condition)
+
+    def pause_lane_when(self, condition: Callable[[list[str]], bool]):
+        self.__lane_pause_conditions.append(condition)
+
+    def __get_open_backends(self) -> set[str] | None:
+        """
+        Backends of lanes with room to claim for, None if all have.
+        """
+        registry = get_backend_registry()
+        open_backends = set()
+        with self.__condition:
+            for backends in self.__lanes.values():
+                held = sum(
+                    len(registry.get_capable(job.get_requirements(), backends))
+                    > 0
+                    for job in self.__jobs
+                )
+                if held < self.__lookahead and not any(
+                    condition(backends)
+                    for condition in self.__lane_pause_conditions
+                ):
+                    open_backends.update(backends)
+        if open_backends == {
+            backend
+            for backends in self.__lanes.values()
+            for backend in backends
+        }:
+            return None
+        return open_backends
+
+    def __accepts(self, requirements: dict, open_backends: set[str]) -> bool:
+        """
+        Whether a backend of a lane with room can serve a job, jobs no
+        backend serves are accepted for lanes to fail them.
+        """
+        registry = get_backend_registry()
+        if not registry.has_kind(requirements["flux"]):
+            return True
+        return len(registry.get_capable(requirements, open_backends)) > 0
+
+    def run(self):
+        while self.is_claiming:
+            accept = None
+            if self.__lanes is None:
+                with self.__condition:
+                    is_full = len(self.__jobs) >= self.__lookahead
+            else:
+                open_backends = self.__get_open_backends()
+                is_full = open_backends is not None and len(open_backends) == 0
+                if open_backends is not None:
+                    accept = lambda requirements: self.__accepts(
+                        requirements, open_backends
+                    )
+            is_full = is_full or self.is_paused
+
+            # Keep watching commands while the lookahead is full
+            try:
+                wait_result = self.__db.wait_signal(
+                    with_queue=not is_full,
+                    timeout=(
+                        self.FULL_WAIT_TIMEOUT
+                        if is_full or accept is not None
+                        else 5
+                    ),
+                    accept=accept,
+                )
+            except Exception as e:
+                logger.error(f"Failed to wait signal: {e}")
+                logger.error(traceback.format_exc())
+                sleep(1)
+                continue
+            if wait_result is None:
+                continue
+
+            signal_type, payload, queue_key = wait_result
+
+            if signal_type == "COMMAND":
+                with self.__condition:
+                    self.__commands.append(payload)
+                    self.__condition.notify_all()
+                continue
+
+            # Claimed by `wait_signal` already
+            job = payload
+            if job is None:
+                logger.warning("No job found or failed to get job")
+                continue
+
+            logger.info(f"Prefetched job: {job.id}")
+            with self.__condition:
+                self.__jobs.append(job)
+                self.__condition.notify_all()
+
+    def get_command(self, timeout: float = 5) -> CommandType | None:
+        """
+        Wait for the next command.
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__commands, timeout)
+            if self.__commands:
+                return self.__commands.popleft()
+            return None
+
+    def take(self, match: Callable[[Job], bool], timeout: float) -> Job | None:
+        """
+        Wait for the first prefetched job accepted by `match`.
+        """
+        deadline = monotonic() + timeout
+        with self.__condition:
+            while True:
+                for job in self.__jobs:
+                    if match(job):
+                        self.__jobs.remove(job)
+                        return job
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return None
+                self.__condition.wait(remaining)
+
+    def give_back(self, job: Job):
+        """
+        Hold a taken job again, first in line.
+        """
+        with self.__condition:
+            self.__jobs.appendleft(job)
+            self.__condition.notify_all()
+
+    def take_matching(
+        self, match: Callable[[Job], bool], limit: int, timeout: float
+    ) -> list[Job]:
+        """
+        Take up to `limit` prefetched jobs accepted by `match`, waiting at
+        most `timeout` seconds for more to be claimed.
+
+        - Stops waiting early once a command arrives.
+        """
+        deadline = monotonic() + timeout
+        taken: list[Job] = []
+        with self.__condition:
+            while True:
+                for job in list(self.__jobs):
+                    if len(taken) >= limit:
+                        break
+                    if match(job):
+                        self.__jobs.remove(job)
+                        taken.append(job)
+
+                remaining = deadline - monotonic()
+                if len(taken) >= limit or remaining <= 0 or self.__commands:
+                    break
+                self.__condition.wait(remaining)
+        return taken
+
+    def close(self):
+        """
+        Stop claiming and hand prefetched jobs back to their queue.
+        """
+        self.__is_closed = True
+        if self.is_alive():
+            self.join()
+
+        with self.__condition:
+            jobs = list(self.__jobs)
+            self.__jobs.clear()
+
+        # Push back in reverse so the original order is kept
+        for job in reversed(jobs):
+            logger.info(f"Returning job to {job.queue_key}: {job.id}")
+            try:
+                self.__db.requeue_job(job)
+            except:
+                logger.error(traceback.format_exc())
@@ -1 +1 @@
-from .hash import encode_blurhash
+from .hash import encode_blurhash, encode_blurhashes
@@ -0,0 +1,68 @@
+"""
+Compare the NumPy blurhash encoder against blurhash-python.
+
+Run from `src`: python -m postprocess.hash.benchmark [count]
+"""
+import sys
+from time import perf_counter
+import numpy as np
+from PIL import Image
+from .hash import RES, COMPONENTS, encode_blurhashes
+
+
+def make_images(count: int) -> list[Image.Image]:
+    rng = np.random.default_rng(0)
+    images = []
+    for index in range(count):
+        # Mix of smooth gradients and noise
+        y, x = np.mgrid[0:512, 0:512]
+        gradient = np.stack(
+            [x * (index % 7 + 1), y * (index % 5 + 1), x + y], axis=-1
+        )
+        noise = rng.integers(0, 64, size=(512, 512, 3))
+        pixels = ((gradient / 4 + noise) % 256).astype(np.uint8)
+        images.append(Image.fromarray(pixels, "RGB"))
+    return images
+
+
+def encode_reference(images: list[Image.Image]) -> list[str]:
+    import blurhash
+
+    return [
+        blurhash.encode(
+            image.resize((RES, RES)).convert("RGB"), COMPONENTS, COMPONENTS
+        )
+        for image in images
+    ]
+
+
+def measure(name: str, encode, images: list[Image.Image]) -> list[str]:
+    time_start = perf_counter()
+    hashes = encode(images)
+    elapsed = perf_counter() - time_start
+    print(
+        f"{name:>12}: {elapsed:.3f}s "
+        + f"({elapsed / len(images) * 1000:.2f}ms / image)"
+    )
+    return hashes
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    # Resize up front to compare the encoders only
+    images = [image.resize((RES, RES)) for image in make_images(count)]
+
+    reference = measure("reference", encode_reference, images)
+    single = measure(
+        "numpy",
+        lambda images: [encode_blurhashes([i])[0] for i in images],
+        images,
+    )
+    stack = measure("numpy stack", encode_blurhashes, images)
+
+    mismatches = sum(
+        a != b["hash"] or a != c["hash"]
+        for a, b, c in zip(reference, single, stack)
+    )
+    print(f"Mismatches: {mismatches} / {count}")
+    sys.exit(1 if mismatches > 0 else 0)
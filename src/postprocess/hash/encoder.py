@@ -0,0 +1,200 @@
+import ctypes
+import ctypes.util
+import math
+from functools import cache
+import numpy as np
+
+CHARACTERS = (
+    "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    + "abcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+)
+
+
+def _load_libm():
+    """
+    Use the C library math, so results match the reference encoder bit for
+    bit, its `cosf` / `powf` are not always correctly rounded.
+    """
+    try:
+        libm = ctypes.CDLL(ctypes.util.find_library("m") or "libm.so.6")
+        for name, argtypes in [
+            ("cosf", [ctypes.c_float]),
+            ("powf", [ctypes.c_float, ctypes.c_float]),
+        ]:
+            getattr(libm, name).argtypes = argtypes
+            getattr(libm, name).restype = ctypes.c_float
+        return libm
+    except (OSError, AttributeError):
+        return None
+
+
+_libm = _load_libm()
+
+
+def _cosf(value: np.float32) -> np.float32:
+    if _libm is not None:
+        return np.float32(_libm.cosf(value))
+    return np.float32(math.cos(value))
+
+
+def _powf(value: np.float32, exp: np.float32) -> np.float32:
+    if _libm is not None:
+        return np.float32(_libm.powf(value, exp))
+    return np.float32(float(value) ** float(exp))
+
+
+@cache
+def _srgb_to_linear() -> np.ndarray:
+    table = np.zeros(256, dtype=np.float32)
+    for value in range(256):
+        v = np.float32(value) / np.float32(255)
+        if v <= 0.04045:
+            table[value] = np.float32(float(v) / 12.92)
+        else:
+            table[value] = _powf(
+                np.float32((float(v) + 0.055) / 1.055), np.float32(2.4)
+            )
+    return table
+
+
+@cache
+def _basis(components: int, size: int) -> np.ndarray:
+    """
+    `cosf(pi * component * position / size)` for each component.
+    """
+    return np.array(
+        [
+            [
+                _cosf(np.float32(math.pi * component * position / size))
+                for position in range(size)
+            ]
+            for component in range(components)
+        ],
+        dtype=np.float32,
+    )
+
+
+def _linear_to_srgb(value: np.float32) -> int:
+    v = max(np.float32(0), min(np.float32(1), value))
+    if v <= 0.0031308:
+        return int(float(v) * 12.92 * 255 + 0.5)
+    return int(
+        (1.055 * float(_powf(v, np.float32(1 / 2.4))) - 0.055) * 255 + 0.5
+    )
+
+
+def _quantise_ac(ac: np.ndarray, maximum_value: np.ndarray) -> np.ndarray:
+    ratio = ac / maximum_value[:, None, None]
+
+    def quantise(root: np.ndarray) -> np.ndarray:
+        sign_pow = np.copysign(root, ratio)
+        quant = np.floor(
+            ((sign_pow * np.float32(9)).astype(np.float64) + 9.5).astype(
+                np.float32
+            )
+        )
+        return np.clip(quant, 0, 18).astype(np.int64)
+
+    # `powf(x, 0.5)` is within 1 ulp of the exact root, only ask the C
+    # library where that could change the quantised value
+    root = np.sqrt(np.abs(ratio))
+    quant = quantise(root)
+    if _libm is not None:
+        is_uncertain = (
+            quantise(np.nextafter(root, np.float32(np.inf))) != quant
+        ) | (quantise(np.nextafter(root, np.float32(0))) != quant)
+        for index in zip(*np.nonzero(is_uncertain)):
+            root[index] = _powf(abs(ratio[index]), np.float32(0.5))
+        quant = quantise(root)
+    return quant
+
+
+def _encode_int(value: int, length: int) -> str:
+    return "".join(
+        CHARACTERS[(value // 83**i) % 83] for i in reversed(range(length))
+    )
+
+
+def encode_pixels(
+    pixels: np.ndarray, x_components: int, y_components: int
+) -> list[str]:
+    """
+    Blurhash of each RGB uint8 image in a (N, height, width, 3) stack.
+
+    - All components of all images are computed in one pass.
+    - Sums run sequentially in float32 like the C encoder, so hashes are
+      identical to blurhash-python.
+    """
+    if not (1 <= x_components <= 9 and 1 <= y_components <= 9):
+        raise ValueError("Invalid x_components or y_components")
+
+    count, height, width, _ = pixels.shape
+    components = y_components * x_components
+
+    # linear[pixel, image, channel]
+    linear = (
+        _srgb_to_linear()[pixels]
+        .reshape(count, height * width, 3)
+        .transpose(1, 0, 2)
+    )
+
+    # basis[pixel, component], pixels and components row-major like the C
+    # loops
+    basis = (
+        (
+            _basis(y_components, height)[:, None, :, None]
+            * _basis(x_components, width)[None, :, None, :]
+        )
+        .reshape(components, height * width)
+        .T
+    )
+
+    # Sequential float32 sums over pixels, `np.sum` would sum pairwise
+    terms = basis[:, None, :, None] * linear[:, :, None, :]
+    np.add.accumulate(terms, axis=0, out=terms)
+
+    scale = np.full(
+        components, np.float32(2) / np.float32(width * height), np.float32
+    )
+    scale[0] = np.float32(1) / np.float32(width * height)
+    factors = terms[-1] * scale[None, :, None]
+
+    # Quantise AC components of all images at once
+    ac = factors[:, 1:]
+    if components > 1:
+        actual_maximum_value = np.abs(ac).max(axis=(1, 2))
+        quantised_maximum_value = np.clip(
+            np.floor(
+                (
+                    (actual_maximum_value * np.float32(166)).astype(np.float64)
+                    - 0.5
+                ).astype(np.float32)
+            ),
+            0,
+            82,
+        ).astype(np.int64)
+        maximum_value = (
+            quantised_maximum_value.astype(np.float32) + np.float32(1)
+        ) / np.float32(166)
+        quant = _quantise_ac(ac, maximum_value)
+        ac_values = (
+            quant[:, :, 0] * 19 * 19 + quant[:, :, 1] * 19 + quant[:, :, 2]
+        )
+    else:
+        quantised_maximum_value = np.zeros(count, dtype=np.int64)
+        ac_values = np.zeros((count, 0), dtype=np.int64)
+
+    size_flag = _encode_int((x_components - 1) + (y_components - 1) * 9, 1)
+    hashes = []
+    for dc, maximum, values in zip(
+        factors[:, 0], quantised_maximum_value, ac_values
+    ):
+        r, g, b = [_linear_to_srgb(value) for value in dc]
+        hashes.append(
+            size_flag
+            + _encode_int(int(maximum), 1)
+            + _encode_int((r << 16) + (g << 8) + b, 4)
+            + "".join(_encode_int(int(value), 2) for value in values)
+        )
+
+    return hashes
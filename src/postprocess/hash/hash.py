@@ -1,15 +1,34 @@
-import blurhash
+import numpy as np
 from PIL.Image import Image as PILImage
+from .encoder import encode_pixels
 
 RES = 64
 COMPONENTS = 4
 
 
+def encode_blurhashes(images: list[PILImage]) -> list[dict]:
+    """
+    Encode a stack of images at once.
+    """
+    if len(images) == 0:
+        return []
+
+    pixels = np.stack(
+        [
+            np.asarray(image.resize((RES, RES)).convert("RGB"))
+            for image in images
+        ]
+    )
+    hashes = encode_pixels(pixels, COMPONENTS, COMPONENTS)
+    return [
+        {
+            "hash": blurhash,
+            "width": image.width,
+            "height": image.height,
+        }
+        for image, blurhash in zip(images, hashes)
+    ]
+
+
 def encode_blurhash(image: PILImage):
-    width, height = image.size
-    image = image.resize((RES, RES)).convert("RGB")
-    return {
-        "hash": blurhash.encode(image, COMPONENTS, COMPONENTS),
-        "width": width,
-        "height": height,
-    }
+    return encode_blurhashes([image])[0]
@@ -1 +1 @@
-from .nsfw import nsfw_check
+from .nsfw import nsfw_check, nsfw_check_batch, nsfw_service
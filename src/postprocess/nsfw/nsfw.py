@@ -1,16 +1,66 @@
-import numpy as np
 from PIL import Image
-from nsfw_detector import predict
-from tensorflow import keras
 from pathlib import Path
+from collections.abc import Sequence
+from concurrent.futures import Future
+from defines import Settings
+from .service import NsfwService
 
-model = predict.load_model(str(Path(__file__).parent / "nsfw_model.h5"))
+nsfw_service = NsfwService(
+    str(Path(__file__).parent / "nsfw_model.h5"),
+    max_batch=Settings.NSFW_BATCH_SIZE,
+)
 
 
-def nsfw_check(image: Image):
-    if image.mode != "RGB":
-        image = image.convert("RGB")
-    image = image.resize((224, 224), Image.NEAREST)
-    image = keras.preprocessing.image.img_to_array(image)
-    image /= 255
-    return predict.classify_nd(model, np.asarray([image]))[0]
+def nsfw_score(probs: dict) -> float:
+    return 1 - probs.get("neutral", 0) - probs.get("drawings", 0)
+
+
+def sample_frames(frames: Sequence[Image.Image], count: int) -> list:
+    """
+    Evenly spaced frames of an animation, first frame included.
+    """
+    count = max(1, min(count, len(frames)))
+    step = (len(frames) - 1) / max(1, count - 1)
+    return [frames[round(i * step)] for i in range(count)]
+
+
+def nsfw_check_batch(items: list[Image.Image | Sequence[Image.Image]]):
+    """
+    Classify every item in one request, resolves to one result per item.
+
+    - Animations are sampled with `NSFW_ANIMATION_SAMPLES` frames, the most
+      explicit frame is reported.
+    """
+    frames = []
+    owners = []
+    for index, item in enumerate(items):
+        if isinstance(item, Image.Image):
+            samples = [item]
+        else:
+            samples = sample_frames(item, Settings.NSFW_ANIMATION_SAMPLES)
+        frames += samples
+        owners += [index] * len(samples)
+
+    result_future = Future()
+
+    def on_done(future: Future):
+        try:
+            probs = future.result()
+        except Exception as e:
+            result_future.set_exception(e)
+            return
+
+        results = [None] * len(items)
+        for owner, this_probs in zip(owners, probs):
+            if results[owner] is None or nsfw_score(this_probs) > nsfw_score(
+                results[owner]
+            ):
+                results[owner] = this_probs
+        result_future.set_result(results)
+
+    nsfw_service.classify(frames).add_done_callback(on_done)
+    return result_future
+
+
+def nsfw_check(image: Image.Image):
+    return nsfw_service.classify([image]).result(Settings.NSFW_TIMEOUT)[0]
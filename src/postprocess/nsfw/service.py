@@ -0,0 +1,224 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+import numpy as np
+from PIL import Image
+from loguru import logger
+
+INPUT_SIZE = 224
+
+
+def prepare_inputs(images: list[Image.Image]) -> np.ndarray:
+    """
+    Downscale to the model input size, kept as uint8 to send less data.
+    """
+    frames = []
+    for image in images:
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        frames.append(
+            np.asarray(image.resize((INPUT_SIZE, INPUT_SIZE), Image.NEAREST))
+        )
+    return np.stack(frames)
+
+
+def _serve(
+    model_path: str,
+    requests: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+    max_batch: int,
+):
+    """
+    Service process, keep the model loaded and classify queued requests
+    together in as few forward passes as possible.
+    """
+    from nsfw_detector import predict
+
+    model = predict.load_model(model_path)
+    results.put(("READY", None, None))
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        # Take whatever else is already waiting
+        batch = [request]
+        size = len(request[1])
+        while size < max_batch:
+            try:
+                request = requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                requests.put(None)
+                break
+            batch.append(request)
+            size += len(request[1])
+
+        try:
+            inputs = np.concatenate([frames for _, frames in batch])
+            probs = predict.classify_nd(model, inputs.astype(np.float32) / 255)
+        except Exception as e:
+            for request_id, _ in batch:
+                results.put((request_id, None, str(e)))
+            continue
+
+        offset = 0
+        for request_id, frames in batch:
+            results.put(
+                (request_id, probs[offset : offset + len(frames)], None)
+            )
+            offset += len(frames)
+
+
+class NsfwService:
+    """
+    NSFW classifier running in its own process with the model kept warm.
+
+    - Started on first use, restarted if the process died.
+    - `classify` returns a future, TensorFlow never runs in this process.
+    - Requests waiting together are classified in one forward pass.
+    """
+
+    READY_TIMEOUT = 300
+
+    def __init__(self, model_path: str, max_batch: int = 32):
+        self.__model_path = model_path
+        self.__max_batch = max_batch
+        self.__context = multiprocessing.get_context("spawn")
+        self.__lock = threading.Lock()
+        self.__ids = itertools.count()
+        self.__pending: dict[int, Future] = {}
+        self.__process = None
+        self.__requests = None
+        self.__results = None
+        self.__ready = threading.Event()
+
+    @property
+    def is_running(self) -> bool:
+        return self.__process is not None and self.__process.is_alive()
+
+    def start(self):
+        with self.__lock:
+            self.__start()
+
+    def __start(self):
+        """
+        Start the process unless running, with the lock held.
+        """
+        if self.is_running:
+            return
+
+        logger.info("Starting NSFW service")
+        self.__ready.clear()
+        self.__pending = {}
+        self.__requests = self.__context.Queue()
+        self.__results = self.__context.Queue()
+        self.__process = self.__context.Process(
+            target=_serve,
+            args=(
+                self.__model_path,
+                self.__requests,
+                self.__results,
+                self.__max_batch,
+            ),
+            name="nsfw",
+            daemon=True,
+        )
+        self.__process.start()
+        threading.Thread(
+            target=self.__collect,
+            args=(
+                self.__process,
+                self.__requests,
+                self.__results,
+                self.__pending,
+            ),
+            name="nsfw-results",
+            daemon=True,
+        ).start()
+
+    def wait_ready(self, timeout: float | None = None) -> bool:
+        self.start()
+        return self.__ready.wait(timeout or self.READY_TIMEOUT)
+
+    def classify(self, images: list[Image.Image]) -> Future:
+        """
+        Classify images in one request, resolves to a list of probabilities.
+
+        - Registered with a live process under the lock, a process dying
+          later fails it, see `__collect`.
+        """
+        future = Future()
+        if len(images) == 0:
+            future.set_result([])
+            return future
+
+        inputs = prepare_inputs(images)
+        request_id = next(self.__ids)
+        with self.__lock:
+            self.__start()
+            self.__pending[request_id] = future
+            self.__requests.put((request_id, inputs))
+        return future
+
+    def close(self):
+        with self.__lock:
+            process = self.__process
+            self.__process = None
+        if process is None:
+            return
+
+        self.__requests.put(None)
+        process.join(timeout=5)
+        if process.is_alive():
+            process.kill()
+        # Unread requests would block exit
+        self.__requests.cancel_join_thread()
+
+    def __collect(
+        self,
+        process,
+        requests: multiprocessing.Queue,
+        results: multiprocessing.Queue,
+        pending: dict[int, Future],
+    ):
+        while True:
+            try:
+                request_id, probs, error = results.get(timeout=1)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                logger.error(f"NSFW service exited: {process.exitcode}")
+                requests.cancel_join_thread()
+                self.__fail_pending(pending, Exception("NSFW service exited"))
+                return
+            except:
+                logger.error(traceback.format_exc())
+                return
+
+            if request_id == "READY":
+                logger.info("NSFW service ready")
+                self.__ready.set()
+                continue
+
+            with self.__lock:
+                future = pending.pop(request_id, None)
+            if future is None:
+                continue
+            if error is not None:
+                future.set_exception(Exception(f"NSFW check failed: {error}"))
+            else:
+                future.set_result(list(probs))
+
+    def __fail_pending(self, pending: dict[int, Future], error: Exception):
+        with self.__lock:
+            futures = list(pending.values())
+            pending.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
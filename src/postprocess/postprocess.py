@@ -4,9 +4,10 @@ from typing import List, Callable
 from cuid2 import cuid_wrapper
 from loguru import logger
 from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 
 from .add_text import add_text
-from .r2 import upload_r2
+from .r2 import upload_r2, prepare_images
 from .letterbox import letterbox
 from .nsfw import nsfw_check
 from .watermark import watermark
@@ -14,6 +15,11 @@ from .hash import encode_blurhash
 
 cuid_generator: Callable[[], str] = cuid_wrapper()
 
+# Pillow and PyAV release the GIL while encoding
+upload_executor = ThreadPoolExecutor(
+    max_workers=3, thread_name_prefix="upload"
+)
+
 
 def postprocess(
     image: PILImage | List[PILImage],
@@ -24,7 +30,7 @@ def postprocess(
     image_id = cuid_generator()
 
     # Convert to list for gif compatibility
-    this_images = image if isinstance(image, list) else [image]
+    this_images = [image] if isinstance(image, PILImage) else list(image)
 
     for process in process_list:
         logger.debug(f"Processing [{process.type}]")
@@ -49,7 +55,7 @@ def postprocess(
         # Loop back process
         elif process.type == "LETTERBOX":
             new_image = letterbox(this_images[0])
-            letterbox_url, letterbox_size = upload_r2(
+            letterbox_url, letterbox_size, _ = upload_r2(
                 [new_image],
                 image_id + "_letterbox",
                 fmt=image_format,
@@ -59,36 +65,42 @@ def postprocess(
 
         # One way process
         elif process.type == "UPLOAD":
-            image_url, image_size = upload_r2(
-                this_images,
-                image_id,
-                fmt=image_format,
-                **args,
-            )
-            dump_result("images", image_url, True, False)
-            dump_result("images_sizes", image_size, True, False)
+            # Resize once before encoding variants concurrently
+            upload_args = {**args}
+            prepare_images(this_images, upload_args.pop("resize", None))
+
+            variants = {"images": (this_images, image_id, image_format)}
 
             # upload first frame if animation for preview
             if len(this_images) > 1:
-                image_url, static_size = upload_r2(
+                variants["statics"] = (
                     [this_images[0]],
                     image_id + "_s",
-                    fmt=image_format,
-                    **args,
+                    image_format,
                 )
-                dump_result("statics", image_url, True, False)
-                dump_result("statics_sizes", static_size, True, False)
 
             # upload mp4 if animation and is webp, use mp4 for compatibility
             if len(this_images) > 1 and image_format == "WEBP":
-                video_url, video_size = upload_r2(
-                    this_images,
-                    image_id,
-                    fmt="MP4",
-                    **args,
+                variants["videos"] = (this_images, image_id, "MP4")
+
+            futures = {
+                key: upload_executor.submit(
+                    upload_r2,
+                    list(images),
+                    variant_id,
+                    fmt=fmt,
+                    **upload_args,
                 )
-                dump_result("videos", video_url, True, False)
-                dump_result("videos_sizes", video_size, True, False)
+                for key, (images, variant_id, fmt) in variants.items()
+            }
+
+            upload_timings = {}
+            for key, future in futures.items():
+                url, size, timing = future.result()
+                dump_result(key, url, True, False)
+                dump_result(f"{key}_sizes", size, True, False)
+                upload_timings[key] = timing
+            dump_result("upload_timings", upload_timings, True, False)
 
         # One way process
         elif process.type == "NSFW_DETECTION":
@@ -1 +1 @@
-from .r2 import upload_r2
+from .r2 import upload_r2, prepare_images, get_r2_client, get_r2_spool
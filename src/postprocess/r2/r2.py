@@ -1,19 +1,91 @@
 from PIL.Image import Image, Resampling
-from io import BytesIO
 from defines import Settings
 from loguru import logger
 from typing import List
-import boto3
-import imageio.v3 as imageio
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+import shutil
+import threading
 from pathlib import Path
+from time import perf_counter
 
+from .stream import R2UploadStream, TeeWriter
+from .video import Mp4Encoder
+from .spool import R2Spool
 
-r2_client = boto3.client(
-    service_name="s3",
-    endpoint_url=Settings.R2_ENDPOINT_URL,
-    region_name="apac",
+
+r2_part_executor = ThreadPoolExecutor(
+    max_workers=Settings.R2_MAX_POOL_CONNECTIONS,
+    thread_name_prefix="r2_part",
 )
+r2_client_lock = threading.Lock()
+
+
+def get_r2_client():
+    """
+    Create the client on first use, boto3 is slow to import and set up.
+
+    - Created under a lock, warm-up may race the first upload and boto3's
+      default session isn't thread-safe.
+    """
+    with r2_client_lock:
+        return create_r2_client()
+
+
+@cache
+def create_r2_client():
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client(
+        service_name="s3",
+        endpoint_url=Settings.R2_ENDPOINT_URL,
+        region_name="apac",
+        config=Config(max_pool_connections=Settings.R2_MAX_POOL_CONNECTIONS),
+    )
+
+
+def open_upload_stream(filename: str) -> R2UploadStream:
+    return R2UploadStream(
+        get_r2_client(),
+        Settings.R2_BUCKET_NAME,
+        filename,
+        executor=r2_part_executor,
+        part_size=Settings.R2_PART_SIZE,
+        max_concurrency=Settings.R2_MAX_CONCURRENCY,
+    )
+
+
+def upload_spooled(blob: Path, filename: str):
+    with open_upload_stream(filename) as upload_stream, open(blob, "rb") as f:
+        shutil.copyfileobj(f, upload_stream, Settings.R2_PART_SIZE)
+
+
+@cache
+def get_r2_spool() -> R2Spool | None:
+    """
+    Spool of encoded outputs synced in the background, if configured.
+    """
+    if Settings.R2_SPOOL_DIR == "":
+        return None
+    return R2Spool(
+        Settings.R2_SPOOL_DIR,
+        Settings.R2_SPOOL_SIZE,
+        upload_spooled,
+        workers=Settings.R2_SPOOL_WORKERS,
+        max_backoff=Settings.R2_SPOOL_MAX_BACKOFF,
+    )
+
+
+def prepare_images(images: List[Image], resize: int | None = None):
+    """
+    Resize and load frames in place, so they can be encoded concurrently.
+    """
+    for image in images:
+        if resize is not None:
+            image.thumbnail((resize, 4096), Resampling.LANCZOS)
+        else:
+            image.load()
 
 
 def upload_r2(
@@ -23,7 +95,11 @@ def upload_r2(
     duration: int = 125,
     resize: int | None = None,
     fps: int = 8,
-) -> tuple[str, int]:
+    crf: int | None = None,
+    preset: str | None = None,
+) -> tuple[str, int, dict]:
+    time_start = perf_counter()
+
     # Check lossless
     is_lossless = fmt == "WEBP_LOSSLESS"
     if fmt == "WEBP_LOSSLESS":
@@ -37,7 +113,6 @@ def upload_r2(
 
     filename = f"{'dev/' if Settings.DEV else ''}{image_id}.{fmt.lower()}"
 
-    bytes_io = BytesIO()
     save_options = {
         "format": fmt,
         "lossless": is_lossless,
@@ -46,9 +121,7 @@ def upload_r2(
     }
 
     # Resize if specified
-    if resize is not None:
-        for image in images:
-            image.thumbnail((resize, 4096), Resampling.LANCZOS)
+    prepare_images(images, resize)
 
     # Save all frames if sequence
     if is_sequence:
@@ -65,53 +138,65 @@ def upload_r2(
     if fmt == "JPEG":
         images[0] = images[0].convert("RGB")
 
-    # Pillow save
-    if fmt != "MP4":
-        images[0].save(bytes_io, **save_options)
-    else:
-        # imageio save
-        imageio.imwrite(
-            bytes_io,
-            [np.array(image) for image in images],
-            format_hint=".mp4",
-            plugin="pyav",
+    def encode(output):
+        if fmt != "MP4":
+            images[0].save(output, **save_options)
+            return
+        with Mp4Encoder(
+            output,
+            *images[0].size,
             fps=fps,
-            codec="h264",
-            out_pixel_format="yuv420p",
-        )
-
-    bytes_io.seek(0)
-    size = bytes_io.getbuffer().nbytes
-
-    # Upload to R2
-    logger.debug(
-        f"Uploading resource to R2: {filename} ({size / 1024 / 1024:.2f}MB)"
-    )
-    r2_client.upload_fileobj(
-        bytes_io,
-        Settings.R2_BUCKET_NAME,
-        filename,
-    )
-
-    # Save file if dev
+            crf=crf if crf is not None else Settings.MP4_CRF,
+            preset=preset or Settings.MP4_PRESET,
+            fragmented=Settings.MP4_FRAGMENTED,
+        ) as encoder:
+            for image in images:
+                encoder.write(image)
+
+    dev_path = None
     if Settings.DEV:
-        dev_path = Path("dev")
-        dev_path.mkdir(exist_ok=True)
-
-        save_file = dev_path / f"{image_id}.{fmt.lower()}"
+        Path("dev").mkdir(exist_ok=True)
+        dev_path = Path("dev") / f"{image_id}.{fmt.lower()}"
+
+    # Encode into the spool and let it sync, the URL is valid once uploaded
+    r2_spool = get_r2_spool()
+    spool_writer = r2_spool.open() if r2_spool is not None else None
+    if spool_writer is not None:
+        logger.debug(f"Spooling resource for R2: {filename}")
+        try:
+            encode(spool_writer)
+        except:
+            spool_writer.abort()
+            raise
+        spool_writer.commit(filename, mirror=dev_path)
+        return (
+            f"{Settings.R2_PUBLIC_URL}/{filename}",
+            spool_writer.size,
+            {"encode_time": perf_counter() - time_start, "upload_time": 0},
+        )
 
-        if fmt != "MP4":
-            with open(save_file, "wb") as f:
-                images[0].save(f, **save_options)
-        else:
-            imageio.imwrite(
-                save_file,
-                [np.array(image) for image in images],
-                format_hint=".mp4",
-                plugin="pyav",
-                fps=fps,
-                codec="h264",
-                out_pixel_format="yuv420p",
+    # Mirror to a local file if dev, from the same encoding pass
+    dev_file = open(dev_path, "wb") if dev_path is not None else None
+
+    # Stream into R2 while encoding
+    logger.debug(f"Streaming resource to R2: {filename}")
+    try:
+        with open_upload_stream(filename) as upload_stream:
+            encode(
+                upload_stream
+                if dev_file is None
+                else TeeWriter(upload_stream, dev_file)
             )
-
-    return f"{Settings.R2_PUBLIC_URL}/{filename}", size
+            encode_time = perf_counter() - time_start
+            time_start = perf_counter()
+    finally:
+        if dev_file is not None:
+            dev_file.close()
+    size = upload_stream.size
+    upload_time = perf_counter() - time_start
+
+    return (
+        f"{Settings.R2_PUBLIC_URL}/{filename}",
+        size,
+        {"encode_time": encode_time, "upload_time": upload_time},
+    )
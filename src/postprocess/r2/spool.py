@@ -0,0 +1,283 @@
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import shutil
+import threading
+import traceback
+import uuid
+from pathlib import Path
+from time import time, monotonic
+from typing import Callable
+from loguru import logger
+
+
+class SpoolWriter:
+    """
+    Sequential file-like output into the spool, hashed while written.
+    """
+
+    def __init__(self, spool: "R2Spool", temp_file: Path):
+        self.__spool = spool
+        self.__temp_file = temp_file
+        self.__file = open(temp_file, "wb")
+        self.__hash = hashlib.sha256()
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def readable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self):
+        pass
+
+    def write(self, data) -> int:
+        self.__file.write(data)
+        self.__hash.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def commit(self, key: str, mirror: Path | None = None):
+        """
+        Store the content and queue its upload to `key`.
+        The stored file is also linked to `mirror` if given.
+        """
+        self.__file.close()
+        self.__spool._commit(
+            self.__temp_file, self.__hash.hexdigest(), self.size, key, mirror
+        )
+
+    def abort(self):
+        self.__file.close()
+        self.__temp_file.unlink(missing_ok=True)
+
+
+class R2Spool:
+    """
+    Local content-addressed spool of encoded outputs, synced to R2 in the
+    background.
+
+    - Blobs are stored once by sha256, pending uploads are journaled and
+      resumed on startup.
+    - Failed uploads are retried with exponential backoff.
+    - `open` returns None while spooled blobs exceed `max_size`.
+    """
+
+    RETRY_BASE = 2
+
+    def __init__(
+        self,
+        directory: str,
+        max_size: int,
+        upload: Callable[[Path, str], None],
+        workers: int = 2,
+        max_backoff: float = 300,
+    ):
+        self.__directory = Path(directory)
+        self.__blob_dir = self.__directory / "blobs"
+        self.__pending_dir = self.__directory / "pending"
+        self.__temp_dir = self.__directory / "tmp"
+        for path in [self.__blob_dir, self.__pending_dir, self.__temp_dir]:
+            path.mkdir(parents=True, exist_ok=True)
+
+        self.__max_size = max_size
+        self.__upload = upload
+        self.__max_backoff = max_backoff
+
+        self.__condition = threading.Condition()
+        self.__queue: list[tuple[float, int, dict]] = []
+        self.__sequence = itertools.count()
+        self.__blob_refs: dict[str, int] = {}
+        self.__size = 0
+        self.__is_closed = False
+        self.__uploading = 0
+
+        self.__resume()
+
+        self.__workers = [
+            threading.Thread(
+                target=self.__run, name=f"r2_spool_{i}", daemon=True
+            )
+            for i in range(max(1, workers))
+        ]
+        for worker in self.__workers:
+            worker.start()
+
+    @property
+    def stats(self) -> dict:
+        with self.__condition:
+            return {
+                "pending": len(self.__queue) + self.__uploading,
+                "bytes": self.__size,
+            }
+
+    @property
+    def is_full(self) -> bool:
+        return self.__size >= self.__max_size
+
+    def open(self) -> SpoolWriter | None:
+        if self.is_full:
+            return None
+        return SpoolWriter(self, self.__temp_dir / uuid.uuid4().hex)
+
+    def _commit(
+        self,
+        temp_file: Path,
+        digest: str,
+        size: int,
+        key: str,
+        mirror: Path | None,
+    ):
+        blob = self.__blob_dir / digest
+        entry = {
+            "key": key,
+            "blob": digest,
+            "size": size,
+            "created_at": time(),
+            "attempts": 0,
+        }
+
+        with self.__condition:
+            if digest in self.__blob_refs:
+                temp_file.unlink(missing_ok=True)
+            else:
+                os.replace(temp_file, blob)
+                self.__blob_refs[digest] = 0
+                self.__size += size
+            self.__blob_refs[digest] += 1
+
+        if mirror is not None:
+            mirror.unlink(missing_ok=True)
+            try:
+                os.link(blob, mirror)
+            except OSError:
+                shutil.copyfile(blob, mirror)
+
+        self.__write_entry(entry)
+        self.__push(entry, monotonic())
+
+    def close(self):
+        """
+        Stop after in-flight uploads, queued ones stay on disk.
+        """
+        with self.__condition:
+            self.__is_closed = True
+            self.__condition.notify_all()
+        for worker in self.__workers:
+            worker.join()
+
+    def __entry_file(self, key: str) -> Path:
+        return self.__pending_dir / (
+            hashlib.sha256(key.encode()).hexdigest() + ".json"
+        )
+
+    def __write_entry(self, entry: dict):
+        entry_file = self.__entry_file(entry["key"])
+        temp_file = self.__temp_dir / f"{entry_file.name}.{uuid.uuid4().hex}"
+        with open(temp_file, "w") as f:
+            json.dump(entry, f)
+        os.replace(temp_file, entry_file)
+
+    def __push(self, entry: dict, due: float):
+        with self.__condition:
+            heapq.heappush(self.__queue, (due, next(self.__sequence), entry))
+            self.__condition.notify()
+
+    def __resume(self):
+        # Unfinished writes from a previous run
+        for temp_file in self.__temp_dir.iterdir():
+            temp_file.unlink(missing_ok=True)
+
+        now = monotonic()
+        for entry_file in self.__pending_dir.glob("*.json"):
+            try:
+                with open(entry_file, "r") as f:
+                    entry = json.load(f)
+            except:
+                logger.warning(
+                    f"Dropping unreadable spool entry: {entry_file}"
+                )
+                entry_file.unlink(missing_ok=True)
+                continue
+
+            if not (self.__blob_dir / entry["blob"]).exists():
+                logger.warning(f"Dropping spool entry without blob: {entry}")
+                entry_file.unlink(missing_ok=True)
+                continue
+
+            if entry["blob"] not in self.__blob_refs:
+                self.__blob_refs[entry["blob"]] = 0
+                self.__size += entry["size"]
+            self.__blob_refs[entry["blob"]] += 1
+            heapq.heappush(self.__queue, (now, next(self.__sequence), entry))
+
+        # Blobs no entry refers to anymore
+        for blob in self.__blob_dir.iterdir():
+            if blob.name not in self.__blob_refs:
+                blob.unlink(missing_ok=True)
+
+        if len(self.__queue) > 0:
+            logger.info(
+                f"Resuming {len(self.__queue)} spooled uploads "
+                + f"({self.__size / 1024 / 1024:.2f}MB)"
+            )
+
+    def __take(self) -> dict | None:
+        with self.__condition:
+            while True:
+                if self.__is_closed:
+                    return None
+                if len(self.__queue) > 0:
+                    due = self.__queue[0][0]
+                    if due <= monotonic():
+                        self.__uploading += 1
+                        return heapq.heappop(self.__queue)[2]
+                    self.__condition.wait(due - monotonic())
+                else:
+                    self.__condition.wait()
+
+    def __run(self):
+        while (entry := self.__take()) is not None:
+            try:
+                self.__upload(self.__blob_dir / entry["blob"], entry["key"])
+            except Exception as e:
+                entry["attempts"] += 1
+                backoff = min(
+                    self.__max_backoff, self.RETRY_BASE ** entry["attempts"]
+                )
+                logger.warning(
+                    f"Spooled upload failed ({entry['key']}), "
+                    + f"retry #{entry['attempts']} in {backoff}s: {e}"
+                )
+                logger.debug(traceback.format_exc())
+                self.__write_entry(entry)
+                self.__push(entry, monotonic() + backoff)
+                self.__done(None)
+                continue
+
+            logger.debug(f"Spooled upload done: {entry['key']}")
+            self.__entry_file(entry["key"]).unlink(missing_ok=True)
+            self.__done(entry)
+
+    def __done(self, entry: dict | None):
+        with self.__condition:
+            self.__uploading -= 1
+            if entry is None:
+                return
+
+            digest = entry["blob"]
+            self.__blob_refs[digest] -= 1
+            if self.__blob_refs[digest] > 0:
+                return
+            del self.__blob_refs[digest]
+            self.__size -= entry["size"]
+            (self.__blob_dir / digest).unlink(missing_ok=True)
@@ -0,0 +1,167 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from loguru import logger
+
+
+class R2UploadStream:
+    """
+    Writable file-like object that uploads to R2 while it is being written.
+
+    - Written bytes are cut into `part_size` parts and uploaded concurrently.
+    - At most `max_concurrency` parts are held in memory at once.
+    - Small files never start a multipart upload and are sent with one put.
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket: str,
+        key: str,
+        executor: ThreadPoolExecutor,
+        part_size: int,
+        max_concurrency: int,
+    ):
+        self.__client = client
+        self.__bucket = bucket
+        self.__key = key
+        self.__executor = executor
+        self.__part_size = part_size
+        self.__slots = threading.Semaphore(max_concurrency)
+
+        self.__buffer = bytearray()
+        self.__upload_id: str | None = None
+        self.__parts: list[Future] = []
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.complete()
+        else:
+            self.abort()
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def readable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self):
+        pass
+
+    def write(self, data) -> int:
+        self.__buffer += data
+        self.size += len(data)
+
+        while len(self.__buffer) >= self.__part_size:
+            part = bytes(self.__buffer[: self.__part_size])
+            del self.__buffer[: self.__part_size]
+            self.__upload_part(part)
+
+        return len(data)
+
+    def __upload_part(self, part: bytes):
+        if self.__upload_id is None:
+            self.__upload_id = self.__client.create_multipart_upload(
+                Bucket=self.__bucket, Key=self.__key
+            )["UploadId"]
+
+        # Wait for a free slot to keep memory bounded
+        self.__slots.acquire()
+        future = self.__executor.submit(
+            self.__client.upload_part,
+            Bucket=self.__bucket,
+            Key=self.__key,
+            UploadId=self.__upload_id,
+            PartNumber=len(self.__parts) + 1,
+            Body=part,
+        )
+        future.add_done_callback(lambda _: self.__slots.release())
+        self.__parts.append(future)
+
+    def complete(self):
+        # Not large enough for multipart
+        if self.__upload_id is None:
+            self.__client.put_object(
+                Bucket=self.__bucket,
+                Key=self.__key,
+                Body=bytes(self.__buffer),
+            )
+            self.__buffer.clear()
+            return
+
+        try:
+            if len(self.__buffer) > 0:
+                self.__upload_part(bytes(self.__buffer))
+                self.__buffer.clear()
+
+            parts = [
+                {"ETag": future.result()["ETag"], "PartNumber": index + 1}
+                for index, future in enumerate(self.__parts)
+            ]
+            self.__client.complete_multipart_upload(
+                Bucket=self.__bucket,
+                Key=self.__key,
+                UploadId=self.__upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except:
+            self.abort()
+            raise
+
+    def abort(self):
+        self.__buffer.clear()
+        if self.__upload_id is None:
+            return
+
+        for future in self.__parts:
+            future.cancel()
+        try:
+            self.__client.abort_multipart_upload(
+                Bucket=self.__bucket,
+                Key=self.__key,
+                UploadId=self.__upload_id,
+            )
+        except Exception as e:
+            logger.warning(f"Failed to abort multipart upload: {e}")
+        self.__upload_id = None
+
+
+class TeeWriter:
+    """
+    Write the same bytes to several sequential outputs.
+    """
+
+    def __init__(self, *outputs):
+        self.__outputs = outputs
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def readable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self):
+        for output in self.__outputs:
+            output.flush()
+
+    def write(self, data) -> int:
+        for output in self.__outputs:
+            output.write(data)
+        self.size += len(data)
+        return len(data)
@@ -0,0 +1,139 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from fractions import Fraction
+from typing import BinaryIO
+from PIL.Image import Image
+
+# Index up front, written by a second pass over the file by its path
+MOVFLAGS = "+faststart"
+
+# Fragmented MP4 never seeks back to write the index, but has no duration
+FRAGMENTED_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+
+class Mp4Encoder:
+    """
+    Encode frames to H.264 MP4 in a background thread while they are fed.
+
+    - Frames are converted one at a time, never held as a list of arrays.
+    - Output is written sequentially, it can be a non-seekable stream.
+    - A regular MP4 is encoded into a temporary file first and copied to
+      the output once done, a `fragmented` one is streamed as encoded.
+    - At most `QUEUE_SIZE` converted frames wait for the encoder.
+    """
+
+    QUEUE_SIZE = 4
+
+    def __init__(
+        self,
+        output: BinaryIO,
+        width: int,
+        height: int,
+        fps: float,
+        crf: int,
+        preset: str,
+        fragmented: bool = False,
+    ):
+        # yuv420p needs even dimensions
+        self.__width = width - width % 2
+        self.__height = height - height % 2
+        self.__frames: queue.Queue = queue.Queue(self.QUEUE_SIZE)
+        self.__error: Exception | None = None
+        self.__is_fed = False
+        self.__thread = threading.Thread(
+            target=self.__run,
+            args=(output, fps, crf, preset, fragmented),
+            name="mp4",
+            daemon=True,
+        )
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, image: Image):
+        import av
+
+        if self.__error is not None:
+            raise self.__error
+
+        if image.mode not in ["RGB", "RGBA"]:
+            image = image.convert("RGB")
+        frame = av.VideoFrame.from_image(image).reformat(
+            width=self.__width, height=self.__height, format="yuv420p"
+        )
+        self.__frames.put(frame)
+
+    def close(self):
+        """
+        Flush the encoder and wait for the output to be written.
+        """
+        self.__frames.put(None)
+        self.__thread.join()
+        if self.__error is not None:
+            raise self.__error
+
+    def __run(
+        self,
+        output: BinaryIO,
+        fps: float,
+        crf: int,
+        preset: str,
+        fragmented: bool,
+    ):
+        temp_path = None
+        try:
+            if fragmented:
+                self.__encode(output, fps, crf, preset, FRAGMENTED_MOVFLAGS)
+            else:
+                with tempfile.NamedTemporaryFile(
+                    suffix=".mp4", delete=False
+                ) as temp_file:
+                    temp_path = temp_file.name
+                self.__encode(temp_path, fps, crf, preset, MOVFLAGS)
+                with open(temp_path, "rb") as temp_file:
+                    shutil.copyfileobj(temp_file, output)
+
+        except Exception as e:
+            self.__error = e
+            # Keep consuming so the feeder never blocks
+            while not self.__is_fed and self.__frames.get() is not None:
+                pass
+        finally:
+            if temp_path is not None:
+                os.unlink(temp_path)
+
+    def __encode(
+        self,
+        output: BinaryIO | str,
+        fps: float,
+        crf: int,
+        preset: str,
+        movflags: str,
+    ):
+        import av
+
+        container = av.open(
+            output, mode="w", format="mp4", options={"movflags": movflags}
+        )
+        stream = container.add_stream(
+            "h264", rate=Fraction(fps).limit_denominator(1001)
+        )
+        stream.width = self.__width
+        stream.height = self.__height
+        stream.pix_fmt = "yuv420p"
+        stream.options = {"crf": str(crf), "preset": preset}
+
+        while (frame := self.__frames.get()) is not None:
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        self.__is_fed = True
+        for packet in stream.encode():
+            container.mux(packet)
+        container.close()
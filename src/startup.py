@@ -0,0 +1,36 @@
+from time import perf_counter
+from loguru import logger
+
+
+class StartupProfile:
+    """
+    Time spent in each startup step, reported once the worker is ready.
+
+    - Steps are measured from the previous mark.
+    - Warns if the total exceeds `budget` seconds.
+    """
+
+    def __init__(self):
+        self.__start = perf_counter()
+        self.__last = self.__start
+        self.__steps: list[tuple[str, float]] = []
+
+    @property
+    def total(self) -> float:
+        return self.__last - self.__start
+
+    def mark(self, step: str):
+        now = perf_counter()
+        self.__steps.append((step, now - self.__last))
+        self.__last = now
+
+    def report(self, budget: float):
+        logger.info(
+            "Startup profile: "
+            + ", ".join(f"{step} {time:.3f}s" for step, time in self.__steps)
+            + f" (total {self.total:.3f}s)"
+        )
+        if self.total > budget:
+            logger.warning(
+                f"Startup took {self.total:.3f}s, over budget of {budget}s"
+            )
@@ -1,37 +1,136 @@
-from job import api, forge_api
+from job import Job, get_backend_registry
 from loguru import logger
-from time import sleep
+from time import perf_counter
 from db import RedisDatabase
+from defines import Settings, RestartCause
+from pipeline import HealthMonitor
+import threading
+from contextlib import nullcontext
+from typing import Callable, ContextManager
 
+restart_lock = threading.Lock()
 
-def check_webui_alive():
-    try:
-        api.get_queue_status()
-        if forge_api is not None:
-            forge_api.get_queue_status()
-        return True
 
-    except Exception as e:
-        return False
+def get_backends() -> dict:
+    """
+    WebUI backends by name, as used for health and checkpoint affinity.
+    """
+    return get_backend_registry().getters
 
 
-def restart_webui(db: RedisDatabase):
-    db.update_worker_status("RESTART")
+def restart_webui(
+    db: RedisDatabase,
+    health: HealthMonitor,
+    cause: RestartCause = "COMMAND",
+    backend_names: list[str] | None = None,
+):
+    """
+    Restart the backends in `backend_names`, all by default, and wait for
+    them to come back.
+    """
+    backends = get_backends()
+    if backend_names is not None:
+        backends = {
+            name: backends[name] for name in backend_names if name in backends
+        }
+    # One restart at a time, lanes may fail together
+    with restart_lock:
+        logger.warning(f"Restarting WebUI {list(backends)} ({cause})")
+        db.record_restart(cause)
+        db.update_worker_status("RESTART")
 
-    try:
-        api.restart_server()
-        if forge_api is not None:
-            forge_api.restart_server()
-    except:
-        pass
-
-    sleep(3)  # Wait for webui to close
-
-    is_webui_running = False
-    while not is_webui_running:
-        is_webui_running = check_webui_alive()
-        if not is_webui_running:
+        # Pause claiming right away, give the webui time to go down
+        health.mark_down(
+            hold=Settings.WEBUI_RESTART_GRACE, names=list(backends)
+        )
+
+        for get_backend_api in backends.values():
+            try:
+                get_backend_api().restart_server()
+            except:
+                pass
+
+        while not health.wait_healthy(timeout=30):
             logger.info("Waiting for webui to restart...")
-            sleep(5)
 
-    logger.info("WebUI restarted")
+        registry = get_backend_registry()
+        for name in backends:
+            registry.mark_generated(name, is_backend_failure=False)
+        reset_webui_state()
+        logger.info("WebUI restarted")
+
+
+def handle_failures(
+    db: RedisDatabase,
+    health: HealthMonitor,
+    jobs: list[Job],
+    hold: Callable[[], ContextManager] = nullcontext,
+):
+    """
+    Restart the webui only when failed jobs call for it, inside `hold`.
+
+    - OOM restarts the backend it happened on.
+    - BACKEND restarts it only if it doesn't pass a health check anymore,
+      or failed `WEBUI_FAILURE_STREAK` generations in a row, a broken CUDA
+      context still answers health checks.
+    - CLIENT and TRANSIENT failures are the job's own.
+    """
+    restarted = set()
+    for cause in ["OOM", "BACKEND"]:
+        backend_names = {
+            job.backend_name
+            for job in jobs
+            if job.failure_type == cause and job.backend_name is not None
+        } - restarted
+        if cause == "BACKEND":
+            registry = get_backend_registry()
+            max_streak = Settings.WEBUI_FAILURE_STREAK
+            backend_names = {
+                name
+                for name in backend_names
+                if name in get_backends()
+                and (
+                    0 < max_streak <= registry.get_failure_streak(name)
+                    or not health.probe(name)
+                )
+            }
+        if len(backend_names) > 0:
+            with hold():
+                restart_webui(db, health, cause, sorted(backend_names))
+            restarted |= backend_names
+
+    if len(restarted) == 0:
+        logger.info(
+            "No restart needed for failures: "
+            + f"{[(job.id, job.failure_type) for job in jobs]}"
+        )
+
+
+def reset_webui_state():
+    """
+    Forget cached WebUI state after it went away and came back.
+    """
+    for get_backend_api in get_backends().values():
+        get_backend_api().invalidate_options()
+
+
+def warm_up():
+    """
+    Initialize lazily created subsystems ahead of the first job.
+    """
+    from elastic import get_elastic_client
+    from postprocess.r2 import get_r2_client
+    from postprocess.nsfw import nsfw_service
+    from job.payload import get_image_cache
+
+    time_start = perf_counter()
+    try:
+        nsfw_service.start()
+        get_image_cache()
+        get_r2_client()
+        get_elastic_client()
+        import av
+    except Exception as e:
+        logger.warning(f"Warm-up failed: {e}")
+        return
+    logger.info(f"Warm-up done in {perf_counter() - time_start:.3f}s")
@@ -1,10 +1,12 @@
 from .webuiapi import (
     WebUIApi,
     WebUIApiResult,
+    LazyImages,
     Upscaler,
     HiResUpscaler,
     b64_img,
     raw_b64_img,
+    set_image_source,
     ControlNetUnit,
 )
 
@@ -14,8 +16,10 @@ __all__ = [
     "__version__",
     "WebUIApi",
     "WebUIApiResult",
+    "LazyImages",
     "Upscaler",
     "HiResUpscaler",
     "b64_img",
+    "set_image_source",
     "ControlNetUnit",
 ]
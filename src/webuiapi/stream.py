@@ -0,0 +1,264 @@
+import asyncio
+import base64
+import codecs
+import io
+import json
+import queue
+import re
+from typing import AsyncIterable, Callable, Iterable
+
+CHUNK_SIZE = 256 * 1024
+MAX_PENDING_CHUNKS = 4
+
+_WHITESPACE = " \t\r\n"
+_STRING_SPECIAL = re.compile(r'["\\]')
+_VALUE_SPECIAL = re.compile(r'["\\\[\]{},]')
+_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+
+class _Base64Sink:
+    """
+    Decode base64 text as it arrives, keeping only the decoded bytes.
+    """
+
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.__output = io.BytesIO()
+        self.__pending = ""
+
+    def write(self, text: str):
+        self.__pending += text
+        if len(self.__pending) < self.BLOCK_SIZE:
+            return
+        size = len(self.__pending) // 4 * 4
+        self.__output.write(base64.b64decode(self.__pending[:size]))
+        self.__pending = self.__pending[size:]
+
+    def getvalue(self) -> bytes:
+        if self.__pending:
+            self.__output.write(base64.b64decode(self.__pending))
+            self.__pending = ""
+        return self.__output.getvalue()
+
+
+class _TextStream:
+    def __init__(self, chunks: Iterable[bytes]):
+        self.__chunks = iter(chunks)
+        self.__decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+
+    def fill(self) -> bool:
+        """
+        Drop consumed text and append the next chunk, False at the end.
+        """
+        for chunk in self.__chunks:
+            text = self.__decoder.decode(chunk)
+            if text:
+                self.buffer = self.buffer[self.pos :] + text
+                self.pos = 0
+                return True
+
+        text = self.__decoder.decode(b"", final=True)
+        if text:
+            self.buffer = self.buffer[self.pos :] + text
+            self.pos = 0
+            return True
+        return False
+
+    def fill_or_raise(self):
+        if not self.fill():
+            raise ValueError("Unexpected end of JSON response")
+
+    def peek(self) -> str:
+        """
+        Return the next non-whitespace char without consuming it.
+        """
+        while True:
+            while (
+                self.pos < len(self.buffer)
+                and self.buffer[self.pos] in _WHITESPACE
+            ):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            self.fill_or_raise()
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected '{char}' but found '{found}'")
+        self.pos += 1
+
+    def read_string(self, sink: Callable[[str], None]):
+        """
+        Read a string value, unescaped text is passed to `sink` in pieces.
+        """
+        self.expect('"')
+        while True:
+            match = _STRING_SPECIAL.search(self.buffer, self.pos)
+            if match is None:
+                sink(self.buffer[self.pos :])
+                self.pos = len(self.buffer)
+                self.fill_or_raise()
+                continue
+
+            sink(self.buffer[self.pos : match.start()])
+            self.pos = match.end()
+            if match.group() == '"':
+                return
+
+            # Escape sequence
+            while len(self.buffer) - self.pos < 5:
+                if not self.fill():
+                    break
+            escape = self.buffer[self.pos : self.pos + 1]
+            if escape == "u":
+                sink(chr(int(self.buffer[self.pos + 1 : self.pos + 5], 16)))
+                self.pos += 5
+            elif escape in _ESCAPES:
+                sink(_ESCAPES[escape])
+                self.pos += 1
+            else:
+                raise ValueError(f"Invalid escape '\\{escape}'")
+
+    def read_raw_value(self) -> str:
+        """
+        Return the raw JSON text of the next value inside an object/array.
+        """
+        self.peek()
+        parts = []
+        depth = 0
+        is_in_string = False
+        while True:
+            pattern = _STRING_SPECIAL if is_in_string else _VALUE_SPECIAL
+            match = pattern.search(self.buffer, self.pos)
+            if match is None:
+                parts.append(self.buffer[self.pos :])
+                self.pos = len(self.buffer)
+                self.fill_or_raise()
+                continue
+
+            char = match.group()
+            end = match.end()
+
+            if is_in_string:
+                if char == '"':
+                    is_in_string = False
+                elif end < len(self.buffer):
+                    end += 1
+                else:
+                    # Escaped char is in the next chunk
+                    parts.append(self.buffer[self.pos : end])
+                    self.pos = end
+                    self.fill_or_raise()
+                    end = 1
+            elif char == '"':
+                is_in_string = True
+            elif char in "[{":
+                depth += 1
+            elif depth > 0 and char in "]}":
+                depth -= 1
+            elif depth == 0 and char in ",]}":
+                # End of value, leave the delimiter
+                parts.append(self.buffer[self.pos : match.start()])
+                self.pos = match.start()
+                return "".join(parts)
+
+            parts.append(self.buffer[self.pos : end])
+            self.pos = end
+
+    def read_base64(self) -> bytes:
+        sink = _Base64Sink()
+        self.read_string(sink.write)
+        return sink.getvalue()
+
+
+def parse_response(
+    chunks: Iterable[bytes], image_keys: Iterable[str] = ("images", "image")
+) -> dict:
+    """
+    Parse a JSON object response incrementally.
+
+    Base64 strings under `image_keys` are decoded to bytes while streamed,
+    so the encoded text is never held as a whole. Other values are parsed
+    with `json` as usual.
+    """
+    stream = _TextStream(chunks)
+    result = {}
+
+    stream.expect("{")
+    if stream.peek() == "}":
+        return result
+
+    while True:
+        key_parts = []
+        stream.read_string(key_parts.append)
+        key = "".join(key_parts)
+        stream.expect(":")
+
+        token = stream.peek()
+        if key in image_keys and token == '"':
+            result[key] = stream.read_base64()
+        elif key in image_keys and token == "[":
+            stream.pos += 1
+            images = []
+            while stream.peek() != "]":
+                if len(images) > 0:
+                    stream.expect(",")
+                images.append(stream.read_base64())
+            stream.pos += 1
+            result[key] = images
+        else:
+            result[key] = json.loads(stream.read_raw_value())
+
+        token = stream.peek()
+        stream.pos += 1
+        if token == "}":
+            return result
+        if token != ",":
+            raise ValueError(f"Expected ',' or '}}' but found '{token}'")
+
+
+async def parse_response_async(
+    chunks: AsyncIterable[bytes],
+    image_keys: Iterable[str] = ("images", "image"),
+) -> dict:
+    """
+    Async version of `parse_response`, parsing in a worker thread while
+    chunks arrive.
+
+    At most `MAX_PENDING_CHUNKS` chunks wait for the parser, the rest of
+    the body stays in the connection.
+    """
+    loop = asyncio.get_running_loop()
+    pending = queue.Queue(MAX_PENDING_CHUNKS)
+
+    def parse() -> dict:
+        source = iter(pending.get, None)
+        try:
+            return parse_response(source, image_keys)
+        finally:
+            # Keep taking chunks until the end, the reader may be waiting
+            for _ in source:
+                pass
+
+    parsing = loop.run_in_executor(None, parse)
+    try:
+        async for chunk in chunks:
+            if parsing.done():
+                break
+            await loop.run_in_executor(None, pending.put, chunk)
+    finally:
+        await loop.run_in_executor(None, pending.put, None)
+    return await parsing
@@ -5,7 +5,12 @@ import base64
 from PIL import Image, PngImagePlugin
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Literal
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from .stream import parse_response, parse_response_async, CHUNK_SIZE
 
 
 class Upscaler(str, Enum):
@@ -38,6 +43,62 @@ class HiResUpscaler(str, Enum):
     SwinIR_4x = "SwinIR 4x"
 
 
+DecodeMode = Literal["eager", "lazy", "parallel"]
+
+
+class LazyImages(Sequence):
+    """
+    Result images kept as encoded bytes (or base64 text) and decoded on first
+    access. `decode_all` decodes the remaining ones across a thread pool.
+    """
+
+    def __init__(self, sources: list, max_workers: int = 4):
+        self.__entries = list(sources)
+        self.__max_workers = max_workers
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __getitem__(self, index):
+        # Slices stay lazy and share already decoded frames
+        if isinstance(index, slice):
+            return LazyImages(self.__entries[index], self.__max_workers)
+
+        entry = self.__entries[index]
+        if isinstance(entry, Image.Image):
+            return entry
+        return self.__decode(index % len(self.__entries))
+
+    def __decode(self, index: int) -> Image.Image:
+        entry = self.__entries[index]
+        if isinstance(entry, Image.Image):
+            return entry
+
+        data = base64.b64decode(entry) if isinstance(entry, str) else entry
+        image = Image.open(io.BytesIO(data))
+        image.load()
+
+        # Release the encoded data
+        self.__entries[index] = image
+        return image
+
+    def decode_all(self):
+        pending = [
+            index
+            for index, entry in enumerate(self.__entries)
+            if not isinstance(entry, Image.Image)
+        ]
+        if len(pending) > 1:
+            with ThreadPoolExecutor(
+                min(len(pending), self.__max_workers),
+                thread_name_prefix="decode",
+            ) as executor:
+                list(executor.map(self.__decode, pending))
+        elif len(pending) == 1:
+            self.__decode(pending[0])
+        return self
+
+
 @dataclass
 class WebUIApiResult:
     images: list
@@ -200,24 +261,76 @@ class ControlNetUnit:
         return payload
 
 
+# Formats the WebUI decodes as-is, sent without re-encoding
+PASSTHROUGH_FORMATS = ["PNG", "JPEG", "WEBP"]
+
+# EXIF tag the WebUI rotates inputs by when decoding them
+EXIF_ORIENTATION = 0x0112
+
+
+def set_image_source(image: Image, data: bytes, b64: str | None = None):
+    """
+    Remember the encoded bytes (and base64 if known) an image was decoded
+    from, so it is sent back as-is while its mode and size are unchanged.
+    Images must not be drawn on in place after this.
+
+    - Images with an EXIF orientation are re-encoded, the WebUI would
+      rotate the original bytes away from their masks and size.
+    """
+    if image.getexif().get(EXIF_ORIENTATION, 1) != 1:
+        return
+    image._webuiapi_source = (data, b64, image.format, image.mode, image.size)
+
+
+def _encode_img(image: Image) -> tuple[str, str]:
+    """
+    Return (format, base64) of an image, memoized per image object.
+    """
+    state = (image.mode, image.size)
+    cached = getattr(image, "_webuiapi_b64", None)
+    if cached is not None and cached[0] == state:
+        return cached[1], cached[2]
+
+    # Reuse original bytes if untouched
+    source = getattr(image, "_webuiapi_source", None)
+    if (
+        source is not None
+        and source[2] in PASSTHROUGH_FORMATS
+        and source[3:] == state
+    ):
+        data, b64, fmt, _, _ = source
+        if b64 is None:
+            b64 = str(base64.b64encode(data), "utf-8")
+    else:
+        with io.BytesIO() as output_bytes:
+            metadata = None
+            for key, value in image.info.items():
+                if isinstance(key, str) and isinstance(value, str):
+                    if metadata is None:
+                        metadata = PngImagePlugin.PngInfo()
+                    metadata.add_text(key, value)
+            # Fast compression, size does not matter on the local wire
+            image.save(
+                output_bytes, format="PNG", pnginfo=metadata, compress_level=1
+            )
+
+            bytes_data = output_bytes.getvalue()
+
+        fmt = "PNG"
+        b64 = str(base64.b64encode(bytes_data), "utf-8")
+
+    image._webuiapi_b64 = (state, fmt, b64)
+    return fmt, b64
+
+
 def b64_img(image: Image) -> str:
-    return "data:image/png;base64," + raw_b64_img(image)
+    fmt, b64 = _encode_img(image)
+    return f"data:image/{fmt.lower()};base64," + b64
 
 
 def raw_b64_img(image: Image) -> str:
     # XXX controlnet only accepts RAW base64 without headers
-    with io.BytesIO() as output_bytes:
-        metadata = None
-        for key, value in image.info.items():
-            if isinstance(key, str) and isinstance(value, str):
-                if metadata is None:
-                    metadata = PngImagePlugin.PngInfo()
-                metadata.add_text(key, value)
-        image.save(output_bytes, format="PNG", pnginfo=metadata)
-
-        bytes_data = output_bytes.getvalue()
-
-    return str(base64.b64encode(bytes_data), "utf-8")
+    return _encode_img(image)[1]
 
 
 class WebUIApi:
@@ -231,6 +344,11 @@ class WebUIApi:
         use_https=False,
         username=None,
         password=None,
+        decode_mode: DecodeMode = "lazy",
+        decode_workers=4,
+        async_timeout=600,
+        async_connections=8,
+        options_ttl=300,
     ):
         if baseurl is None:
             if use_https:
@@ -244,28 +362,69 @@ class WebUIApi:
         self.baseurl = baseurl
         self.default_sampler = sampler
         self.default_steps = steps
+        self.decode_mode = decode_mode
+        self.decode_workers = decode_workers
 
         self.session = requests.Session()
 
+        # Shared aiohttp session, created on first async call
+        self.async_timeout = async_timeout
+        self.async_connections = async_connections
+        self.__async_session = None
+        self.__async_loop = None
+
+        # Known WebUI options, see `set_options`
+        self.options_ttl = options_ttl
+        self.options_stats = {"applied": 0, "skipped": 0, "refreshed": 0}
+        self.__options = {}
+        self.__is_options_complete = False
+        self.__options_time = 0.0
+        self.__sd_models = None
+        self.__sd_models_time = 0.0
+
         if username and password:
             self.set_auth(username, password)
 
     def set_auth(self, username, password):
         self.session.auth = (username, password)
 
+    def _to_images(self, sources: list) -> LazyImages:
+        images = LazyImages(sources, self.decode_workers)
+        if self.decode_mode == "parallel":
+            images.decode_all()
+        elif self.decode_mode == "eager":
+            for image in images:
+                pass
+        return images
+
     def _to_api_result(self, response):
-        if response.status_code != 200:
-            raise RuntimeError(response.status_code, response.text)
+        # Decode images while the body streams in, see `parse_response`
+        try:
+            if response.status_code != 200:
+                raise RuntimeError(response.status_code, response.text)
+
+            r = parse_response(response.iter_content(CHUNK_SIZE))
+        finally:
+            response.close()
+
+        return self._build_api_result(r)
 
-        r = response.json()
+    async def _to_api_result_async(self, response):
+        if response.status != 200:
+            raise RuntimeError(response.status, await response.text())
+
+        # Decode images while the body streams in, see `parse_response_async`
+        r = await parse_response_async(
+            response.content.iter_chunked(CHUNK_SIZE)
+        )
+        return self._build_api_result(r)
+
+    def _build_api_result(self, r: dict):
         images = []
         if "images" in r.keys():
-            images = [
-                Image.open(io.BytesIO(base64.b64decode(i)))
-                for i in r["images"]
-            ]
+            images = self._to_images(r["images"])
         elif "image" in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(r["image"])))]
+            images = self._to_images([r["image"]])
 
         info = {}
         if "info" in r.keys():
@@ -290,36 +449,73 @@ class WebUIApi:
 
         return WebUIApiResult(images, parameters, info)
 
-    async def _to_api_result_async(self, response):
-        if response.status != 200:
-            raise RuntimeError(response.status, await response.text())
-
-        r = await response.json()
-        images = []
-        if "images" in r.keys():
-            images = [
-                Image.open(io.BytesIO(base64.b64decode(i)))
-                for i in r["images"]
-            ]
-        elif "image" in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(r["image"])))]
-
-        info = ""
-        if "info" in r.keys():
-            try:
-                info = json.loads(r["info"])
-            except:
-                info = r["info"]
-        elif "html_info" in r.keys():
-            info = r["html_info"]
-        elif "caption" in r.keys():
-            info = r["caption"]
-
-        parameters = ""
-        if "parameters" in r.keys():
-            parameters = r["parameters"]
-
-        return WebUIApiResult(images, parameters, info)
+    async def _get_async_session(self):
+        import asyncio
+        import aiohttp
+
+        # Sessions are bound to the loop they were created in
+        loop = asyncio.get_running_loop()
+        if (
+            self.__async_session is None
+            or self.__async_session.closed
+            or self.__async_loop is not loop
+        ):
+            await self.__close_stale_async_session()
+            auth = None
+            if self.session.auth:
+                auth = aiohttp.BasicAuth(*self.session.auth)
+            self.__async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.async_connections),
+                auth=auth,
+            )
+            self.__async_loop = loop
+        return self.__async_session
+
+    async def __close_stale_async_session(self):
+        """
+        Close the session of a previous loop before it is replaced.
+        """
+        import asyncio
+
+        session = self.__async_session
+        loop = self.__async_loop
+        self.__async_session = None
+        if session is None or session.closed:
+            return
+        try:
+            if loop.is_running():
+                # Still running in another thread, close it there
+                await asyncio.wrap_future(
+                    asyncio.run_coroutine_threadsafe(session.close(), loop)
+                )
+            else:
+                # Connections of a closed loop are only dropped
+                await session.close()
+        except Exception:
+            session.detach()
+
+    async def async_request(self, method, url, json=None, timeout=None):
+        """
+        Send a request on the shared async session and return its JSON.
+        Cancelling the awaiting task aborts the request.
+        """
+        import aiohttp
+
+        session = await self._get_async_session()
+        async with session.request(
+            method,
+            url,
+            json=json,
+            timeout=aiohttp.ClientTimeout(total=timeout or self.async_timeout),
+        ) as response:
+            if response.status != 200:
+                raise RuntimeError(response.status, await response.text())
+            return await response.json()
+
+    async def aclose(self):
+        if self.__async_session is not None:
+            await self.__async_session.close()
+            self.__async_session = None
 
     def txt2img(
         self,
@@ -445,19 +641,35 @@ class WebUIApi:
         if distilled_cfg_scale is not None:
             payload["distilled_cfg_scale"] = distilled_cfg_scale
 
+        # Options overridden for good are no longer known
+        if not override_settings_restore_afterwards:
+            self.__forget_options(override_settings.keys())
+
         return self.post_and_get_api_result(
             f"{self.baseurl}/txt2img", payload, use_async
         )
 
     def post_and_get_api_result(self, url, json, use_async):
         if use_async:
-            raise RuntimeError("use_async is not supported yet")
+            return self.async_post(url=url, json=json)
         else:
-            response = self.session.post(url=url, json=json)
+            response = self.session.post(url=url, json=json, stream=True)
             return self._to_api_result(response)
 
-    async def async_post(self, url, json):
-        return
+    async def async_post(self, url, json, timeout=None):
+        """
+        Async version of `post_and_get_api_result`.
+        Cancelling the awaiting task aborts the request.
+        """
+        import aiohttp
+
+        session = await self._get_async_session()
+        async with session.post(
+            url,
+            json=json,
+            timeout=aiohttp.ClientTimeout(total=timeout or self.async_timeout),
+        ) as response:
+            return await self._to_api_result_async(response)
 
     def img2img(
         self,
@@ -591,6 +803,10 @@ class WebUIApi:
         if distilled_cfg_scale is not None:
             payload["distilled_cfg_scale"] = distilled_cfg_scale
 
+        # Options overridden for good are no longer known
+        if not override_settings_restore_afterwards:
+            self.__forget_options(override_settings.keys())
+
         return self.post_and_get_api_result(
             f"{self.baseurl}/img2img", payload, use_async
         )
@@ -692,7 +908,7 @@ class WebUIApi:
         }
 
         response = self.session.post(
-            url=f"{self.baseurl}/png-info", json=payload
+            url=f"{self.baseurl}/png-info", json=payload, stream=True
         )
         return self._to_api_result(response)
 
@@ -701,7 +917,7 @@ class WebUIApi:
     :param model "clip" or "deepdanbooru"
     """
 
-    def interrogate(self, image, model="clip"):
+    def interrogate(self, image, model="clip", use_async=False):
         payload = {
             "image": b64_img(image)
             if isinstance(image, Image.Image)
@@ -709,8 +925,13 @@ class WebUIApi:
             "model": model,
         }
 
+        if use_async:
+            return self.async_post(
+                url=f"{self.baseurl}/interrogate", json=payload
+            )
+
         response = self.session.post(
-            url=f"{self.baseurl}/interrogate", json=payload
+            url=f"{self.baseurl}/interrogate", json=payload, stream=True
         )
         return self._to_api_result(response)
 
@@ -720,7 +941,7 @@ class WebUIApi:
             "generateType": generateType,
         }
         response = self.session.post(
-            url=f"{self.rooturl}/moonland/promptgen", json=payload
+            url=f"{self.rooturl}/moonland/promptgen", json=payload, stream=True
         )
         return self._to_api_result(response)
 
@@ -732,21 +953,96 @@ class WebUIApi:
         response = self.session.post(url=f"{self.baseurl}/skip")
         return response.json()
 
-    def get_options(self):
+    def invalidate_options(self):
+        """
+        Forget cached options and models, e.g. after the WebUI restarted.
+        """
+        self.__options = {}
+        self.__is_options_complete = False
+        self.__options_time = 0.0
+        self.__sd_models = None
+
+    def __is_options_fresh(self):
+        return monotonic() - self.__options_time < self.options_ttl
+
+    def __remember_options(self, options: dict):
+        if not self.__is_options_fresh():
+            self.__options = {}
+            self.__is_options_complete = False
+        self.__options.update(options)
+        self.__options_time = monotonic()
+
+    def __forget_options(self, keys):
+        for key in keys:
+            self.__options.pop(key, None)
+        self.__is_options_complete = False
+
+    def get_options(self, use_cache=False):
+        if (
+            use_cache
+            and self.__is_options_complete
+            and self.__is_options_fresh()
+        ):
+            return dict(self.__options)
+
         response = self.session.get(url=f"{self.baseurl}/options")
-        return response.json()
+        options = response.json()
+        if response.status_code == 200:
+            self.__options = dict(options)
+            self.__is_options_complete = True
+            self.__options_time = monotonic()
+            self.options_stats["refreshed"] += 1
+        return options
+
+    def set_options(self, options, use_async=False):
+        """
+        Send only options that differ from the known WebUI state.
+
+        - Known state comes from previous calls and expires after
+          `options_ttl` seconds or `invalidate_options`.
+        - Returns None without a request if nothing changed.
+        """
+        if self.__is_options_fresh():
+            options = {
+                key: value
+                for key, value in options.items()
+                if key not in self.__options or self.__options[key] != value
+            }
+        if len(options) == 0:
+            self.options_stats["skipped"] += 1
+            return self.__skip_async() if use_async else None
+
+        self.options_stats["applied"] += 1
+        if use_async:
+            return self.__set_options_async(options)
 
-    def set_options(self, options):
         response = self.session.post(
             url=f"{self.baseurl}/options", json=options
         )
+        if response.status_code == 200:
+            self.__remember_options(options)
         return response.json()
 
+    async def __set_options_async(self, options):
+        result = await self.async_request(
+            "POST", f"{self.baseurl}/options", json=options
+        )
+        self.__remember_options(options)
+        return result
+
+    async def __skip_async(self):
+        return None
+
     def get_cmd_flags(self):
         response = self.session.get(url=f"{self.baseurl}/cmd-flags")
         return response.json()
 
-    def get_progress(self):
+    def get_progress(self, use_async=False):
+        if use_async:
+            return self.async_request(
+                "GET", f"{self.baseurl}/progress", timeout=30
+            )
+
         response = self.session.get(url=f"{self.baseurl}/progress")
         return response.json()
 
@@ -770,9 +1066,20 @@ class WebUIApi:
         response = self.session.get(url=f"{self.baseurl}/loras")
         return response.json()
 
-    def get_sd_models(self):
+    def get_sd_models(self, use_cache=False):
+        if (
+            use_cache
+            and self.__sd_models is not None
+            and monotonic() - self.__sd_models_time < self.options_ttl
+        ):
+            return self.__sd_models
+
         response = self.session.get(url=f"{self.baseurl}/sd-models")
-        return response.json()
+        sd_models = response.json()
+        if response.status_code == 200:
+            self.__sd_models = sd_models
+            self.__sd_models_time = monotonic()
+        return sd_models
 
     def get_hypernetworks(self):
         response = self.session.get(url=f"{self.baseurl}/hypernetworks")
@@ -799,6 +1106,7 @@ class WebUIApi:
         return response.json()
 
     def refresh_checkpoints(self):
+        self.__sd_models = None
         response = self.session.post(url=f"{self.baseurl}/refresh-checkpoints")
         return response.json()
 
@@ -841,7 +1149,7 @@ class WebUIApi:
                 self.async_post(url=url, json=payload)
             )
         else:
-            response = self.session.post(url=url, json=payload)
+            response = self.session.post(url=url, json=payload, stream=True)
             return self._to_api_result(response)
 
     def controlnet_version(self):
@@ -863,6 +1171,7 @@ class WebUIApi:
         processor_res=512,
         threshold_a=64,
         threshold_b=64,
+        use_async=False,
     ):
         input_images = [b64_img(x) for x in images]
         payload = {
@@ -872,7 +1181,9 @@ class WebUIApi:
             "controlnet_threshold_a": threshold_a,
             "controlnet_threshold_b": threshold_b,
         }
-        r = self.custom_post("controlnet/detect", payload=payload)
+        r = self.custom_post(
+            "controlnet/detect", payload=payload, use_async=use_async
+        )
         return r
 
     def util_get_model_names(self):
@@ -909,11 +1220,11 @@ class WebUIApi:
             print("model not found")
 
     def util_get_current_model(self):
-        options = self.get_options()
+        options = self.get_options(use_cache=True)
         if "sd_model_checkpoint" in options:
             return options["sd_model_checkpoint"]
         else:
-            sd_models = self.get_sd_models()
+            sd_models = self.get_sd_models(use_cache=True)
             sd_model = [
                 model
                 for model in sd_models
@@ -937,21 +1248,25 @@ class WebUIApi:
                 time.sleep(check_interval)
 
     # Connector implementation
-    def get_queue_status(self):
+    def get_queue_status(self, timeout=None):
         response = self.session.get(
             url=f"{self.baseurl}/queue/status",
             headers={"Cache-Control": "no-cache"},
+            timeout=timeout,
         )
         return response.json()
 
     def restart_server(self):
+        self.invalidate_options()
         response = self.session.post(url=f"{self.baseurl}/server-restart")
         return response.json()
 
     def stop_server(self):
+        self.invalidate_options()
         response = self.session.post(url=f"{self.baseurl}/server-stop")
         return response.json()
 
     def kill_server(self):
+        self.invalidate_options()
         response = self.session.post(url=f"{self.baseurl}/server-kill")
         return response.json()
@@ -0,0 +1,16 @@
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+
+# Settings the worker refuses to start without
+for key in [
+    "R2_ENDPOINT_URL",
+    "R2_BUCKET_NAME",
+    "R2_PUBLIC_URL",
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+]:
+    os.environ.setdefault(key, "test")
+
+sys.path.insert(0, SRC_DIR)
@@ -0,0 +1,153 @@
+import json
+from datetime import datetime, timedelta, timezone
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import db
+from db import RedisDatabase
+from defines import Settings
+from job.registry import BackendRegistry, WebUIBackend
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(Settings, "WORKER_NAME", "test")
+    monkeypatch.setattr(db.redis, "Redis", lambda **_: client)
+    return client
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = BackendRegistry(
+        [WebUIBackend("a1111", "localhost", 7860, is_flux=False)]
+    )
+    monkeypatch.setattr(db, "get_backend_registry", lambda: registry)
+    return registry
+
+
+def load_checkpoint(registry: BackendRegistry, checkpoint: str):
+    with registry.use("a1111", checkpoint):
+        pass
+
+
+def push_job(
+    client,
+    job_id: str,
+    checkpoint: str | None = None,
+    created_at: str | None = None,
+    metadata: str | None = None,
+    queue_key: str = "queue",
+):
+    payload = {"prompt": job_id}
+    if checkpoint is not None:
+        payload["override_settings"] = {"sd_model_checkpoint": checkpoint}
+    if created_at is None:
+        created_at = datetime.now(timezone.utc).isoformat()
+    fields = {
+        "type": "TXT2IMG",
+        "payload": json.dumps(payload),
+        "format": "WEBP",
+        "status": "PENDING",
+        "created_at": created_at,
+    }
+    if metadata is not None:
+        fields["metadata"] = metadata
+    client.hset(job_id, mapping=fields)
+    client.rpush(queue_key, job_id)
+
+
+def test_claim_next(client, monkeypatch):
+    monkeypatch.setattr(Settings, "AFFINITY_WINDOW", 1)
+    database = RedisDatabase()
+    push_job(client, "job_a")
+    push_job(client, "job_b")
+
+    signal, job, key = database.wait_signal()
+
+    assert (signal, job.id, key) == ("JOB", "job_a", "queue")
+    assert client.hget("job_a", "status") == "PROCESSING"
+    assert client.hget("job_a", "worker") == Settings.WORKER_INFO
+    assert client.lrange("queue", 0, -1) == ["job_b"]
+
+
+def test_claim_next_takes_command_first(client, monkeypatch):
+    monkeypatch.setattr(Settings, "AFFINITY_WINDOW", 1)
+    database = RedisDatabase()
+    push_job(client, "job_a")
+    client.rpush("command_test", "RESTART")
+
+    assert database.wait_signal()[:2] == ("COMMAND", "RESTART")
+    assert client.lrange("queue", 0, -1) == ["job_a"]
+
+
+def test_pick_loaded_checkpoint(client, registry, monkeypatch):
+    monkeypatch.setattr(Settings, "AFFINITY_WINDOW", 8)
+    database = RedisDatabase()
+    load_checkpoint(registry, "sdxl")
+    push_job(client, "job_a", checkpoint="flux")
+    push_job(client, "job_b", checkpoint="sdxl")
+
+    _, job, _ = database.wait_signal()
+
+    assert job.id == "job_b"
+    assert client.hget("job_b", "status") == "PROCESSING"
+    assert client.lrange("queue", 0, -1) == ["job_a"]
+
+
+def test_pick_aged_head(client, registry, monkeypatch):
+    monkeypatch.setattr(Settings, "AFFINITY_WINDOW", 8)
+    database = RedisDatabase()
+    load_checkpoint(registry, "sdxl")
+    created_at = datetime.now(timezone.utc) - timedelta(
+        seconds=Settings.AFFINITY_MAX_WAIT + 1
+    )
+    push_job(
+        client, "job_a", checkpoint="flux", created_at=created_at.isoformat()
+    )
+    push_job(client, "job_b", checkpoint="sdxl")
+
+    assert database.wait_signal()[1].id == "job_a"
+
+
+@pytest.mark.parametrize("accept", [None, lambda requirements: True])
+@pytest.mark.parametrize(
+    "fields",
+    [
+        {"created_at": "2024-01-01T00:00:00"},
+        {"created_at": "yesterday"},
+        {"metadata": "{"},
+    ],
+)
+def test_pick_fails_unparsable_head(
+    client, registry, monkeypatch, accept, fields
+):
+    monkeypatch.setattr(Settings, "AFFINITY_WINDOW", 8)
+    database = RedisDatabase()
+    load_checkpoint(registry, "sdxl")
+    push_job(client, "job_a", checkpoint="flux", **fields)
+    push_job(client, "job_b", checkpoint="sdxl")
+
+    assert database.wait_signal(accept=accept) == ("JOB", None, "queue")
+    assert client.hget("job_a", "status") == "FAILED"
+    assert client.lrange("queue", 0, -1) == ["job_b"]
+
+
+@pytest.mark.parametrize("affinity_window", [0, 1])
+def test_lane_scan_window(client, registry, monkeypatch, affinity_window):
+    monkeypatch.setattr(Settings, "AFFINITY_WINDOW", affinity_window)
+    monkeypatch.setattr(Settings, "LANE_WINDOW", 2)
+    database = RedisDatabase()
+    load_checkpoint(registry, "sdxl")
+    push_job(client, "job_a", checkpoint="flux")
+    push_job(client, "job_b", checkpoint="anime")
+    push_job(client, "job_c", checkpoint="flux")
+    push_job(client, "job_d", checkpoint="sdxl")
+
+    def accept(requirements):
+        return "flux" not in requirements["checkpoints"]
+
+    assert database.wait_signal(accept=accept)[1].id == "job_b"
+    assert database.wait_signal(accept=accept, timeout=1) is None
+    assert client.lrange("queue", 0, -1) == ["job_a", "job_c", "job_d"]
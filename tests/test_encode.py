@@ -0,0 +1,46 @@
+import base64
+from io import BytesIO
+from PIL import Image
+from webuiapi import b64_img, set_image_source
+from webuiapi.webuiapi import EXIF_ORIENTATION
+
+
+def new_jpeg(orientation: int | None) -> bytes:
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[EXIF_ORIENTATION] = orientation
+    with BytesIO() as output:
+        Image.new("RGB", (64, 32), "red").save(
+            output, format="JPEG", exif=exif
+        )
+        return output.getvalue()
+
+
+def load(data: bytes) -> Image.Image:
+    image = Image.open(BytesIO(data))
+    image.load()
+    set_image_source(image, data)
+    return image
+
+
+def decode(b64: str) -> Image.Image:
+    _, _, b64 = b64.partition(";base64,")
+    return Image.open(BytesIO(base64.b64decode(b64)))
+
+
+def test_upright_jpeg_is_sent_as_is():
+    for orientation in [None, 1]:
+        data = new_jpeg(orientation)
+
+        assert b64_img(load(data)) == (
+            "data:image/jpeg;base64," + base64.b64encode(data).decode()
+        )
+
+
+def test_oriented_jpeg_is_reencoded_without_exif():
+    encoded = b64_img(load(new_jpeg(6)))
+
+    assert encoded.startswith("data:image/png;base64,")
+    image = decode(encoded)
+    assert image.size == (64, 32)
+    assert image.getexif().get(EXIF_ORIENTATION, 1) == 1
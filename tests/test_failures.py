@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+import utils
+from job import classify_failure
+
+
+def failed_job(_id: str, backend_name: str, failure_type: str):
+    return SimpleNamespace(
+        id=_id, backend_name=backend_name, failure_type=failure_type
+    )
+
+
+def handle_failures(
+    monkeypatch,
+    jobs,
+    down: set[str],
+    streaks: dict[str, int] = {},
+    **kwargs,
+) -> list[tuple]:
+    restarts = []
+    monkeypatch.setattr(
+        utils, "get_backends", lambda: {"a1111": None, "forge": None}
+    )
+    monkeypatch.setattr(
+        utils,
+        "get_backend_registry",
+        lambda: SimpleNamespace(
+            get_failure_streak=lambda name: streaks.get(name, 0)
+        ),
+    )
+    monkeypatch.setattr(
+        utils,
+        "restart_webui",
+        lambda db, health, cause, names: restarts.append((cause, names)),
+    )
+    health = SimpleNamespace(probe=lambda name: name not in down)
+    utils.handle_failures(None, health, jobs, **kwargs)
+    return restarts
+
+
+def test_oom_and_backend_failures_both_restart(monkeypatch):
+    jobs = [
+        failed_job("a", "a1111", "OOM"),
+        failed_job("b", "forge", "BACKEND"),
+    ]
+
+    restarts = handle_failures(monkeypatch, jobs, down={"forge"})
+
+    assert restarts == [("OOM", ["a1111"]), ("BACKEND", ["forge"])]
+
+
+def test_backend_failure_of_healthy_backend_is_not_restarted(monkeypatch):
+    jobs = [
+        failed_job("a", "a1111", "BACKEND"),
+        failed_job("b", "forge", "CLIENT"),
+    ]
+
+    assert handle_failures(monkeypatch, jobs, down=set()) == []
+
+
+def test_backend_failing_in_a_row_is_restarted(monkeypatch):
+    jobs = [failed_job("a", "a1111", "BACKEND")]
+    streak = utils.Settings.WEBUI_FAILURE_STREAK
+
+    assert (
+        handle_failures(
+            monkeypatch, jobs, down=set(), streaks={"a1111": streak - 1}
+        )
+        == []
+    )
+    assert handle_failures(
+        monkeypatch, jobs, down=set(), streaks={"a1111": streak}
+    ) == [("BACKEND", ["a1111"])]
+
+
+def test_backend_restarts_once(monkeypatch):
+    jobs = [
+        failed_job("a", "a1111", "OOM"),
+        failed_job("b", "a1111", "BACKEND"),
+    ]
+
+    restarts = handle_failures(monkeypatch, jobs, down={"a1111"})
+
+    assert restarts == [("OOM", ["a1111"])]
+
+
+def test_restart_inside_hold(monkeypatch):
+    events = []
+
+    @contextmanager
+    def hold():
+        events.append("hold")
+        yield
+        events.append("release")
+
+    restarts = handle_failures(
+        monkeypatch,
+        [failed_job("a", "a1111", "OOM")],
+        down=set(),
+        hold=hold,
+    )
+
+    assert events == ["hold", "release"]
+    assert restarts == [("OOM", ["a1111"])]
+
+
+def test_oom_only_on_backend():
+    for error in [MemoryError(), Exception("CUDA out of memory")]:
+        assert classify_failure(error, is_backend=True) == "OOM"
+        assert classify_failure(error) == "CLIENT"
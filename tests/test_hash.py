@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+blurhash = pytest.importorskip("blurhash")
+
+from postprocess.hash import encode_blurhashes
+from postprocess.hash.benchmark import encode_reference, make_images
+from postprocess.hash.encoder import encode_pixels
+
+
+@pytest.mark.parametrize("size", [(64, 64), (48, 32), (17, 9), (1, 1)])
+@pytest.mark.parametrize("components", [(1, 1), (4, 4), (4, 3), (9, 9)])
+def test_hashes_match_reference(size, components):
+    rng = np.random.default_rng(sum(size))
+    pixels = rng.integers(
+        0, 256, size=(3, size[1], size[0], 3), dtype=np.uint8
+    )
+
+    hashes = encode_pixels(pixels, *components)
+
+    assert hashes == [
+        blurhash.encode(Image.fromarray(image, "RGB"), *components)
+        for image in pixels
+    ]
+
+
+def test_image_hashes_match_reference():
+    images = make_images(8)
+
+    hashes = [result["hash"] for result in encode_blurhashes(images)]
+
+    assert hashes == encode_reference(images)
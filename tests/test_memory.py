@@ -0,0 +1,41 @@
+from pipeline.memory import MemoryWatcher
+
+GB = 1024**3
+
+
+def new_watcher() -> MemoryWatcher:
+    return MemoryWatcher({"a1111": lambda: None}, is_quiet=lambda: True)
+
+
+def sample(watcher: MemoryWatcher, vram: float):
+    watcher._MemoryWatcher__sample(
+        "a1111",
+        {"cuda": {"system": {"total": 10 * GB, "used": int(vram * 10 * GB)}}},
+    )
+
+
+def test_growth_is_a_leak():
+    watcher = new_watcher()
+    for i in range(10):
+        sample(watcher, 0.4 + i * 0.02)
+
+    assert watcher.recycle_reasons == {"a1111": "VRAM_LEAK"}
+
+
+def test_checkpoint_swap_is_not_a_leak():
+    watcher = new_watcher()
+    for _ in range(9):
+        sample(watcher, 0.4)
+
+    watcher.clear_samples("a1111")
+    for _ in range(10):
+        sample(watcher, 0.7)
+
+    assert watcher.recycle_reasons == {}
+
+
+def test_limit_is_crossed_right_away():
+    watcher = new_watcher()
+    sample(watcher, 0.96)
+
+    assert watcher.recycle_reasons == {"a1111": "VRAM_LIMIT"}
@@ -0,0 +1,15 @@
+import pytest
+from PIL import Image
+from postprocess.nsfw.service import NsfwService
+
+
+def test_classify_fails_once_service_exits():
+    service = NsfwService("missing_model.h5")
+    try:
+        future = service.classify([Image.new("RGB", (8, 8))])
+
+        with pytest.raises(Exception, match="NSFW service exited"):
+            future.result(timeout=60)
+        assert not service.is_running
+    finally:
+        service.close()
@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+import pytest
+from job.registry import (
+    BackendRegistry,
+    WebUIBackend,
+    get_checkpoint_names,
+    parse_backends,
+)
+
+
+def new_registry() -> BackendRegistry:
+    backends = [
+        WebUIBackend("gpu0", "localhost", 7860, is_flux=False),
+        WebUIBackend("gpu1", "localhost", 7861, is_flux=False),
+        WebUIBackend("forge", "localhost", 7870, is_flux=True),
+    ]
+    backends[0].capabilities["checkpoints"] = get_checkpoint_names(
+        [{"title": "sdxl.safetensors [abc]", "model_name": "sdxl"}]
+    )
+    backends[1].capabilities["checkpoints"] = {}
+    backends[1].capabilities["loras"] = {"detail"}
+    return BackendRegistry(backends)
+
+
+def new_job(checkpoint=None, loras=(), is_flux=False):
+    return SimpleNamespace(
+        get_checkpoint=lambda: checkpoint,
+        get_requirements=lambda: {
+            "flux": is_flux,
+            "checkpoints": {checkpoint} if checkpoint else set(),
+            "loras": set(loras),
+        },
+    )
+
+
+def test_parse_backends():
+    assert parse_backends("gpu0=localhost:7860, 10.0.0.2:7861,") == [
+        ("gpu0", "localhost", 7860),
+        ("10.0.0.2:7861", "10.0.0.2", 7861),
+    ]
+    with pytest.raises(ValueError):
+        parse_backends("gpu0=localhost")
+
+
+def test_route_to_capable_backend():
+    registry = new_registry()
+
+    assert registry.route(new_job("sdxl.safetensors")) == "gpu0"
+    assert registry.route(new_job("sdxl", loras=["detail"])) == "gpu0"
+    assert registry.route(new_job(loras=["detail"])) == "gpu0"
+    assert registry.route(new_job("flux1-dev", is_flux=True)) == "forge"
+
+
+def test_route_ignores_requirements_no_backend_meets():
+    assert new_registry().route(new_job("unknown")) == "gpu0"
+
+
+def test_route_to_least_loaded():
+    registry = new_registry()
+
+    with registry.use("gpu0"):
+        assert registry.route(new_job()) == "gpu1"
+        assert registry.route(new_job("unknown")) == "gpu1"
+        assert registry.route(new_job("sdxl")) == "gpu0"
+
+
+def test_route_waits_for_skipped_capable_backend():
+    registry = new_registry()
+    registry.skip_when(lambda name: name == "gpu0")
+
+    assert registry.route(new_job("sdxl")) is None
+    assert registry.route(new_job()) == "gpu1"
+
+
+def test_failure_streak():
+    registry = new_registry()
+
+    for is_backend_failure in [True, True, False, True]:
+        registry.mark_generated("gpu0", is_backend_failure)
+
+    assert registry.get_failure_streak("gpu0") == 1
+    assert registry.get_failure_streak("gpu1") == 0
+
+
+def test_checkpoint_swaps():
+    registry = new_registry()
+    swapped = []
+    registry.on_swap(swapped.append)
+
+    for checkpoint in ["sdxl", None, "sdxl", "anime"]:
+        with registry.use("gpu0", checkpoint):
+            pass
+
+    assert registry.checkpoints == {"gpu0": "anime"}
+    assert registry.checkpoint_swaps == 1
+    assert swapped == ["gpu0", "gpu0"]
@@ -0,0 +1,55 @@
+import json
+import subprocess
+import sys
+from conftest import SRC_DIR
+from defines import Settings
+
+# Slow to import, only loaded once first needed or by the warm-up
+LAZY_MODULES = ["boto3", "elasticsearch", "av", "tensorflow"]
+
+STARTUP_SCRIPT = f"""
+import json, sys
+import main
+print(json.dumps({{
+    "total": main.startup_profile.total,
+    "loaded": [name for name in {LAZY_MODULES!r} if name in sys.modules],
+}}))
+"""
+
+
+def import_main() -> dict:
+    """
+    Import the worker from a fresh interpreter, like on startup.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT],
+        cwd=SRC_DIR,
+        capture_output=True,
+        text=True,
+        timeout=Settings.STARTUP_BUDGET * 3,
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_startup_within_budget():
+    assert import_main()["total"] < Settings.STARTUP_BUDGET
+
+
+def test_slow_modules_are_lazy():
+    assert import_main()["loaded"] == []
+
+
+def test_image_cache_is_lazy(tmp_path):
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys; sys.path.insert(0, {SRC_DIR!r}); import job.payload",
+        ],
+        cwd=tmp_path,
+        check=True,
+        timeout=Settings.STARTUP_BUDGET * 3,
+    )
+
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,36 @@
+import asyncio
+import base64
+import json
+import pytest
+from webuiapi.stream import parse_response_async
+
+IMAGE = bytes(range(256)) * 1024
+
+
+async def chunked(body: bytes, size: int = 1000):
+    for start in range(0, len(body), size):
+        await asyncio.sleep(0)
+        yield body[start : start + size]
+
+
+def test_parse_async_decodes_images():
+    body = json.dumps(
+        {
+            "images": [base64.b64encode(IMAGE).decode()] * 2,
+            "info": json.dumps({"seed": 1}),
+        }
+    ).encode()
+
+    result = asyncio.run(parse_response_async(chunked(body)))
+
+    assert result["images"] == [IMAGE, IMAGE]
+    assert json.loads(result["info"]) == {"seed": 1}
+
+
+def test_parse_async_invalid_body_does_not_hang():
+    body = b"[" + b" " * 100_000
+
+    with pytest.raises(ValueError):
+        asyncio.run(
+            asyncio.wait_for(parse_response_async(chunked(body)), timeout=10)
+        )
@@ -0,0 +1,47 @@
+from io import BytesIO
+import pytest
+from PIL import Image
+
+av = pytest.importorskip("av")
+
+from postprocess.r2.video import Mp4Encoder
+
+
+class Sink:
+    """Sequential output, like the spool and upload streams."""
+
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data) -> int:
+        self.data += bytes(data)
+        return len(data)
+
+
+def encode(fragmented: bool) -> bytes:
+    sink = Sink()
+    with Mp4Encoder(
+        sink, 65, 48, fps=8, crf=23, preset="ultrafast", fragmented=fragmented
+    ) as encoder:
+        for i in range(8):
+            encoder.write(Image.new("RGB", (65, 48), (i * 30, 0, 0)))
+    return sink.data
+
+
+def test_mp4_has_index_up_front():
+    data = encode(fragmented=False)
+
+    assert b"moof" not in data
+    assert 0 <= data.find(b"moov") < data.find(b"mdat")
+    with av.open(BytesIO(data)) as container:
+        assert container.duration == 1_000_000
+        assert container.streams.video[0].frames == 8
+        assert container.streams.video[0].width == 64
+
+
+def test_fragmented_mp4_is_opt_in():
+    data = encode(fragmented=True)
+
+    assert b"moof" in data
+    with av.open(BytesIO(data)) as container:
+        assert len(list(container.decode(video=0))) == 8